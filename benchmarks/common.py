@@ -0,0 +1,27 @@
+import io
+import contextlib
+from functools import lru_cache
+from comad.synthetic import neutral_table
+from comad.neufit import neufit_table
+
+# Synthetic neutral tables, name: (otus, samples, depth, sparsity)
+SIZES = {'1e3x1e2': (10**3, 10**2, 10**4, 0.9),
+         '1e5x1e3': (10**5, 10**3, 10**4, 0.99),
+         '1e6x1e4': (10**6, 10**4, 10**4, 0.999)}
+
+
+@lru_cache(maxsize=None)
+def table(size):
+    '''Sparse (counts, otu_ids, sample_ids) table of SIZES[size], built
+    once per benchmark process'''
+    n_otus, n_samples, depth, sparsity = SIZES[size]
+    return neutral_table(n_otus, n_samples, depth, m=0.1, sparsity=sparsity,
+                         seed=0)
+
+
+@lru_cache(maxsize=None)
+def fitted(size):
+    '''neufit_table() results (occurr_freqs, n_reads, n_samples, r_square,
+    beta_fit) of table(size)'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        return neufit_table(table(size), seed=0)
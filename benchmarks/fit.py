@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+from comad.neufit_utils import beta_cdf, fit_neutral_model
+
+
+class TimeFitNeutralModel:
+    '''Fit of m for a growing number of OTUs, dedicated scalar fitter vs
+    the generic lmfit Model.fit.'''
+    params = ([10**4, 10**5, 3 * 10**5], ['scalar', 'lmfit'])
+    param_names = ['otus', 'method']
+
+    def setup(self, otus, method):
+        rng = np.random.default_rng(0)
+        n_reads, n_samples = 10000, 1000
+        p = rng.lognormal(-14, 2.5, otus)
+        totals = rng.poisson(p / p.sum() * n_reads * n_samples) + 1
+        mean_abundance = totals / (n_reads * n_samples)
+        occurrence = beta_cdf(mean_abundance, n_reads, 0.2) + rng.normal(0, 0.05, otus)
+        self.occurr_freqs = pd.DataFrame({'mean_abundance': mean_abundance,
+                                          'occurrence': np.clip(occurrence, 0, 1)})
+        self.n_reads = n_reads
+
+    def time_fit(self, otus, method):
+        fit_neutral_model(self.occurr_freqs, self.n_reads, method)
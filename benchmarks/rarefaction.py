@@ -0,0 +1,49 @@
+import numpy as np
+from comad.neufit_utils import rarefy
+
+
+def per_read_rarefy(counts, depth, rng):
+    # Previous subsample() kernel: one array entry per read, drawn with the 
+    # legacy np.random.choice as before
+    flattened = np.repeat(np.arange(counts.size), counts)
+    subsample = rng.choice(flattened, depth, replace=False)
+    return np.bincount(subsample, minlength=counts.size)
+
+
+class TimeRarefySample:
+    '''Cost of rarefying one 2000-OTU sample to 1000 reads as its read 
+    count grows; the hypergeometric kernel should stay flat.'''
+    params = ([10**4, 10**5, 10**6, 10**7], ['hypergeometric', 'per_read'])
+    param_names = ['reads', 'method']
+
+    def setup(self, reads, method):
+        rng = np.random.default_rng(0)
+        proportions = rng.dirichlet(np.full(2000, 0.1))
+        self.counts = rng.multinomial(reads, proportions)[:, None]
+        self.rng = np.random.default_rng(1)
+        self.legacy_rng = np.random.RandomState(1)
+
+    def time_rarefy(self, reads, method):
+        if method == 'hypergeometric':
+            rarefy(self.counts, 1000, seed=self.rng)
+        else:
+            per_read_rarefy(self.counts[:, 0], 1000, self.legacy_rng)
+
+    def peakmem_rarefy(self, reads, method):
+        self.time_rarefy(reads, method)
+
+
+class TimeRarefyTable:
+    '''Whole-table rarefaction, dense vs sparse.'''
+    params = ([100, 1000], ['dense', 'sparse'])
+    param_names = ['samples', 'layout']
+
+    def setup(self, samples, layout):
+        from scipy import sparse
+        rng = np.random.default_rng(0)
+        counts = rng.negative_binomial(0.05, 0.001, size=(5000, samples))
+        self.counts = sparse.csc_matrix(counts) if layout == 'sparse' else counts
+        self.depth = int(np.percentile(counts.sum(0), 10))
+
+    def time_rarefy(self, samples, layout):
+        rarefy(self.counts, self.depth, seed=0)
@@ -0,0 +1,99 @@
+import io
+import os
+import shutil
+import tempfile
+import contextlib
+from comad.neufit_utils import (rarefy, occurrence_frequencies,
+                                fit_neutral_model, neutral_confint)
+from comad.utils import load_abundances, non_neutral_outliers
+from comad.synthetic import write_biom, write_tsv
+from .common import SIZES, table, fitted
+
+# One parameter per stage of comad_pipeline(), timed on synthetic neutral
+# tables up to 10^6 OTUs x 10^4 samples; the largest tables take a while
+# to generate, hence the long timeouts.
+
+
+class TimeLoad:
+    '''Parsing the input table (load_abundances).'''
+    params = (list(SIZES), ['tsv', 'biom', 'biom_sparse'])
+    param_names = ['size', 'format']
+    timeout = 1200
+
+    def setup(self, size, format):
+        if size == '1e6x1e4' and format != 'biom_sparse':
+            # 10^10 dense cells
+            raise NotImplementedError
+        self.tmpdir = tempfile.mkdtemp()
+        if format == 'tsv':
+            self.filename = os.path.join(self.tmpdir, 'table.tsv')
+            write_tsv(table(size), self.filename)
+        else:
+            self.filename = os.path.join(self.tmpdir, 'table.biom')
+            write_biom(table(size), self.filename)
+
+    def teardown(self, size, format):
+        shutil.rmtree(self.tmpdir)
+
+    def time_load(self, size, format):
+        load_abundances(self.filename, sparse=format == 'biom_sparse')
+
+
+class TimeStages:
+    '''Rarefaction (the subsample() kernel), occurrence frequencies, fit of
+    m, Wilson confidence interval and non-neutral outliers.'''
+    params = list(SIZES)
+    param_names = ['size']
+    timeout = 1200
+
+    def setup(self, size):
+        self.counts = table(size)[0]
+        self.otu_ids = table(size)[1]
+        self.depth = SIZES[size][2]
+        self.occurr_freqs, self.n_reads, self.n_samples = fitted(size)[:3]
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self, size):
+        shutil.rmtree(self.tmpdir)
+
+    def time_rarefy(self, size):
+        rarefy(self.counts, self.depth // 2, seed=0)
+
+    def peakmem_rarefy(self, size):
+        rarefy(self.counts, self.depth // 2, seed=0)
+
+    def time_occurrence_frequencies(self, size):
+        occurrence_frequencies(self.counts, self.otu_ids, self.n_reads)
+
+    def time_fit(self, size):
+        fit_neutral_model(self.occurr_freqs, self.n_reads)
+
+    def time_confint(self, size):
+        neutral_confint(self.occurr_freqs['predicted_occurrence'], self.n_samples)
+
+    def time_non_neutral_outliers(self, size):
+        with contextlib.redirect_stdout(io.StringIO()):
+            non_neutral_outliers(os.path.join(self.tmpdir, 'run'),
+                                 self.occurr_freqs, full=True)
+
+
+class TimeNeufitPlot:
+    '''Plot of the fit, saved as pdf.'''
+    params = list(SIZES)
+    param_names = ['size']
+    timeout = 1200
+
+    def setup(self, size):
+        import matplotlib
+        matplotlib.use('Agg')
+        self.results = fitted(size)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self, size):
+        shutil.rmtree(self.tmpdir)
+
+    def time_neufit_plot(self, size):
+        from comad.plotting import neufit_plot
+        occurr_freqs, n_reads, n_samples, r_square, beta_fit = self.results
+        neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square,
+                    os.path.join(self.tmpdir, 'run'), False)
@@ -0,0 +1,209 @@
+import os
+import time
+import traceback
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+# Manifest columns passed on to comad_pipeline() and how to parse them
+MANIFEST_COLUMNS = {'input_filename': str,
+                    'output_filename': str,
+                    'output_filepath': str,
+                    'arg_rarefaction_level': int,
+                    'arg_ignore_level': int,
+                    'neufit_plot_bool': bool,
+                    'HP_Color': bool,
+                    'sparse': bool,
+                    'save_data_tax': bool,
+                    'seed': int,
+                    'jobs': int,
+                    'rarefaction_iterations': int,
+                    'bootstrap': int,
+                    'cache': bool,
+                    'profile': bool,
+                    'chunksize': int,
+                    'samples': str,
+                    'metadata': str,
+                    'where': str,
+                    'group_by': str,
+                    'results_format': str,
+                    'ranks': str}
+
+SUMMARY_COLUMNS = ['output_filename', 'input_filename', 'status', 'm',
+                   'r_square', 'n_samples', 'n_otus', 'n_reads', 'seconds',
+                   'error']
+
+
+def _parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 't', 'yes', 'y', '1')
+    return bool(value)
+
+
+def read_manifest(manifest_filename, output_filepath=None):
+    '''Reads a batch manifest into one comad_pipeline() argument dict
+        per row
+
+    Parameters
+    ----------
+    manifest_filename: str, path
+        Tab separated file with a header row. input_filename and
+        output_filename are required; output_filepath and every other
+        column of MANIFEST_COLUMNS (e.g. arg_rarefaction_level, sparse,
+        seed) are optional. Empty cells use the comad_pipeline() default.
+    output_filepath: str, optional
+        Used for rows without an output_filepath.
+
+    Returns
+    -------
+    jobs: list of dict
+    '''
+    manifest = pd.read_csv(manifest_filename, sep='\t', dtype=str,
+                           keep_default_na=False, comment='#')
+    unknown = set(manifest.columns) - set(MANIFEST_COLUMNS)
+    if unknown:
+        raise ValueError('Unknown manifest columns: ' + ', '.join(sorted(unknown)))
+    for column in ('input_filename', 'output_filename'):
+        if column not in manifest.columns:
+            raise ValueError('Manifest needs an ' + column + ' column')
+
+    jobs = []
+    for _, row in manifest.iterrows():
+        job = parse_job(row.to_dict())
+        if 'output_filepath' not in job:
+            if output_filepath is None:
+                raise ValueError('No output_filepath for ' + job['output_filename'])
+            job['output_filepath'] = output_filepath
+        jobs.append(job)
+    return jobs
+
+
+def parse_job(job):
+    '''comad_pipeline() arguments of one manifest row or json job
+
+    Values are converted to the types of MANIFEST_COLUMNS (strings such
+    as '1' or 'true' as in a manifest, or already typed json values);
+    empty strings and None are left out, i.e. use the default.
+    '''
+    unknown = set(job) - set(MANIFEST_COLUMNS)
+    if unknown:
+        raise ValueError('Unknown job keys: ' + ', '.join(sorted(unknown)))
+    parsed = {}
+    for column, value in job.items():
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            continue
+        parse = _parse_bool if MANIFEST_COLUMNS[column] is bool else MANIFEST_COLUMNS[column]
+        parsed[column] = parse(value)
+    for column in ('input_filename', 'output_filename'):
+        if column not in parsed:
+            raise ValueError('Job needs an ' + column)
+    return parsed
+
+
+def _init_worker():
+    # Import the heavy dependencies once per worker instead of per job
+    import comad.neufit  # noqa: F401
+    import comad.plotting  # noqa: F401
+
+
+def run_job(job):
+    '''Runs comad_pipeline() for one manifest row and summarises the fit
+
+    Failures are recorded in the summary instead of being raised, so one
+    bad input does not stop a batch.
+    '''
+    from comad.neufit import comad_pipeline
+
+    summary = dict.fromkeys(SUMMARY_COLUMNS)
+    summary.update({'output_filename': job['output_filename'],
+                    'input_filename': job['input_filename']})
+    start = time.time()
+    try:
+        results = comad_pipeline(show_plot=False, **job)
+        if results is None:
+            raise ValueError('Invlaid file format')
+        if job.get('group_by') is not None:
+            #Summarise the combined group
+            combined = results[0].iloc[-1]
+            summary.update({'m': combined['m'], 'r_square': combined['r_square'],
+                            'n_samples': combined['n_samples'],
+                            'n_otus': combined['n_otus'],
+                            'n_reads': combined['n_reads']})
+        elif job.get('ranks') is not None:
+            #Summarise the first rank
+            rank = results[0].iloc[0]
+            occurr_freqs, n_reads, n_samples, r_square, beta_fit = \
+                next(iter(results[1].values()))
+            summary.update({'m': rank['m'], 'r_square': rank['r_square'],
+                            'n_samples': n_samples, 'n_otus': rank['n_taxa'],
+                            'n_reads': rank['n_reads']})
+        elif job.get('rarefaction_iterations', 1) > 1:
+            ensemble = results[0]
+            summary.update({'m': ensemble.loc['m', 'mean'],
+                            'r_square': ensemble.loc['r_square', 'mean'],
+                            'n_samples': ensemble.attrs['n_samples'],
+                            'n_otus': ensemble.attrs['n_otus'],
+                            'n_reads': ensemble.attrs['n_reads']})
+        else:
+            occurr_freqs, n_reads, n_samples, r_square, beta_fit = results
+            summary.update({'m': beta_fit.best_values['m'],
+                            'r_square': r_square, 'n_samples': n_samples,
+                            'n_otus': len(occurr_freqs), 'n_reads': n_reads})
+        summary['status'] = 'ok'
+    except Exception:
+        summary['status'] = 'failed'
+        summary['error'] = traceback.format_exc().strip().splitlines()[-1]
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def run_batch(manifest_filename, jobs=1, summary_filename=None,
+              output_filepath=None, cache=True):
+    '''Runs every row of a manifest through comad_pipeline() on a process
+        pool and writes a summary table
+
+    Parameters
+    ----------
+    manifest_filename: str, path
+        Manifest, see read_manifest().
+    jobs: int, optional
+        Number of datasets processed in parallel; 0 uses all CPUs.
+        Default is 1.
+    summary_filename: str, path, optional
+        Where to write the summary. Default is [manifest]_summary.tsv next
+        to the manifest.
+    output_filepath: str, optional
+        Output folder for rows without an output_filepath.
+    cache: bool, optional
+        Result cache setting for rows without a cache column, see
+        comad_pipeline(). Default is True.
+
+    Returns
+    -------
+    summary: pandas df
+        One row per manifest row (same order): output_filename,
+        input_filename, status, m, r_square, n_samples, n_otus, n_reads,
+        seconds and error.
+    '''
+    from comad.parallel import resolve_jobs
+
+    manifest = read_manifest(manifest_filename, output_filepath)
+    for job in manifest:
+        job.setdefault('cache', cache)
+    jobs = resolve_jobs(jobs)
+    if jobs > 1 and len(manifest) > 1:
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=_init_worker) as pool:
+            results = list(pool.map(run_job, manifest))
+    else:
+        _init_worker()
+        results = [run_job(job) for job in manifest]
+
+    summary = pd.DataFrame(results, columns=SUMMARY_COLUMNS)
+    summary = summary.astype({'n_samples': 'Int64', 'n_otus': 'Int64',
+                              'n_reads': 'Int64'})
+    if summary_filename is None:
+        summary_filename = os.path.splitext(manifest_filename)[0] + '_summary.tsv'
+    summary.to_csv(summary_filename, sep='\t', index=False)
+    return summary
@@ -0,0 +1,316 @@
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from comad import __version__
+
+# Files written next to the report, as suffixes of the run's file_header
+OUTPUT_SUFFIXES = ['.txt', '_FullNonNeutral.csv', '_NonNeutral_Outliers.csv',
+                   '_ensemble_otus.tsv', '_ensemble_iterations.tsv',
+                   '.pdf', '.tsv', '_results.parquet', '_results.feather']
+
+# Default bound on the total size of the cache, in bytes
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+
+# TableCache used by load_abundances(); None loads every table from disk
+_active_tables = ContextVar('comad_table_cache', default=None)
+
+
+def default_cache_dir():
+    '''Cache folder: $COMAD_CACHE_DIR, else $XDG_CACHE_HOME/comad, else
+        ~/.cache/comad'''
+    if os.environ.get('COMAD_CACHE_DIR'):
+        return os.environ['COMAD_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or \
+           os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'comad')
+
+
+def file_digest(filename, block_size=1 << 20):
+    '''sha256 of a file's contents
+
+    A .comad folder (see comad.columnar) is identified by its meta.json,
+    which records the digest of the stored arrays, ids and taxonomy 
+    (content_sha256). Folders written without one are hashed file by 
+    file, see folder_digest().
+    '''
+    if os.path.isdir(filename):
+        import json
+        with open(os.path.join(filename, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('content_sha256') is None:
+            return folder_digest(filename, exclude=())
+        filename = os.path.join(filename, 'meta.json')
+    digest = hashlib.sha256()
+    _update_digest(digest, filename, block_size)
+    return digest.hexdigest()
+
+
+def folder_digest(folder, exclude=('meta.json',), block_size=1 << 20):
+    '''sha256 of the names and contents of every file in a folder
+        (sorted by name), except those in exclude'''
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if name in exclude or not os.path.isfile(path):
+            continue
+        digest.update(('\n' + name + '\n').encode())
+        _update_digest(digest, path, block_size)
+    return digest.hexdigest()
+
+
+def _update_digest(digest, filename, block_size):
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+
+def result_key(input_filename, **params):
+    '''Cache key of a comad_pipeline() run
+
+    Parameters
+    ----------
+    input_filename: str, path
+        Input table; its contents (not its name or time stamp) are hashed.
+    params:
+        Every argument that changes the results or output files, e.g.
+        arg_rarefaction_level, arg_ignore_level and seed.
+
+    Returns
+    -------
+    key: str
+        Hex digest of the input contents, params and the comad version.
+    '''
+    digest = hashlib.sha256()
+    digest.update(file_digest(input_filename).encode())
+    digest.update(('comad ' + __version__).encode())
+    for name in sorted(params):
+        digest.update(('\n' + name + '=' + repr(params[name])).encode())
+    return digest.hexdigest()
+
+
+def selection_key(samples=None, metadata=None, where=None):
+    '''result_key() params of a sample selection: the selected ids and
+        filter, and the contents of files they are read from'''
+    from comad.utils import read_sample_list, parse_where
+    if samples is None and where is None:
+        return {}
+    params = {'samples': None if samples is None else sorted(read_sample_list(samples)),
+              'where': None if where is None else sorted(parse_where(where).items())}
+    if isinstance(metadata, str):
+        params['metadata'] = file_digest(metadata)
+    elif metadata is not None:
+        params['metadata'] = _frame_digest(metadata)
+    return params
+
+
+def _frame_digest(df):
+    '''sha256 of a pandas df's contents'''
+    import pandas as pd
+    return hashlib.sha256(pd.util.hash_pandas_object(df).values.tobytes()).hexdigest()
+
+
+class ResultCache:
+    '''Size bounded, least recently used store of comad_pipeline() results
+
+    Every entry is a single pickle holding the returned results and the
+    contents of the output files (report, non-neutral tables, plot).
+    Reading an entry marks it as recently used; after each store the
+    least recently used entries are removed until the cache is at most
+    max_size bytes.
+
+    Parameters
+    ----------
+    cache_dir: str, path, optional
+        Default is default_cache_dir().
+    max_size: int, optional
+        Size bound in bytes. Default is $COMAD_CACHE_SIZE or 2 GiB.
+    '''
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        if max_size is None:
+            max_size = int(os.environ.get('COMAD_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        '''Cached entry (dict with 'results' and 'files') or None'''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, results, file_header=None, suffixes=OUTPUT_SUFFIXES):
+        '''Stores results and the output files of file_header (those with 
+            one of suffixes)'''
+        files = {}
+        if file_header is not None:
+            for suffix in suffixes:
+                fn = str(file_header) + suffix
+                if os.path.isfile(fn):
+                    with open(fn, 'rb') as f:
+                        files[suffix] = f.read()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        #Write to a temporary file first so parallel runs never read a
+        #partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'results': results, 'files': files}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        '''Removes least recently used entries beyond max_size'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        '''Removes all entries'''
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+def restore_outputs(entry, file_header):
+    '''Writes the cached output files of entry under a new file_header'''
+    for suffix, contents in entry['files'].items():
+        with open(str(file_header) + suffix, 'wb') as f:
+            f.write(contents)
+
+
+def active_table_cache():
+    '''TableCache activated in this thread/context, or None'''
+    return _active_tables.get()
+
+
+def _table_nbytes(table):
+    counts = table[0]
+    if hasattr(counts, 'nnz'):
+        return counts.data.nbytes + counts.indices.nbytes + counts.indptr.nbytes
+    return counts.nbytes
+
+
+class TableCache:
+    '''Size bounded, least recently used in-memory store of loaded tables
+
+    While activated (``with tables.activate():``), load_abundances() serves
+    whole-table loads from memory instead of parsing the file again, e.g.
+    in a long running `comad serve` process. Tables are keyed by path,
+    size and modification time, so an edited file is loaded again. They
+    are stored as the read only (counts, otu_ids, sample_ids) tuple of
+    table_counts(), shared by every job that uses them.
+
+    Parameters
+    ----------
+    max_size: int, optional
+        Size bound of the counts in bytes. Default is
+        $COMAD_TABLE_CACHE_SIZE or 2 GiB.
+    '''
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = int(os.environ.get('COMAD_TABLE_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+        self.max_size = max_size
+        self.tables = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        '''Serves load_abundances() from this cache in the enclosed block'''
+        token = _active_tables.set(self)
+        try:
+            yield self
+        finally:
+            _active_tables.reset(token)
+
+    @staticmethod
+    def key(input_filename, sparse):
+        '''(path, size, mtime, sparse); .comad folders by their meta.json'''
+        path = os.path.realpath(input_filename)
+        stat = os.stat(os.path.join(path, 'meta.json') if os.path.isdir(path) else path)
+        return (path, stat.st_size, stat.st_mtime_ns, bool(sparse))
+
+    @property
+    def size(self):
+        return sum(nbytes for _, nbytes in self.tables.values())
+
+    def get(self, input_filename, sparse, load):
+        '''Cached table, or load() stored as a read only table_counts() 
+            tuple; None (unsupported format) is not stored'''
+        from comad.utils import table_counts
+        key = self.key(input_filename, sparse)
+        with self._lock:
+            if key in self.tables:
+                self.tables.move_to_end(key)
+                self.hits += 1
+                return self.tables[key][0]
+            self.misses += 1
+        #Parse outside the lock, other tables stay available meanwhile; 
+        #load() itself must read from disk
+        token = _active_tables.set(None)
+        try:
+            table = load()
+        finally:
+            _active_tables.reset(token)
+        if table is None:
+            return None
+        table = table_counts(table)
+        counts = table[0]
+        for array in ([counts.data, counts.indices, counts.indptr] 
+                      if hasattr(counts, 'nnz') else [counts]):
+            array.flags.writeable = False
+        with self._lock:
+            self.tables[key] = (table, _table_nbytes(table))
+            self.evict()
+        return table
+
+    def evict(self):
+        '''Drops least recently used tables beyond max_size (call with 
+            the lock held)'''
+        while len(self.tables) > 1 and self.size > self.max_size:
+            self.tables.popitem(last=False)
+
+    def info(self):
+        '''Cached tables (oldest first) and hit counts, json serialisable'''
+        with self._lock:
+            return {'max_size': self.max_size, 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'tables': [{'filename': key[0], 'sparse': key[3],
+                                'shape': list(table[0].shape), 'nbytes': nbytes}
+                               for key, (table, nbytes) in self.tables.items()]}
@@ -0,0 +1,188 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from scipy import sparse as scipy_sparse
+from comad import __version__
+from comad.neufit_utils import CountTable
+
+# Suffix of converted tables, e.g. combined.comad/
+EXTENSION = '.comad'
+
+# Bumped whenever the layout of the folder changes
+FORMAT_VERSION = 1
+
+SPARSE_ARRAYS = ['data', 'indices', 'indptr']
+
+
+def is_columnar(filename):
+    '''True if filename is a table written by convert_table()'''
+    return os.path.isfile(os.path.join(str(filename), 'meta.json'))
+
+
+def read_meta(filename):
+    '''meta.json of a converted table: format, layout, shape, nnz and the
+        sha256 of the input it was converted from'''
+    with open(os.path.join(filename, 'meta.json')) as f:
+        return json.load(f)
+
+
+def write_columnar(table, filename, taxonomy=None, source_digest=None):
+    '''Writes a count table as a folder of .npy arrays that
+        load_columnar() can memory-map
+
+    Parameters
+    ----------
+    table: tuple, pandas df or any table accepted by table_counts()
+        Dense tables are stored dense, in column (sample) major order;
+        sparse ones (e.g. the tuple of biom2sparse()) as the data,
+        indices and indptr arrays of a CSC matrix.
+    filename: str, path
+        Output folder, conventionally ending in .comad. Replaced if it
+        exists.
+    taxonomy: pandas df, optional
+        Taxonomic information indexed by otu_id, stored as taxonomy.tsv.
+    source_digest: str, optional
+        sha256 of the original input, recorded in meta.json.
+
+    The sha256 of everything written (arrays, ids and taxonomy.tsv) is
+    recorded in meta.json as content_sha256, the table's identity in the
+    result cache.
+    '''
+    from comad.cache import folder_digest
+    from comad.utils import table_counts
+    counts, otu_ids, sample_ids = table_counts(table)
+
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    tmp_filename = str(filename) + '.tmp'
+    if os.path.isdir(tmp_filename):
+        shutil.rmtree(tmp_filename)
+    os.makedirs(tmp_filename)
+
+    meta = {'format': FORMAT_VERSION, 'comad_version': __version__,
+            'shape': list(counts.shape), 'source_sha256': source_digest}
+    if scipy_sparse.issparse(counts):
+        meta['layout'], meta['nnz'] = 'csc', int(counts.nnz)
+        meta['dtype'] = str(counts.data.dtype)
+        for name in SPARSE_ARRAYS:
+            np.save(os.path.join(tmp_filename, name + '.npy'), getattr(counts, name))
+    else:
+        meta['layout'], meta['nnz'] = 'dense', int(np.count_nonzero(counts))
+        meta['dtype'] = str(counts.dtype)
+        np.save(os.path.join(tmp_filename, 'counts.npy'), np.asfortranarray(counts))
+    #Ids as fixed width strings, so loading them needs no pickle
+    np.save(os.path.join(tmp_filename, 'otu_ids.npy'), np.asarray(otu_ids).astype(str))
+    np.save(os.path.join(tmp_filename, 'sample_ids.npy'), np.asarray(sample_ids).astype(str))
+    if taxonomy is not None:
+        taxonomy.to_csv(os.path.join(tmp_filename, 'taxonomy.tsv'), sep='\t')
+
+    meta['content_sha256'] = folder_digest(tmp_filename)
+
+    #meta.json last: a folder without it is not a complete table
+    with open(os.path.join(tmp_filename, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_filename, filename)
+
+
+def convert_table(input_filename, output_filename=None, sparse=None,
+                  taxonomy=None):
+    '''Converts a tsv or biom table once into the memory-mapped format
+
+    Parameters
+    ----------
+    input_filename: str, path
+        .tsv (OTUs as rows, samples as columns) or .biom file.
+    output_filename: str, path, optional
+        Output folder. Default is input_filename with its extension
+        replaced by .comad.
+    sparse: bool, optional
+        Store the counts as a CSC matrix (True) or dense (False). Default
+        is sparse for biom and dense for tsv inputs.
+    taxonomy: str, path or pandas df, optional
+        Taxonomy to store with the counts ([]_taxonomy.csv file or df
+        indexed by otu_id).
+
+    Returns
+    -------
+    output_filename: str
+    '''
+    from comad.cache import file_digest
+    from comad.utils import load_abundances
+    extension = input_filename.split('.')[-1]
+    if output_filename is None:
+        output_filename = input_filename[:-len(extension) - 1] + EXTENSION
+    if sparse is None:
+        sparse = extension == 'biom'
+
+    table = load_abundances(input_filename, sparse=extension == 'biom')
+    if table is None:
+        raise ValueError('Invlaid file format: ' + str(input_filename))
+    if sparse and isinstance(table, pd.DataFrame):
+        table = (scipy_sparse.csc_matrix(table.to_numpy()), table.index.to_numpy(),
+                 table.columns.to_numpy())
+    elif not sparse and isinstance(table, tuple):
+        counts, otu_ids, sample_ids = table
+        table = (counts.toarray(), otu_ids, sample_ids)
+    if isinstance(taxonomy, str):
+        taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+
+    write_columnar(table, output_filename, taxonomy, file_digest(input_filename))
+    return output_filename
+
+
+def load_columnar(filename, mmap=True):
+    '''Opens a table written by convert_table()
+
+    With mmap the arrays are memory-mapped read only (np.load with
+    mmap_mode='r'): nothing is parsed or copied up front, pages are read
+    on first use and processes opening the same table share the page
+    cache.
+
+    Parameters
+    ----------
+    filename: str, path
+        .comad folder.
+    mmap: bool, optional
+        Default is True; False reads the arrays into memory.
+
+    Returns
+    -------
+    (counts, otu_ids, sample_ids): tuple
+        counts is a scipy.sparse.csc_matrix or (OTUs x samples) numpy
+        array, as accepted by neufit_table(). The counts were compacted
+        by write_columnar(), so tables that record their dtype come back
+        as a neufit_utils.CountTable and are never scanned again.
+    '''
+    meta = read_meta(filename)
+    if meta['format'] != FORMAT_VERSION:
+        raise ValueError(str(filename) + ' has format ' + str(meta['format']) +
+                         ', expected ' + str(FORMAT_VERSION) + '; convert the ' +
+                         'input again')
+    mmap_mode = 'r' if mmap else None
+
+    def array(name):
+        return np.load(os.path.join(filename, name + '.npy'), mmap_mode=mmap_mode)
+
+    if meta['layout'] == 'csc':
+        data, indices, indptr = [array(name) for name in SPARSE_ARRAYS]
+        counts = scipy_sparse.csc_matrix((data, indices, indptr),
+                                         shape=tuple(meta['shape']))
+    else:
+        counts = array('counts')
+    #Ids are small and used as pandas indices, read them into memory
+    otu_ids = np.load(os.path.join(filename, 'otu_ids.npy'))
+    sample_ids = np.load(os.path.join(filename, 'sample_ids.npy'))
+    values = counts.data if meta['layout'] == 'csc' else counts
+    if meta.get('dtype') == str(values.dtype):
+        return CountTable((counts, otu_ids, sample_ids))
+    return counts, otu_ids, sample_ids
+
+
+def load_columnar_taxonomy(filename):
+    '''Taxonomy stored with a converted table, or None'''
+    taxonomy_filename = os.path.join(filename, 'taxonomy.tsv')
+    if not os.path.isfile(taxonomy_filename):
+        return None
+    return pd.read_table(taxonomy_filename, header=0, index_col=0, sep='\t')
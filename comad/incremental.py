@@ -0,0 +1,218 @@
+import io
+import pickle
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from comad.neufit_utils import (rarefy, rarefaction_depth, sample_seeds,
+                                col_sums, compact_counts)
+from comad.neufit import _fit_occurrences
+from comad.profiling import stage
+from comad.utils import table_counts
+
+
+class IncrementalFit:
+    '''Neutral fit over a set of samples that grows (and shrinks) batch by
+        batch, without rarefying the samples already seen again
+
+    The fit only needs two numbers per OTU: the sum of its rarefied reads
+    and the number of samples it occurs in. Both are kept up to date as
+    batches are added, together with every kept sample's rarefied column
+    so it can be subtracted again by remove() or when it leaves a sliding
+    window. Adding or removing samples costs time proportional to their
+    non-zero entries; fit() then only refits m.
+
+    Samples are rarefied to one depth for the lifetime of the state. Every
+    sample gets its own random stream, keyed by the order in which samples
+    were added (see sample_seeds()), so adding a table in batches gives
+    the same draws as neufit_table(table, arg_rarefaction_level=depth)
+    with the same seed.
+
+    Parameters
+    ----------
+    depth: int, optional
+        Rarefaction depth. Default (0) is the highest possible uniform read
+        depth of the first batch; samples added later with fewer reads are
+        dropped.
+    seed: int or numpy.random.Generator, optional
+        Seed of the rarefaction draws. Default uses fresh OS entropy, which
+        is drawn once and stored with the state.
+    jobs: int, optional
+        Number of worker processes used for rarefaction; 0 uses all CPUs.
+        Default is 1.
+    '''
+    def __init__(self, depth=0, seed=None, jobs=1):
+        self.depth = depth
+        self.entropy = sample_seeds(seed)
+        self.jobs = jobs
+        self.otu_ids = []
+        self._otu_index = {}
+        self.otu_sums = np.zeros(0, dtype=np.int64)
+        self.otu_occurrences = np.zeros(0, dtype=np.int64)
+        #Rarefied column of every kept sample, in the order they were added
+        self.samples = {}
+        self.n_offered = 0
+
+    @property
+    def n_samples(self):
+        return len(self.samples)
+
+    @property
+    def sample_ids(self):
+        '''Kept samples, oldest first'''
+        return list(self.samples)
+
+    def _otu_indices(self, otu_ids):
+        # Row of every OTU in the per OTU arrays, adding unseen OTUs
+        new = [otu for otu in dict.fromkeys(otu_ids) if otu not in self._otu_index]
+        for otu in new:
+            self._otu_index[otu] = len(self.otu_ids)
+            self.otu_ids.append(otu)
+        if new:
+            self.otu_sums = np.concatenate([self.otu_sums,
+                                            np.zeros(len(new), dtype=np.int64)])
+            self.otu_occurrences = np.concatenate([self.otu_occurrences,
+                                                   np.zeros(len(new), dtype=np.int64)])
+        return np.array([self._otu_index[otu] for otu in otu_ids], dtype=np.int64)
+
+    def add(self, table):
+        '''Rarefies the samples of table and adds them to the fit
+
+        Parameters
+        ----------
+        table: pandas df, numpy array, biom.Table, scipy.sparse matrix or tuple
+            Batch of samples, OTUs as rows and samples as columns, as
+            accepted by neufit_table(). Samples are added in column order.
+
+        Returns
+        -------
+        added: list
+            Ids of the samples added; samples below the depth are dropped.
+        '''
+        counts, otu_ids, sample_ids = table_counts(table)
+        sample_ids = np.asarray(sample_ids).astype(str)
+        duplicates = [sample for sample in sample_ids if sample in self.samples]
+        if duplicates or len(set(sample_ids)) < len(sample_ids):
+            raise ValueError('Samples already in the fit: ' +
+                             ', '.join(duplicates or sample_ids))
+        if self.depth == 0:
+            self.depth = int(rarefaction_depth(col_sums(counts), 0)[0])
+
+        with stage('rarefy', table=counts, depth=self.depth, jobs=self.jobs):
+            rarefied, keep = rarefy(counts, self.depth, sample_ids, self.entropy,
+                                    self.jobs, first_key=self.n_offered)
+        self.n_offered += len(sample_ids)
+
+        with stage('accumulate', table=rarefied):
+            rarefied = sparse.csc_matrix(rarefied)
+            rarefied.eliminate_zeros()
+            rows = self._otu_indices(list(otu_ids))
+            added = []
+            for j, sample in enumerate(sample_ids[keep]):
+                start, end = rarefied.indptr[j], rarefied.indptr[j + 1]
+                otus = rows[rarefied.indices[start:end]]
+                reads = compact_counts(rarefied.data[start:end])
+                self.otu_sums[otus] += reads
+                self.otu_occurrences[otus] += 1
+                self.samples[sample] = (otus, reads)
+                added.append(sample)
+        return added
+
+    def remove(self, sample_ids):
+        '''Subtracts samples from the fit
+
+        Parameters
+        ----------
+        sample_ids: iterable
+            Ids of samples previously added.
+
+        Returns
+        -------
+        removed: list
+        '''
+        sample_ids = [str(sample) for sample in sample_ids]
+        missing = [sample for sample in sample_ids if sample not in self.samples]
+        if missing:
+            raise ValueError('Samples not in the fit: ' + ', '.join(missing))
+        for sample in sample_ids:
+            otus, reads = self.samples.pop(sample)
+            self.otu_sums[otus] -= reads
+            self.otu_occurrences[otus] -= 1
+        return sample_ids
+
+    def slide(self, table, window):
+        '''Adds a batch, then removes the oldest samples so that at most
+            window samples are left
+
+        Samples are ordered by when they were added and, within a batch,
+        by column, so tables should list samples in collection order.
+
+        Returns
+        -------
+        added, removed: list
+        '''
+        added = self.add(table)
+        removed = self.remove(self.sample_ids[:max(self.n_samples - window, 0)])
+        return added, removed
+
+    def occurrence_frequencies(self):
+        '''Same as neufit_utils.occurrence_frequencies() of the rarefied
+            table of the current samples'''
+        if self.n_samples == 0:
+            raise ValueError('No samples in the fit')
+        present = self.otu_sums > 0
+        occurr_freqs = pd.DataFrame({'mean_abundance':
+                                     (1.0*self.otu_sums[present])/self.depth/self.n_samples},
+                                    index=pd.Index(self.otu_ids)[present])
+        occurr_freqs.index.name = 'otu_id'
+        occurr_freqs['occurrence'] = (1.0*self.otu_occurrences[present])/self.n_samples
+        return occurr_freqs.sort_values(by=['mean_abundance'])
+
+    def fit(self, taxonomy=None, output_filename=None, file_header=None):
+        '''Refits the neutral model to the current samples
+
+        Parameters
+        ----------
+        taxonomy, output_filename, file_header: optional
+            As in neufit_table().
+
+        Returns
+        -------
+        Same as neufit(): occurr_freqs, n_reads, n_samples, r_square, beta_fit
+        '''
+        if file_header is not None:
+            file = open(str(file_header) + ".txt", 'w')
+        else:
+            file = io.StringIO()
+
+        if output_filename is not None:
+            print("Running dataset:" + str(output_filename) + '\n')
+
+        if isinstance(taxonomy, str):
+            taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+
+        with stage('occurrence_frequencies', n_otus=len(self.otu_ids)):
+            occurr_freqs = self.occurrence_frequencies()
+        file.write ('Incremental fit of ' + str(self.n_samples) + ' samples ' + \
+                    '(first: ' + str(self.sample_ids[0]) + ', last: ' + \
+                    str(self.sample_ids[-1]) + '), rarefied to ' + \
+                    str(self.depth) + ' reads per sample \n')
+        file.write ('fitting neutral expectation to dataset with ' + \
+                    str(self.n_samples) + ' samples and ' + str(len(occurr_freqs)) + \
+                    ' otus \n \n')
+
+        return _fit_occurrences(file, occurr_freqs, taxonomy, self.depth,
+                                self.n_samples, file_header)
+
+    def save(self, filename):
+        '''Pickles the state, see load_incremental()'''
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_incremental(filename):
+    '''IncrementalFit saved with IncrementalFit.save()'''
+    with open(filename, 'rb') as f:
+        state = pickle.load(f)
+    if not isinstance(state, IncrementalFit):
+        raise ValueError(str(filename) + ' is not a saved incremental fit')
+    return state
@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from scipy.optimize import minimize, minimize_scalar
+from comad.neufit_utils import beta_cdf
+
+OccupancyModel = namedtuple('OccupancyModel', ['predict', 'params', 'description'])
+OccupancyModel.__doc__ = '''Occurrence frequency as a function of mean relative abundance
+
+predict(p, N, *params) evaluates the model for a numpy array of mean
+relative abundances p at rarefaction depth N. params lists the free
+parameters as (name, lower, upper, initial) in log10 space; a bound or
+initial value may be a function of N.'''
+
+
+def _binomial(p, N):
+    # Probability that a taxon of relative abundance p is among N reads
+    return 1.0 - np.power(1.0 - p, N)
+
+
+def _poisson(p, N):
+    return 1.0 - np.exp(-N*p)
+
+
+def _neutral_free_n(p, N, m, N_free):
+    return beta_cdf(p, N_free, m)
+
+
+# Models fitted by compare_models(); add an entry (or use register_model())
+# to compare another one
+MODELS = {
+    'neutral': OccupancyModel(beta_cdf, (('m', -8.0, 0.0, None),),
+                              'Sloan neutral model, N = rarefaction depth'),
+    'neutral_free_N': OccupancyModel(_neutral_free_n,
+                                     (('m', -8.0, 0.0, None),
+                                      ('N', 0.0, lambda N: np.log10(N) + 4.0,
+                                       lambda N: np.log10(N))),
+                                     'Sloan neutral model, N fitted'),
+    'binomial': OccupancyModel(_binomial, (),
+                               'random sampling of N reads, 1 - (1 - p)^N'),
+    'poisson': OccupancyModel(_poisson, (),
+                              'random sampling (Poisson), 1 - exp(-N p)'),
+}
+
+
+def register_model(name, predict, params=(), description=''):
+    '''Adds a model to MODELS, see OccupancyModel'''
+    MODELS[name] = OccupancyModel(predict, tuple(params), description)
+
+
+def occurrence_statistics(occurr_freqs):
+    '''Everything a least squares fit of an occupancy model needs, once
+        per distinct mean abundance
+
+    mean_abundance is a read total / (N * n_samples), so many OTUs share
+    a value. With these statistics the residual sum of squares of any
+    prediction f (one value per distinct p) is
+    sum_of_squares - 2 f.occurrence_sums + weights.f^2.
+
+    Returns
+    -------
+    p: numpy array
+        Distinct mean relative abundances.
+    weights: numpy array
+        OTUs per distinct p.
+    occurrence_sums: numpy array
+        Sum of the occurrence frequencies of those OTUs.
+    sum_of_squares, total_sum_of_squares: float
+        Sum of the squared occurrences, and of their squared deviations
+        from the mean (for R^2).
+    '''
+    occurrence = np.asarray(occurr_freqs['occurrence'], dtype=float)
+    p, inverse = np.unique(np.asarray(occurr_freqs['mean_abundance'], dtype=float),
+                           return_inverse=True)
+    weights = np.bincount(inverse, minlength=p.size)
+    occurrence_sums = np.bincount(inverse, occurrence, minlength=p.size)
+    sum_of_squares = float(np.sum(occurrence**2))
+    total_sum_of_squares = float(np.sum((occurrence - occurrence.mean())**2))
+    return p, weights, occurrence_sums, sum_of_squares, total_sum_of_squares
+
+
+def _value(bound, N):
+    return bound(N) if callable(bound) else bound
+
+
+def fit_model(model, statistics, n_reads, initial=None):
+    '''Least squares fit of one OccupancyModel
+
+    Free parameters are fitted in log10 space within their bounds: one
+    parameter with bounded Brent minimisation (as fit_neutral_model()),
+    several with L-BFGS-B. Every step is one vectorized evaluation of
+    model.predict over the distinct mean abundances.
+
+    Parameters
+    ----------
+    model: OccupancyModel
+    statistics: tuple
+        As returned by occurrence_statistics().
+    n_reads: int
+        Rarefaction depth.
+    initial: dict, optional
+        Starting values (not log10) of parameters fitted with L-BFGS-B, 
+        e.g. m of the neutral fit. Default is the parameter's own initial 
+        value, else the middle of its bounds.
+
+    Returns
+    -------
+    params: dict
+        Fitted parameter values (not log10).
+    rss: float
+        Residual sum of squares over all OTUs.
+    '''
+    p, weights, occurrence_sums, sum_of_squares, _ = statistics
+    N = float(n_reads)
+
+    def rss(log_params):
+        with np.errstate(over='ignore', invalid='ignore'):
+            predicted = model.predict(p, N, *(10.0**np.atleast_1d(log_params)))
+        predicted = np.where(p >= 1.0, 1.0, predicted)
+        value = sum_of_squares - 2.0*np.dot(predicted, occurrence_sums) + \
+                np.dot(weights, predicted**2)
+        return value if np.isfinite(value) else np.inf
+
+    names = [param[0] for param in model.params]
+    bounds = [(_value(lower, N), _value(upper, N)) for _, lower, upper, _ in model.params]
+    if not names:
+        return {}, max(rss(np.array([])), 0.0)
+    if len(names) == 1:
+        opt = minimize_scalar(rss, bounds=bounds[0], method='bounded',
+                              options={'xatol': 1e-10})
+        log_params = np.atleast_1d(opt.x)
+    else:
+        initial = initial or {}
+        start = []
+        for (name, _, _, value), (lower, upper) in zip(model.params, bounds):
+            if name in initial:
+                value = np.clip(np.log10(initial[name]), lower, upper)
+            elif value is not None:
+                value = _value(value, N)
+            else:
+                value = 0.5*(lower + upper)
+            start.append(value)
+        opt = minimize(rss, start, method='L-BFGS-B', bounds=bounds)
+        log_params = opt.x
+    return dict(zip(names, 10.0**log_params)), max(float(rss(log_params)), 0.0)
+
+
+def compare_models(occurr_freqs, n_reads, beta_fit=None, models=None):
+    '''Fits competing occupancy models to the same occurrence frequencies
+
+    All models are fitted from the one set of occurrence_statistics(), so
+    a model costs a few vectorized evaluations and nothing is re-read or
+    re-rarefied. AIC and BIC are computed as for the neutral fit (and as
+    lmfit does): n log(RSS/n) + 2k and n log(RSS/n) + log(n) k.
+
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+        Needs mean_abundance and occurrence columns.
+    n_reads: int
+        Rarefaction depth.
+    beta_fit: NeutralFit or lmfit.model.ModelResult, optional
+        Existing fit of the neutral model (fit_neutral_model()); used for
+        'neutral' instead of fitting it again.
+    models: list of str, optional
+        Names in MODELS. Default is all of them.
+
+    Returns
+    -------
+    comparison: pandas df
+        Indexed by model: n_params, the fitted parameters, rss, r_square,
+        aic, bic and delta_aic (to the lowest AIC), sorted by AIC.
+    '''
+    statistics = occurrence_statistics(occurr_freqs)
+    n = float(len(occurr_freqs))
+    total_sum_of_squares = statistics[4]
+    rows, fitted = {}, {}
+    for name in (models if models is not None else list(MODELS)):
+        model = MODELS[name]
+        if name == 'neutral' and beta_fit is not None:
+            params = {'m': beta_fit.best_values['m']}
+            residual = np.asarray(occurr_freqs['occurrence'], dtype=float) - \
+                       np.asarray(beta_fit.best_fit, dtype=float)
+            rss = float(np.sum(residual**2))
+        else:
+            #Parameters shared with an earlier model (e.g. m) start from 
+            #its optimum
+            params, rss = fit_model(model, statistics, n_reads, fitted)
+        fitted.update(params)
+        k = len(model.params)
+        neg2_log_likel = n*np.log(max(rss, 1e-300)/n)
+        row = {'n_params': k}
+        row.update(params)
+        row.update({'rss': rss, 'r_square': 1.0 - rss/total_sum_of_squares,
+                    'aic': neg2_log_likel + 2*k, 'bic': neg2_log_likel + np.log(n)*k})
+        rows[name] = row
+    comparison = pd.DataFrame.from_dict(rows, orient='index')
+    comparison.index.name = 'model'
+    statistic_columns = ['rss', 'r_square', 'aic', 'bic']
+    param_columns = [column for column in comparison.columns
+                     if column not in statistic_columns + ['n_params']]
+    comparison = comparison[['n_params'] + param_columns + statistic_columns]
+    comparison['delta_aic'] = comparison['aic'] - comparison['aic'].min()
+    return comparison.sort_values('aic')
+
+
+def comparison_report(comparison):
+    '''Model comparison table as written to the .txt report'''
+    return '\n Model comparison (lowest AIC first):\n' + \
+           comparison.to_string(float_format=lambda x: '{:.6g}'.format(x)) + '\n'
+
+
+def comparison_attrs(comparison):
+    '''compare_models() as a json serialisable dict (model -> fitted
+        parameters and statistics), kept in occurr_freqs.attrs'''
+    return {model: {name: value.item() if hasattr(value, 'item') else value
+                    for name, value in row.items() if pd.notna(value)}
+            for model, row in comparison.to_dict(orient='index').items()}
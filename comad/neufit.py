@@ -1,17 +1,36 @@
+import io
+import re
 import os
 import scipy
+import scipy.sparse
 import numpy as np
 import pandas as pd
 from datetime import datetime
-from lmfit import Parameters, Model, fit_report 
-from scipy.stats import beta 
-from statsmodels.stats.proportion import proportion_confint 
-from comad.neufit_utils import beta_cdf, subsample, non_negative_int
-from comad.utils import biom2data_tax, tsv2data_tax, non_neutral_outliers
-from comad.plotting import neufit_plot
+from comad.neufit_utils import (non_negative_int, rarefy,
+                                row_sums, col_sums, count_nonzero,
+                                rarefaction_depth, occurrence_frequencies,
+                                fit_neutral_model, neutral_confint,
+                                sample_seeds, bootstrap_m, compact_occurrences)
+from comad.parallel import SharedArrays, map_shared, split_columns, resolve_jobs
+from comad.utils import (biom2data_tax, tsv2data_tax, non_neutral_outliers,
+                         load_abundances, table_counts, load_sample_metadata,
+                         load_lineages)
+from comad.cache import (ResultCache, result_key, restore_outputs, selection_key,
+                         OUTPUT_SUFFIXES)
+from comad.profiling import Profiler, stage
+from comad.models import compare_models, comparison_report, comparison_attrs
+from comad.columnar import is_columnar, load_columnar_taxonomy
+from comad.streaming import CHUNKSIZE, scan_tsv, stream_occurrence_frequencies
+from comad.taxonomy import (OTU_RANK, RANKS, parse_ranks, lineage_table,
+                            encode_lineages, aggregation_matrix, rank_taxonomy)
 
 def comad_pipeline(input_filename, output_filename, output_filepath, arg_rarefaction_level = 0,
-                   neufit_plot_bool = True, arg_ignore_level = 0, HP_Color = True):
+                   neufit_plot_bool = True, arg_ignore_level = 0, HP_Color = True,
+                   sparse = False, save_data_tax = False, seed = None, jobs = 1,
+                   rarefaction_iterations = 1, bootstrap = 0, cache = True,
+                   profile = False, show_plot = None, chunksize = None,
+                   samples = None, metadata = None, where = None,
+                   group_by = None, results_format = None, ranks = None):
     
     '''Calls all functions needed to create neutral model 
     
@@ -20,7 +39,8 @@ def comad_pipeline(input_filename, output_filename, output_filepath, arg_rarefac
     Parameters
     ----------
     biom_filename: str
-        Path of biom file
+        Path of biom file; also a .tsv file or a .comad folder written by 
+        comad.columnar.convert_table() (memory-mapped, with its taxonomy).
     output_filename: str
         Name/nickname of dataset (ex. 'combined'). Will be incorperated into 
         filename of all comad outputs.  
@@ -31,9 +51,102 @@ def comad_pipeline(input_filename, output_filename, output_filepath, arg_rarefac
         this value to the highest possible uniform read depth.
     neufit_plot: bool, optional
         Determines if Neufit plot is created/saved. Default is True.
+    show_plot: bool, optional
+        Displays the plot; by default only in IPython/Jupyter sessions, 
+        see plotting.neufit_plot().
     arg_ignore_level: int, optional
         Ignores OTUs below this abudance threshold; default is to use all 
         OTUs regardless of abudance threshold. Value must be non-negative.
+    sparse: bool, optional
+        Only used for biom inputs. If True the biom table is kept as a 
+        scipy.sparse matrix for the whole fit instead of being converted 
+        into a dense table; peak memory then scales with the number of 
+        non-zero entries. Default is False.
+    save_data_tax: bool, optional
+        If True the input is first converted into data_tax_csv/[]_data.csv 
+        (as in earlier versions) and the fit reads that file back. By 
+        default the table is fitted in memory and no intermediate files are 
+        written.
+    seed: int, optional
+        Seed of the rarefaction draws. Default uses fresh OS entropy.
+    jobs: int, optional
+        Number of worker processes used for rarefaction; 0 uses all CPUs. 
+        Results for a given seed do not depend on jobs. Default is 1.
+    rarefaction_iterations: int, optional
+        If larger than 1, the table is loaded once and fitted to this many 
+        independent rarefactions with neufit_ensemble(), which reports the 
+        mean/95% interval of m and R^2 and per OTU non-neutral call 
+        frequencies instead of the single-fit outputs and plot. Default is 1.
+    bootstrap: int, optional
+        Number of bootstrap resamples of the samples used for a percentile 
+        confidence interval of m, see neufit(). Default is 0 (none).
+    cache: bool or ResultCache, optional
+        Seeded runs are looked up in a result cache keyed by the contents 
+        of input_filename, the arguments above and the comad version; a 
+        hit restores the report, tables and plot under a new file header 
+        without refitting. True uses ResultCache() (default folder 
+        ~/.cache/comad, see comad.cache), False disables the cache. 
+        Unseeded runs and save_data_tax runs are never cached. Default 
+        is True.
+    profile: bool or Profiler, optional
+        If True (or a comad.profiling.Profiler, e.g. one with hooks that 
+        forward stage records to a metrics system), wall time, CPU time, 
+        peak memory and table shapes of every stage (parsing, rarefaction, 
+        fit, confidence interval, outliers, plot, ...) are written to 
+        [file_header]_profile.json next to the .txt report. Default is 
+        False.
+    chunksize: int, optional
+        Only for .tsv inputs (other inputs raise ValueError). If given, the 
+        table is streamed from disk in chunks of this many OTU rows with 
+        neufit_stream() instead of being loaded into memory, for tables 
+        larger than RAM. Cannot be combined with rarefaction_iterations, 
+        bootstrap, jobs or save_data_tax, see check_chunksize(). Default 
+        is None (load the whole table).
+    samples: list, str or path, optional
+        Only fit these samples: a list of sample ids, a comma separated 
+        string or a file with one id per line. HDF5 biom files are read 
+        selectively (see utils.read_biom_subset()), skipping the other 
+        samples and the OTUs at or below arg_ignore_level in the selected 
+        ones.
+    metadata: str, path, optional
+        Sample metadata tsv (first column sample ids) used by where. 
+        Default for biom inputs is the sample metadata in the biom file.
+    where: dict, str or list of str, optional
+        Only fit samples whose metadata matches, e.g. 'body_site=gut' or 
+        {'body_site': ['gut', 'stool']}, see utils.parse_where().
+    group_by: str, optional
+        Sample metadata column (from metadata or the biom file). If given, 
+        the table is loaded once and every group of samples, plus all of 
+        them combined, is fitted with neufit_groups(); the groups are 
+        compared in [].txt/[]_groups.tsv and in one faceted plot 
+        []_groups.pdf. Cannot be combined with rarefaction_iterations, 
+        chunksize or save_data_tax.
+    results_format: str, optional
+        'parquet' or 'feather': also write occurr_freqs, the non-neutral 
+        flags and the fit statistics (m, R^2, N, n_samples) to one 
+        compressed [file_header]_results.parquet/.feather file (needs 
+        pyarrow), on a background thread while the plot is drawn; see 
+        comad.results. Not available with rarefaction_iterations or 
+        group_by. Default is None.
+    ranks: str or list of str, optional
+        Taxonomic ranks, e.g. 'genus,family,phylum' (see 
+        taxonomy.parse_ranks()). If given, the table is loaded and 
+        rarefied once, summed into the taxa of every rank and every rank 
+        is fitted with neufit_ranks(); lineages come from the taxonomy of 
+        a .comad folder, the biom observation taxonomy or lineage OTU ids 
+        (see utils.load_lineages()). Every rank's outputs and plot are 
+        written under [file_header]_[rank], the comparison of the ranks to 
+        [].txt and []_ranks.tsv. Cannot be combined with group_by, 
+        rarefaction_iterations, chunksize, save_data_tax or 
+        results_format.
+    
+    Returns
+    -------
+    The return value of neufit() (occurr_freqs, n_reads, n_samples, 
+    r_square, beta_fit), or of neufit_ensemble() if rarefaction_iterations 
+    is larger than 1, or of neufit_groups() with group_by, or of 
+    neufit_ranks() with ranks; None for 
+    unsupported file formats.
     
     TODO
     ----
@@ -56,40 +169,932 @@ def comad_pipeline(input_filename, output_filename, output_filepath, arg_rarefac
     output_folder_path =  output_filepath + '/' + output_filename 
     os.makedirs(output_folder_path, exist_ok=True)
     
-    #Grab and format data/time
-    time = datetime.time(datetime.now())
-    date = datetime.date(datetime.now())
-    h,s = str(time).split(".") #Split string into hours/min and sec
-    
     #Create file_header which holds the path for all future comad outpus
-    file_header = str(output_folder_path) +  \
-                  '/' + str(output_filename) + '_' + \
-                  str(date) + "_" + str(h)
-    
-    if input_filename.split('.')[1] == 'tsv':
-        #Convert data from tsv to csv files for Neufit
-        fnData, fnTaxonomy = tsv2data_tax(input_filename, output_filename, output_folder_path)
-    elif input_filename.split('.')[1] == 'biom':
-        #Convert data from biom to csv files for Neufit
-        fnData, fnTaxonomy = biom2data_tax(input_filename, output_filename, output_folder_path)
+    file_header = make_file_header(output_folder_path, output_filename)
+    
+    #Optionally time every stage of the run
+    if profile == False:
+        return _comad_pipeline(input_filename, output_filename, output_folder_path,
+                               file_header, arg_rarefaction_level, neufit_plot_bool,
+                               arg_ignore_level, HP_Color, sparse, save_data_tax,
+                               seed, jobs, rarefaction_iterations, bootstrap, cache,
+                               show_plot, chunksize, samples, metadata, where,
+                               group_by, results_format, ranks)
+    profiler = profile if isinstance(profile, Profiler) else Profiler()
+    try:
+        with profiler:
+            return _comad_pipeline(input_filename, output_filename, output_folder_path,
+                                   file_header, arg_rarefaction_level, neufit_plot_bool,
+                                   arg_ignore_level, HP_Color, sparse, save_data_tax,
+                                   seed, jobs, rarefaction_iterations, bootstrap, cache,
+                                   show_plot, chunksize, samples, metadata, where,
+                                   group_by, results_format, ranks)
+    finally:
+        profiler.write(file_header + '_profile.json')
+
+
+def _comad_pipeline(input_filename, output_filename, output_folder_path, 
+                    file_header, arg_rarefaction_level, neufit_plot_bool, 
+                    arg_ignore_level, HP_Color, sparse, save_data_tax, seed, 
+                    jobs, rarefaction_iterations, bootstrap, cache, show_plot,
+                    chunksize=None, samples=None, metadata=None, where=None,
+                    group_by=None, results_format=None, ranks=None):
+    '''Body of comad_pipeline() once the output folder and file header 
+        exist'''
+
+    streaming = chunksize is not None
+    if streaming:
+        if os.path.splitext(input_filename)[1] != '.tsv' or is_columnar(input_filename):
+            raise ValueError('chunksize needs a .tsv input, not ' + str(input_filename))
+        check_chunksize(rarefaction_iterations, bootstrap, jobs, save_data_tax)
+    selection = {'samples': samples, 'metadata': metadata, 'where': where}
+    if (samples is not None or where is not None) and (streaming or save_data_tax == True):
+        raise ValueError('samples and where cannot be combined with '
+                         'chunksize or save_data_tax')
+    if group_by is not None and (streaming or save_data_tax == True or
+                                 rarefaction_iterations > 1):
+        raise ValueError('group_by cannot be combined with chunksize, '
+                         'save_data_tax or rarefaction_iterations')
+    if results_format is not None and (group_by is not None or
+                                       rarefaction_iterations > 1):
+        raise ValueError('results_format cannot be combined with group_by '
+                         'or rarefaction_iterations')
+    if ranks is not None and (streaming or save_data_tax == True or
+                              rarefaction_iterations > 1 or group_by is not None or
+                              results_format is not None):
+        raise ValueError('ranks cannot be combined with chunksize, save_data_tax, '
+                         'rarefaction_iterations, group_by or results_format')
+
+    #Serve repeated seeded runs from the result cache
+    cache_key = None
+    if cache is not False and seed is not None and save_data_tax == False:
+        if cache is True:
+            cache = ResultCache()
+        cache_key = result_key(input_filename,
+                               arg_rarefaction_level=arg_rarefaction_level,
+                               arg_ignore_level=arg_ignore_level, seed=seed,
+                               rarefaction_iterations=rarefaction_iterations,
+                               bootstrap=bootstrap,
+                               neufit_plot_bool=neufit_plot_bool,
+                               HP_Color=HP_Color,
+                               chunksize=chunksize,
+                               group_by=group_by,
+                               results_format=results_format,
+                               ranks=None if ranks is None else parse_ranks(ranks),
+                               **selection_key(samples, metadata, where))
+        with stage('cache_lookup') as record:
+            entry = cache.get(cache_key)
+            record['hit'] = entry is not None
+        if entry is not None:
+            print('Using cached results for dataset:' + str(output_filename) + '\n')
+            restore_outputs(entry, file_header)
+            return entry['results']
+    
+    #Converted (.comad) tables can carry their taxonomy
+    taxonomy = load_columnar_taxonomy(input_filename) if is_columnar(input_filename) else None
+    
+    if group_by is not None:
+        #Load data once and fit every group of samples
+        table = load_abundances(input_filename, sparse, arg_ignore_level=arg_ignore_level,
+                                **selection)
+        if table is None:
+            print('Invlaid file format')
+            return
+        sample_metadata = load_sample_metadata(input_filename, metadata)
+        if group_by not in sample_metadata.columns:
+            raise ValueError('No metadata column ' + str(group_by))
+        with stage('groups', group_by=group_by, jobs=jobs):
+            results = neufit_groups(table, sample_metadata[group_by], taxonomy,
+                                    arg_rarefaction_level, arg_ignore_level,
+                                    output_filename, file_header, seed, jobs)
+        if neufit_plot_bool == True:
+            from comad.plotting import neufit_group_plot
+            neufit_group_plot(results[1], file_header, HP_Color, show_plot)
+        if cache_key is not None:
+            suffixes = OUTPUT_SUFFIXES + ['_groups.tsv', '_groups.pdf'] + \
+                       [group_file_header('', group) + suffix 
+                        for group in results[1] for suffix in OUTPUT_SUFFIXES]
+            with stage('cache_store'):
+                cache.put(cache_key, results, file_header, suffixes)
+        return results
+    
+    if ranks is not None:
+        #Load data once, rarefy once and fit every rank
+        table = load_abundances(input_filename, sparse, arg_ignore_level=arg_ignore_level,
+                                **selection)
+        if table is None:
+            print('Invlaid file format')
+            return
+        otu_ids = table.index if isinstance(table, pd.DataFrame) else table[1]
+        with stage('lineages'):
+            lineages = load_lineages(input_filename, otu_ids, taxonomy)
+        with stage('ranks', ranks=ranks, jobs=jobs):
+            results = neufit_ranks(table, ranks, lineages, taxonomy,
+                                   arg_rarefaction_level, arg_ignore_level,
+                                   output_filename, file_header, seed, jobs)
+        if neufit_plot_bool == True:
+            from comad.plotting import neufit_plot
+            for rank, (occurr_freqs, n_reads, n_samples, r_square,
+                       beta_fit) in results[1].items():
+                neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square,
+                            group_file_header(file_header, rank), HP_Color, show_plot)
+        if cache_key is not None:
+            suffixes = OUTPUT_SUFFIXES + ['_ranks.tsv'] + \
+                       [group_file_header('', rank) + suffix 
+                        for rank in results[1] for suffix in OUTPUT_SUFFIXES]
+            with stage('cache_store'):
+                cache.put(cache_key, results, file_header, suffixes)
+        return results
+    
+    if rarefaction_iterations > 1:
+        #Load data once and fit many rarefactions of it
+        table = load_abundances(input_filename, sparse, arg_ignore_level=arg_ignore_level,
+                                **selection)
+        if table is None:
+            print('Invlaid file format')
+            return
+        with stage('ensemble', iterations=rarefaction_iterations):
+            results = neufit_ensemble(table, rarefaction_iterations, taxonomy,
+                                      arg_rarefaction_level, arg_ignore_level,
+                                      output_filename, file_header, seed, jobs)
+        if cache_key is not None:
+            with stage('cache_store'):
+                cache.put(cache_key, results, file_header)
+        return results
+    
+    if save_data_tax == True:
+        if input_filename.split('.')[1] == 'tsv':
+            #Convert data from tsv to csv files for Neufit
+            fnData, fnTaxonomy = tsv2data_tax(input_filename, output_filename, output_folder_path)
+        elif input_filename.split('.')[1] == 'biom':
+            #Convert data from biom to csv files for Neufit
+            fnData, fnTaxonomy = biom2data_tax(input_filename, output_filename, output_folder_path)
+        else:
+            print('Invlaid file format')
+            return
+        
+        #Run Neufit
+        occurr_freqs, n_reads, n_samples, r_square, beta_fit = neufit(output_filename, 
+                                                                      file_header,
+                                                                      fnData, fnTaxonomy,
+                                                                     arg_rarefaction_level,
+                                                                     arg_ignore_level,
+                                                                     seed, jobs,
+                                                                     bootstrap)
+    elif streaming:
+        #Stream the table from disk, never holding it in memory
+        occurr_freqs, n_reads, n_samples, r_square, beta_fit = neufit_stream(input_filename, None,
+                                                                             arg_rarefaction_level,
+                                                                             arg_ignore_level,
+                                                                             output_filename,
+                                                                             file_header,
+                                                                             seed, chunksize)
     else:
-        print('Invlaid file format')
-        return
-    
-    #Run Neufit
-    occurr_freqs, n_reads, n_samples, r_square, beta_fit = neufit(output_filename, 
-                                                                  file_header,
-                                                                  fnData, fnTaxonomy,
-                                                                 arg_rarefaction_level,
-                                                                 arg_ignore_level)
+        #Load data straight into memory, no intermediate files
+        table = load_abundances(input_filename, sparse, arg_ignore_level=arg_ignore_level,
+                                **selection)
+        if table is None:
+            print('Invlaid file format')
+            return
+        
+        #Run Neufit
+        occurr_freqs, n_reads, n_samples, r_square, beta_fit = neufit_table(table, taxonomy,
+                                                                            arg_rarefaction_level,
+                                                                            arg_ignore_level,
+                                                                            output_filename,
+                                                                            file_header,
+                                                                            seed, jobs,
+                                                                            bootstrap)
+    #Write the columnar results while the plot is drawn
+    if results_format is not None:
+        from comad.results import write_results_async
+        writer = write_results_async(file_header, occurr_freqs, beta_fit, n_reads,
+                                     n_samples, r_square, results_format)
+    
     #Create Neufit Plot
     if neufit_plot_bool == True:
-        neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square, file_header, HP_Color)
+        from comad.plotting import neufit_plot
+        neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square, file_header, HP_Color,
+                    show_plot)
+    
+    if results_format is not None:
+        with stage('write_results', format=results_format) as record:
+            record['filename'], record['writer_wall_s'] = writer.result()
+    
+    results = (occurr_freqs, n_reads, n_samples, r_square, beta_fit)
+    if cache_key is not None:
+        with stage('cache_store'):
+            cache.put(cache_key, results, file_header)
+    return results
         
 
 
+def check_chunksize(rarefaction_iterations=1, bootstrap=0, jobs=1,
+                    save_data_tax=False):
+    '''Raises ValueError for options that neufit_stream() (chunksize) 
+        does not support'''
+    if rarefaction_iterations > 1 or bootstrap > 0 or jobs != 1 or \
+       save_data_tax == True:
+        raise ValueError('chunksize cannot be combined with '
+                         'rarefaction_iterations, bootstrap, jobs or '
+                         'save_data_tax')
+
+
+def make_file_header(output_folder_path, output_filename):
+    '''Path prefix (folder, dataset nickname and time stamp) shared by 
+        all comad outputs of one run
+    
+    The time stamp has a resolution of one second, so the header is 
+    reserved by atomically creating its .txt report; if another run (e.g. 
+    a parallel batch job) already holds it, _1, _2, ... is appended 
+    instead of overwriting that run's outputs.
+    '''
+    #Grab and format data/time
+    now = datetime.now()
+    header = str(output_folder_path) +  \
+             '/' + str(output_filename) + '_' + \
+             now.strftime('%Y-%m-%d_%H:%M:%S')
+    
+    file_header, suffix = header, 0
+    while True:
+        try:
+            os.close(os.open(file_header + '.txt', 
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return file_header
+        except FileExistsError:
+            suffix += 1
+            file_header = header + '_' + str(suffix)
+
+
+def neufit_table(table, taxonomy=None, arg_rarefaction_level=0, 
+                 arg_ignore_level=0, output_filename=None, file_header=None,
+                 seed=None, jobs=1, bootstrap=0):
+    '''Fits a neutral community model to an in-memory abundance table
+    
+    Same fit as neufit(), but the table is passed directly instead of 
+    being written to and re-parsed from a _data.csv file. 
+    
+    Parameters
+    ----------
+    table: pandas df, numpy array, biom.Table or scipy.sparse matrix
+        OTU abundance table with OTUs as rows and samples as columns. 
+        biom Tables and scipy.sparse matrices are never densified. A 
+        (counts, otu_ids, sample_ids) tuple, as returned by biom2sparse(), 
+        is also accepted.
+    taxonomy: pandas df or str, path, optional
+        Taxonomic information indexed by otu_id, or the path to a 
+        []_taxonomy.csv file. Default is no taxonomy.
+    arg_rarefaction_level: int, optional
+        Sets the rarefaction level. Leaving the default of 0 changes 
+        this value to the highest possible uniform read depth. 
+    arg_ignore_level: int, optional
+        Ignores OTUs below this abudance threshold; default is to use all 
+        OTUs regardless of abudance threshold. Value must be non-negative.
+    output_filename: str, optional
+        Name/nickname of dataset (ex. 'combined'), only used in messages.
+    file_header: str, optional
+        Path prefix of all output files. If given, the .txt report, 
+        _FullNonNeutral.csv and _NonNeutral_Outliers.csv are written as 
+        in neufit(); by default nothing is written to disk.
+    seed: int or numpy.random.Generator, optional
+        Seed of the rarefaction draws. Default uses fresh OS entropy.
+    jobs: int, optional
+        Number of worker processes used for rarefaction; 0 uses all CPUs. 
+        Results for a given seed do not depend on jobs. Default is 1.
+    bootstrap: int, optional
+        Number of bootstrap resamples of the samples (columns). If 
+        positive, m is refitted to every resample and the 95% percentile 
+        interval is added to the report and to occurr_freqs.attrs 
+        ('m_ci_lower', 'm_ci_upper', 'm_bootstrap_std', 'bootstrap'). 
+        Default is 0 (none).
+    
+    Returns
+    -------
+    Same as neufit(): occurr_freqs, n_reads, n_samples, r_square, beta_fit
+    '''
+    
+    #Check that rarefaction and ignore levels are positive
+    non_negative_int(arg_rarefaction_level)
+    non_negative_int(arg_ignore_level)
+    
+    if file_header is not None:
+        file = open(str(file_header) + ".txt", 'w')
+    else:
+        file = io.StringIO()
+    
+    if output_filename is not None:
+        print("Running dataset:" + str(output_filename) + '\n')
+    
+    with stage('table_counts'):
+        abundances, otu_ids, sample_ids = table_counts(table)
+    file.write('Corresponding table: ' + str(abundances.shape[0]) + \
+               ' otus x ' + str(abundances.shape[1]) + ' samples \n')
+    
+    if isinstance(taxonomy, str):
+        taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+    
+    return _neufit(file, abundances, otu_ids, sample_ids, taxonomy,
+                   arg_rarefaction_level, arg_ignore_level, file_header, seed,
+                   jobs, bootstrap)
+
+
+def neufit_stream(tsv_filename, taxonomy=None, arg_rarefaction_level=0,
+                  arg_ignore_level=0, output_filename=None, file_header=None,
+                  seed=None, chunksize=CHUNKSIZE):
+    '''Fits a neutral community model to a tsv table too large for memory
+
+    The table is read twice in chunks of chunksize OTU rows (see
+    comad.streaming): once for the reads per sample and once to rarefy
+    and accumulate the per OTU read sums and occurrences, which is all
+    the fit needs. Memory is bounded by the chunk size plus a few numbers
+    per OTU. Results are reproducible for a given seed and chunksize, but
+    the draws differ from neufit_table() with the same seed.
+
+    Parameters
+    ----------
+    tsv_filename: str, path
+        Tab separated table with OTUs as rows and samples as columns, e.g. 
+        a []_data.csv file.
+    taxonomy, arg_rarefaction_level, arg_ignore_level, output_filename, 
+    file_header, seed: optional
+        As in neufit_table().
+    chunksize: int, optional
+        OTU rows held in memory at a time. Default is 10000.
+
+    Returns
+    -------
+    Same as neufit(): occurr_freqs, n_reads, n_samples, r_square, beta_fit
+    '''
+
+    #Check that rarefaction and ignore levels are positive
+    non_negative_int(arg_rarefaction_level)
+    non_negative_int(arg_ignore_level)
+
+    if file_header is not None:
+        file = open(str(file_header) + ".txt", 'w')
+    else:
+        file = io.StringIO()
+
+    if output_filename is not None:
+        print("Running dataset:" + str(output_filename) + '\n')
+
+    if isinstance(taxonomy, str):
+        taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+
+    with stage('scan', filename=tsv_filename, chunksize=chunksize) as record:
+        sample_ids, sample_reads, n_otus = scan_tsv(tsv_filename,
+                                                    arg_ignore_level, chunksize)
+        record['shape'] = [n_otus, len(sample_ids)]
+    file.write('Corresponding tsv file: ' + str(tsv_filename) + ', streamed in ' + \
+               'chunks of ' + str(chunksize) + ' otus \n')
+    n_reads = _report_depth(file, sample_ids, sample_reads, arg_rarefaction_level)
+
+    with stage('stream_rarefy', depth=n_reads, chunksize=chunksize):
+        occurr_freqs, keep = stream_occurrence_frequencies(tsv_filename,
+                                                           sample_reads, n_reads,
+                                                           sample_ids,
+                                                           arg_ignore_level,
+                                                           seed, chunksize)
+    n_samples = int(keep.sum())
+
+    file.write ('fitting neutral expectation to dataset with ' + \
+                str(n_samples) + ' samples and ' + str(len(occurr_freqs)) + \
+                ' otus \n \n')
+
+    return _fit_occurrences(file, occurr_freqs, taxonomy, n_reads, n_samples,
+                            file_header)
+
+
+def neufit_ensemble(table, rarefaction_iterations, taxonomy=None, 
+                    arg_rarefaction_level=0, arg_ignore_level=0, 
+                    output_filename=None, file_header=None, seed=None, 
+                    jobs=1):
+    '''Fits the neutral model to many independent rarefactions of one 
+        table
+    
+    The table is loaded and filtered once; each iteration only rarefies 
+    and refits, and iterations run in parallel on a process pool that 
+    reads the counts from shared memory. 
+    
+    Parameters
+    ----------
+    table: pandas df, numpy array, biom.Table, scipy.sparse matrix or tuple
+        OTU abundance table, as accepted by neufit_table().
+    rarefaction_iterations: int
+        Number of rarefactions (and fits).
+    taxonomy: pandas df or str, path, optional
+        Taxonomic information indexed by otu_id, joined to the OTU summary.
+    arg_rarefaction_level: int, optional
+        Sets the rarefaction level. Leaving the default of 0 changes 
+        this value to the highest possible uniform read depth. 
+    arg_ignore_level: int, optional
+        Ignores OTUs below this abudance threshold; default is to use all 
+        OTUs regardless of abudance threshold. Value must be non-negative.
+    output_filename: str, optional
+        Name/nickname of dataset (ex. 'combined'), only used in messages.
+    file_header: str, optional
+        Path prefix of all output files. If given, writes the summary 
+        report to [].txt plus []_ensemble_otus.tsv and 
+        []_ensemble_iterations.tsv.
+    seed: int, optional
+        Seed of the rarefaction draws. Iteration k always uses the k-th 
+        child seed, whatever the number of jobs.
+    jobs: int, optional
+        Number of worker processes; 0 uses all CPUs. Default is 1.
+    
+    Returns
+    -------
+    summary: pandas df
+        Mean, standard deviation and 95% percentile interval of m and R^2 
+        across iterations.
+    otu_summary: pandas df
+        Per OTU: mean_abundance and occurrence averaged over iterations, 
+        the fraction of iterations in which the OTU lies above/below the 
+        neutral confidence interval (frac_above, frac_below) and their sum 
+        (non_neutral_frequency).
+    iterations: pandas df
+        m, m_stderr, r_square and n_otus of every iteration.
+    '''
+    
+    #Check that rarefaction and ignore levels are positive
+    non_negative_int(arg_rarefaction_level)
+    non_negative_int(arg_ignore_level)
+    non_negative_int(rarefaction_iterations)
+    jobs = resolve_jobs(jobs)
+    
+    if output_filename is not None:
+        print("Running dataset:" + str(output_filename) + '\n')
+    
+    abundances, otu_ids, sample_ids = table_counts(table)
+    keep = row_sums(abundances) > arg_ignore_level
+    abundances, otu_ids = abundances[keep], otu_ids[keep]
+    
+    # Drop under-depth samples once instead of in every iteration
+    sample_reads = col_sums(abundances)
+    n_reads, highest = rarefaction_depth(sample_reads, arg_rarefaction_level)
+    keep = sample_reads >= n_reads
+    for sample, reads in zip(sample_ids[~keep], sample_reads[~keep]):
+        print('dropping sample ' + str(sample) + ' with ' + str(reads) + ' reads < ' + str(n_reads))
+    abundances = abundances[:, keep]
+    n_otus, n_samples = abundances.shape
+    
+    if scipy.sparse.issparse(abundances):
+        abundances = scipy.sparse.csc_matrix(abundances)
+        arrays = (abundances.data, abundances.indices, abundances.indptr)
+    else:
+        arrays = (np.ascontiguousarray(abundances), np.empty(0, dtype=np.int64),
+                  np.empty(0, dtype=np.int64))
+    
+    entropy = sample_seeds(seed)
+    if jobs > 1 and rarefaction_iterations > 1:
+        with SharedArrays() as shared:
+            for array in arrays:
+                shared.copy(array)
+            chunks = split_columns(rarefaction_iterations, jobs)
+            results = map_shared(_ensemble_chunk, shared, chunks, jobs, 
+                                 abundances.shape, n_reads, entropy)
+        results = [result for chunk in results for result in chunk]
+    else:
+        results = _ensemble_chunk(*arrays, range(rarefaction_iterations), 
+                                  abundances.shape, n_reads, entropy)
+    
+    # Aggregate fit statistics
+    iterations = pd.DataFrame([result[:4] for result in results], 
+                              columns=['m', 'm_stderr', 'r_square', 'n_otus'])
+    iterations.index.name = 'iteration'
+    summary = pd.DataFrame({'mean': iterations[['m', 'r_square']].mean(),
+                            'std': iterations[['m', 'r_square']].std(),
+                            'ci_lower': iterations[['m', 'r_square']].quantile(0.025),
+                            'ci_upper': iterations[['m', 'r_square']].quantile(0.975)})
+    
+    # Aggregate per OTU non-neutral calls
+    otu_summary = pd.DataFrame({
+        'mean_abundance': np.mean([result[4] for result in results], axis=0, 
+                                  dtype=np.float64),
+        'occurrence': np.mean([result[5] for result in results], axis=0, 
+                              dtype=np.float64),
+        'frac_above': np.mean([result[6] for result in results], axis=0),
+        'frac_below': np.mean([result[7] for result in results], axis=0)},
+        index=otu_ids)
+    otu_summary.index.name = 'otu_id'
+    summary.attrs.update({'n_reads': n_reads, 'n_samples': n_samples,
+                          'n_otus': n_otus})
+    otu_summary['non_neutral_frequency'] = otu_summary['frac_above'] + \
+                                           otu_summary['frac_below']
+    otu_summary = otu_summary.sort_values(by=['mean_abundance'])
+    
+    if isinstance(taxonomy, str):
+        taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+    if taxonomy is not None:
+        otu_summary.index = otu_summary.index.astype(str)
+        taxonomy = taxonomy.copy()
+        taxonomy.index = taxonomy.index.astype(str)
+        otu_summary = otu_summary.join(taxonomy)
+    
+    report = ('Rarefaction ensemble of ' + str(rarefaction_iterations) + \
+              ' iterations at ' + str(n_reads) + ' reads per sample ' + \
+              ('(highest possible uniform read depth) \n' if highest else \
+               '(custom rarefaction level) \n') + \
+              'Dataset contains ' + str(n_samples) + ' samples and ' + \
+              str(n_otus) + ' otus \n \n')
+    for stat in summary.index:
+        report += (stat + ' = ' + '{:1.4f}'.format(summary.loc[stat, 'mean']) + \
+                   ' +/- ' + '{:1.4f}'.format(summary.loc[stat, 'std']) + \
+                   ' (95% interval ' + '{:1.4f}'.format(summary.loc[stat, 'ci_lower']) + \
+                   ' - ' + '{:1.4f}'.format(summary.loc[stat, 'ci_upper']) + ')\n')
+    print(report)
+    print('=========================================================')
+    
+    if file_header is not None:
+        with open(str(file_header) + '.txt', 'w') as file:
+            file.write(report)
+        otu_summary.to_csv(str(file_header) + '_ensemble_otus.tsv', sep='\t')
+        iterations.to_csv(str(file_header) + '_ensemble_iterations.tsv', sep='\t')
+    
+    return(summary, otu_summary, iterations)
+
+
+def _ensemble_chunk(data, indices, indptr, chunk, shape, n_reads, entropy):
+    '''Rarefies and fits the iterations in chunk (worker of 
+        neufit_ensemble())'''
+    if indptr.size == 0:
+        abundances = data
+    else:
+        abundances = scipy.sparse.csc_matrix((data, indices, indptr), shape=shape)
+    
+    results = []
+    for iteration in chunk:
+        rng = np.random.default_rng(np.random.SeedSequence(entropy, 
+                                                           spawn_key=(iteration,)))
+        rarefied, _ = rarefy(abundances, n_reads, seed=rng)
+        n_samples = rarefied.shape[1]
+        mean_abundance = (1.0*row_sums(rarefied))/n_reads/n_samples
+        occurrence = (1.0*count_nonzero(rarefied))/n_samples
+        present = mean_abundance > 0
+        
+        occurr_freqs = pd.DataFrame({'mean_abundance': mean_abundance[present],
+                                     'occurrence': occurrence[present]})
+        beta_fit, r_square = fit_neutral_model(occurr_freqs, n_reads)
+        lower, upper = neutral_confint(np.asarray(beta_fit.best_fit), n_samples)
+        
+        above, below = np.zeros_like(present), np.zeros_like(present)
+        above[present] = occurr_freqs['occurrence'].to_numpy() > upper
+        below[present] = occurr_freqs['occurrence'].to_numpy() < lower
+        results.append((beta_fit.params['m'].value, beta_fit.params['m'].stderr,
+                        r_square, int(present.sum()), 
+                        mean_abundance.astype(np.float32), 
+                        occurrence.astype(np.float32), above, below))
+    return results
+
+
+def group_file_header(file_header, group):
+    '''Path prefix of the outputs of one group of neufit_groups()'''
+    return str(file_header) + '_' + re.sub(r'[^\w.-]+', '_', str(group))
+
+
+def neufit_groups(table, groups, taxonomy=None, arg_rarefaction_level=0,
+                  arg_ignore_level=0, output_filename=None, file_header=None,
+                  seed=None, jobs=1, combined='combined'):
+    '''Fits the neutral model separately to groups of samples of one
+        table, plus all grouped samples combined
+
+    The table is loaded once and each group is a subset of its columns;
+    groups are fitted in parallel on a process pool that reads the counts
+    from shared memory instead of receiving a copy per group. Every group
+    is fitted exactly like neufit_table() on its columns (ignore level
+    applied within the group), rarefied to a common depth so m and R^2
+    can be compared.
+
+    Parameters
+    ----------
+    table: pandas df, numpy array, biom.Table, scipy.sparse matrix or tuple
+        OTU abundance table, as accepted by neufit_table().
+    groups: pandas Series or array-like
+        Group of every sample: a Series indexed by sample id (e.g. a
+        metadata column) or labels in the order of the table's columns.
+        Samples without a group (missing or NaN) are left out.
+    taxonomy: pandas df or str, path, optional
+        Taxonomic information indexed by otu_id.
+    arg_rarefaction_level: int, optional
+        Rarefaction level of all groups. Default (0) is the highest
+        uniform read depth of all grouped samples.
+    arg_ignore_level: int, optional
+        Ignores OTUs below this abudance threshold within each group.
+    output_filename: str, optional
+        Name/nickname of dataset (ex. 'combined'), only used in messages.
+    file_header: str, optional
+        Path prefix of all output files. If given, every group's outputs
+        are written as in neufit_table() under group_file_header(), and
+        the comparison of the groups to [].txt and []_groups.tsv.
+    seed: int, optional
+        Seed of the rarefaction draws. Group k always uses the k-th child
+        seed, whatever the number of jobs.
+    jobs: int, optional
+        Number of worker processes; 0 uses all CPUs. Default is 1.
+    combined: str or None, optional
+        Name of the extra group holding all grouped samples; None leaves
+        it out. Default is 'combined'.
+
+    Returns
+    -------
+    summary: pandas df
+        One row per group: n_samples, n_otus, n_reads, m, m_stderr,
+        m_ci_lower, m_ci_upper (normal approximation) and r_square.
+    group_results: dict
+        Group name -> neufit_table() return value.
+    '''
+
+    #Check that rarefaction and ignore levels are positive
+    non_negative_int(arg_rarefaction_level)
+    non_negative_int(arg_ignore_level)
+    jobs = resolve_jobs(jobs)
+
+    if output_filename is not None:
+        print("Running dataset:" + str(output_filename) + '\n')
+
+    abundances, otu_ids, sample_ids = table_counts(table)
+    if isinstance(groups, pd.Series):
+        groups = groups.copy()
+        groups.index = groups.index.astype(str)
+        groups = groups.reindex(np.asarray(sample_ids).astype(str))
+    groups = pd.Series(np.asarray(groups, dtype=object))
+    grouped = groups.notna().to_numpy()
+    if not grouped.all():
+        print('leaving out ' + str(int((~grouped).sum())) + ' samples without a group')
+    names = sorted(groups[grouped].astype(str).unique())
+    if combined is not None and combined in names:
+        raise ValueError('A group is named ' + str(combined) + ', pick another '
+                         'name for the combined group')
+    columns = [np.flatnonzero(grouped & (groups.astype(str) == name).to_numpy())
+               for name in names]
+    if combined is not None:
+        names.append(combined)
+        columns.append(np.flatnonzero(grouped))
+
+    # One rarefaction depth for all groups
+    arg_rarefaction_level, _ = rarefaction_depth(col_sums(abundances[:, grouped]),
+                                                 arg_rarefaction_level)
+
+    if scipy.sparse.issparse(abundances):
+        abundances = scipy.sparse.csc_matrix(abundances)
+        arrays = (abundances.data, abundances.indices, abundances.indptr)
+    else:
+        arrays = (np.ascontiguousarray(abundances), np.empty(0, dtype=np.int64),
+                  np.empty(0, dtype=np.int64))
+    if isinstance(taxonomy, str):
+        taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+    headers = [None if file_header is None else group_file_header(file_header, name)
+               for name in names]
+
+    entropy = sample_seeds(seed)
+    args = (abundances.shape, otu_ids, sample_ids, columns, headers, taxonomy,
+            arg_rarefaction_level, arg_ignore_level, entropy)
+    if jobs > 1 and len(names) > 1:
+        with SharedArrays() as shared:
+            for array in arrays:
+                shared.copy(array)
+            chunks = split_columns(len(names), jobs)
+            results = map_shared(_groups_chunk, shared, chunks, jobs, *args)
+        results = [result for chunk in results for result in chunk]
+    else:
+        results = _groups_chunk(*arrays, range(len(names)), *args)
+    group_results = dict(zip(names, results))
+
+    # Compare the groups
+    summary = pd.DataFrame(
+        [(n_samples, len(occurr_freqs), n_reads, beta_fit.params['m'].value,
+          beta_fit.params['m'].stderr, r_square)
+         for occurr_freqs, n_reads, n_samples, r_square, beta_fit in results],
+        columns=['n_samples', 'n_otus', 'n_reads', 'm', 'm_stderr', 'r_square'],
+        index=pd.Index(names, name='group'))
+    summary['m_stderr'] = summary['m_stderr'].astype(float)
+    summary.insert(5, 'm_ci_lower', summary['m'] - 1.96 * summary['m_stderr'])
+    summary.insert(6, 'm_ci_upper', summary['m'] + 1.96 * summary['m_stderr'])
+
+    report = ('Neutral fits of ' + str(len(names)) + ' sample groups at ' + \
+              str(arg_rarefaction_level) + ' reads per sample \n \n' + \
+              summary.to_string(float_format='{:1.4f}'.format) + '\n')
+    print(report)
+    print('=========================================================')
+
+    if file_header is not None:
+        with open(str(file_header) + '.txt', 'w') as file:
+            file.write(report)
+        summary.to_csv(str(file_header) + '_groups.tsv', sep='\t')
+
+    return(summary, group_results)
+
+
+def _groups_chunk(data, indices, indptr, chunk, shape, otu_ids, sample_ids,
+                  columns, headers, taxonomy, n_reads, arg_ignore_level,
+                  entropy):
+    '''Fits the groups in chunk (worker of neufit_groups())'''
+    if indptr.size == 0:
+        abundances = data
+    else:
+        abundances = scipy.sparse.csc_matrix((data, indices, indptr), shape=shape)
+
+    results = []
+    for group in chunk:
+        rng = np.random.default_rng(np.random.SeedSequence(entropy,
+                                                           spawn_key=(group,)))
+        group_table = (abundances[:, columns[group]], otu_ids,
+                       np.asarray(sample_ids)[columns[group]])
+        results.append(neufit_table(group_table, taxonomy, n_reads,
+                                    arg_ignore_level, None, headers[group],
+                                    rng))
+    return results
+
+
+def neufit_ranks(table, ranks, lineages=None, taxonomy=None,
+                 arg_rarefaction_level=0, arg_ignore_level=0,
+                 output_filename=None, file_header=None, seed=None, jobs=1):
+    '''Fits the neutral model at several taxonomic ranks of one table
+
+    The table is loaded, filtered and rarefied once. Lineages are parsed
+    once into integer codes per rank (taxonomy.encode_lineages()), and
+    the rarefied OTU counts are summed into the taxa of every rank with
+    one sparse (taxa x OTUs) aggregation matrix product, so a taxon's
+    reads in a sample are the rarefied reads of its OTUs. Ranks are
+    fitted in parallel on a process pool that reads the rarefied table
+    from shared memory; every rank is reported as in neufit_table().
+
+    Parameters
+    ----------
+    table: pandas df, numpy array, biom.Table, scipy.sparse matrix or tuple
+        OTU abundance table, as accepted by neufit_table().
+    ranks: str or list of str
+        Ranks to fit, e.g. 'genus,family,phylum', see
+        taxonomy.parse_ranks(); 'OTU' fits the OTUs themselves.
+    lineages: pandas df, Series or list, optional
+        Lineage of every OTU, see taxonomy.lineage_table() and
+        utils.load_lineages(). Default is the OTU ids, which then have to
+        be lineages ('k__...;p__...;...').
+    taxonomy: pandas df or str, path, optional
+        Taxonomic information indexed by otu_id, only joined to the 'OTU'
+        rank; the taxa of other ranks get their lineage columns.
+    arg_rarefaction_level: int, optional
+        Rarefaction level of all ranks. Default (0) is the highest
+        possible uniform read depth.
+    arg_ignore_level: int, optional
+        Ignores OTUs below this abudance threshold before aggregation.
+    output_filename: str, optional
+        Name/nickname of dataset (ex. 'combined'), only used in messages.
+    file_header: str, optional
+        Path prefix of all output files. If given, every rank's outputs
+        are written as in neufit_table() under group_file_header(), and
+        the read depths and the comparison of the ranks to [].txt and
+        []_ranks.tsv.
+    seed: int or numpy.random.Generator, optional
+        Seed of the rarefaction draws, the same draws as neufit_table().
+    jobs: int, optional
+        Number of worker processes for rarefaction and the rank fits; 0
+        uses all CPUs. Default is 1.
+
+    Returns
+    -------
+    summary: pandas df
+        One row per rank: n_taxa, n_reads, m, m_stderr, m_ci_lower,
+        m_ci_upper (normal approximation) and r_square.
+    rank_results: dict
+        Rank -> neufit_table() return value, indexed by the taxa's
+        lineages.
+    '''
+    #Check that rarefaction and ignore levels are positive
+    non_negative_int(arg_rarefaction_level)
+    non_negative_int(arg_ignore_level)
+    jobs = resolve_jobs(jobs)
+    ranks = parse_ranks(ranks)
+
+    if file_header is not None:
+        file = open(str(file_header) + ".txt", 'w')
+    else:
+        file = io.StringIO()
+
+    if output_filename is not None:
+        print("Running dataset:" + str(output_filename) + '\n')
+
+    with stage('table_counts'):
+        abundances, otu_ids, sample_ids = table_counts(table)
+    file.write('Corresponding table: ' + str(abundances.shape[0]) + \
+               ' otus x ' + str(abundances.shape[1]) + ' samples \n')
+    if isinstance(taxonomy, str):
+        taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+
+    #Parse every lineage once, for all ranks
+    with stage('encode_lineages', n_otus=len(otu_ids)):
+        levels = lineage_table(otu_ids if lineages is None else lineages, otu_ids)
+        codes, labels = encode_lineages(levels)
+
+    #Filter and rarefy once, as in _neufit()
+    with stage('filter', table=abundances):
+        keep = row_sums(abundances) > arg_ignore_level
+        abundances, otu_ids, codes = abundances[keep], otu_ids[keep], codes[keep]
+    sample_reads = col_sums(abundances)
+    n_reads = _report_depth(file, sample_ids, sample_reads, arg_rarefaction_level)
+    if not all(reads == n_reads for reads in sample_reads):
+        with stage('rarefy', table=abundances, depth=n_reads, jobs=jobs):
+            abundances, keep = rarefy(abundances, n_reads, sample_ids, seed, jobs)
+            keep = row_sums(abundances) > 0
+            abundances, otu_ids, codes = abundances[keep], otu_ids[keep], codes[keep]
+    n_samples = abundances.shape[1]
+
+    #Taxa of every rank that still have reads, renumbered from 0
+    rank_codes, rank_labels = [], []
+    for rank in ranks:
+        if rank == OTU_RANK:
+            rank_codes.append(None)
+            rank_labels.append(None)
+        else:
+            present, inverse = np.unique(codes[:, RANKS.index(rank)],
+                                         return_inverse=True)
+            rank_codes.append(inverse)
+            rank_labels.append(labels[RANKS.index(rank)][present])
+
+    if scipy.sparse.issparse(abundances):
+        abundances = scipy.sparse.csc_matrix(abundances)
+        arrays = (abundances.data, abundances.indices, abundances.indptr)
+    else:
+        arrays = (np.ascontiguousarray(abundances), np.empty(0, dtype=np.int64),
+                  np.empty(0, dtype=np.int64))
+    headers = [None if file_header is None else group_file_header(file_header, rank)
+               for rank in ranks]
+
+    args = (abundances.shape, otu_ids, ranks, rank_codes, rank_labels, taxonomy,
+            headers, n_reads)
+    if jobs > 1 and len(ranks) > 1:
+        with SharedArrays() as shared:
+            for array in arrays:
+                shared.copy(array)
+            chunks = split_columns(len(ranks), jobs)
+            results = map_shared(_ranks_chunk, shared, chunks, jobs, *args)
+        results = [result for chunk in results for result in chunk]
+    else:
+        results = _ranks_chunk(*arrays, range(len(ranks)), *args)
+    rank_results = dict(zip(ranks, results))
+
+    # Compare the ranks
+    summary = pd.DataFrame(
+        [(len(occurr_freqs), n_reads, beta_fit.params['m'].value,
+          beta_fit.params['m'].stderr, r_square)
+         for occurr_freqs, n_reads, n_samples, r_square, beta_fit in results],
+        columns=['n_taxa', 'n_reads', 'm', 'm_stderr', 'r_square'],
+        index=pd.Index(ranks, name='rank'))
+    summary['m_stderr'] = summary['m_stderr'].astype(float)
+    summary.insert(4, 'm_ci_lower', summary['m'] - 1.96 * summary['m_stderr'])
+    summary.insert(5, 'm_ci_upper', summary['m'] + 1.96 * summary['m_stderr'])
+
+    report = ('\nNeutral fits of ' + str(n_samples) + ' samples at ' + \
+              str(len(ranks)) + ' ranks, ' + str(n_reads) + \
+              ' reads per sample \n \n' + \
+              summary.to_string(float_format='{:1.4f}'.format) + '\n')
+    print(report)
+    print('=========================================================')
+    file.write(report)
+    file.close()
+    if file_header is not None:
+        summary.to_csv(str(file_header) + '_ranks.tsv', sep='\t')
+
+    return(summary, rank_results)
+
+
+def _ranks_chunk(data, indices, indptr, chunk, shape, otu_ids, ranks, codes,
+                 labels, taxonomy, headers, n_reads):
+    '''Aggregates and fits the ranks in chunk (worker of neufit_ranks())'''
+    if indptr.size == 0:
+        abundances = data
+    else:
+        abundances = scipy.sparse.csc_matrix((data, indices, indptr), shape=shape)
+    n_samples = shape[1]
+
+    results = []
+    for i in chunk:
+        if headers[i] is not None:
+            file = open(str(headers[i]) + ".txt", 'w')
+        else:
+            file = io.StringIO()
+        if codes[i] is None:
+            collapsed, taxa, rank_tax = abundances, otu_ids, taxonomy
+        else:
+            with stage('aggregate', rank=ranks[i], n_taxa=len(labels[i])):
+                collapsed = aggregation_matrix(codes[i], len(labels[i])) @ abundances
+            taxa, rank_tax = labels[i], rank_taxonomy(labels[i], ranks[i])
+        file.write ('Rank ' + str(ranks[i]) + ': ' + str(shape[0]) + \
+                    ' otus summed into ' + str(collapsed.shape[0]) + ' taxa \n')
+        file.write ('fitting neutral expectation to dataset with ' + \
+                    str(n_samples) + ' samples and ' + str(collapsed.shape[0]) + \
+                    ' taxa, rarefied to ' + str(n_reads) + \
+                    ' reads per sample \n \n')
+        with stage('occurrence_frequencies', table=collapsed):
+            occurr_freqs = occurrence_frequencies(collapsed, taxa, n_reads)
+        results.append(_fit_occurrences(file, occurr_freqs, rank_tax, n_reads,
+                                        n_samples, headers[i]))
+    return results
+
+
 def neufit(output_filename, file_header, _data_filename,
-           _taxonomy_filename, arg_rarefaction_level, arg_ignore_level):
+           _taxonomy_filename, arg_rarefaction_level, arg_ignore_level,
+           seed=None, jobs=1, bootstrap=0):
     
     '''Fits a neutral community model to species abundances
     
@@ -130,8 +1135,11 @@ def neufit(output_filename, file_header, _data_filename,
         filename of all comad outputs.     
     file_header: str
         Path of all output files
-    _data_filename: str, path
+    _data_filename: str, path, biom.Table, scipy.sparse matrix or tuple
         The path to []_data.csv file; often an OTU abudance table. 
+        Alternatively a biom Table, a scipy.sparse CSR/CSC matrix or the 
+        (counts, otu_ids, sample_ids) tuple from biom2sparse(); these are 
+        processed without ever building a dense matrix.
     _taxonomy_filename: str, path
         The path to []_taxonomy.csv; corresponding taxonomic information.
     arg_rarefaction_level: int
@@ -140,6 +1148,17 @@ def neufit(output_filename, file_header, _data_filename,
     arg_ignore_level: int
         Ignores OTUs below this abudance threshold; default is to use all 
         OTUs regardless of abudance threshold. Value must be non-negative.
+    seed: int or numpy.random.Generator, optional
+        Seed of the rarefaction draws. Default uses fresh OS entropy.
+    jobs: int, optional
+        Number of worker processes used for rarefaction; 0 uses all CPUs. 
+        Results for a given seed do not depend on jobs. Default is 1.
+    bootstrap: int, optional
+        Number of bootstrap resamples of the samples (columns). If 
+        positive, m is refitted to every resample and the 95% percentile 
+        interval is added to the report and to occurr_freqs.attrs 
+        ('m_ci_lower', 'm_ci_upper', 'm_bootstrap_std', 'bootstrap'). 
+        Default is 0 (none).
     
     Returns
     -------
@@ -219,38 +1238,62 @@ def neufit(output_filename, file_header, _data_filename,
     
     # Writes dataset info output file, calculates and writes the 
     # number of samples/ reads in the file
-    file.write('Corresponding csv file: ' + _data_filename + '\n')
-    abundances = pd.read_table(_data_filename, header=0, 
-                               index_col=0, sep='\t').astype(int)
-    abundances = abundances[abundances.sum(1) > arg_ignore_level]
-    file.write ('Dataset contains ' + str(abundances.shape[1]) + \
-                ' samples (sample_id, reads): \n')
-    
-    ##Caitlin
-    # The following loop is used instead of 'print abundances.sum(0)' 
-    # so that it can be written to a file
-    for index, col in abundances.iteritems():
-        col_sum = 0
-        for i in col:
-            col_sum += i
-        file.write (index + '\t' + str(col_sum) + '\n')
-    file.write ('\n')
-    ##
+    if isinstance(_data_filename, str):
+        file.write('Corresponding csv file: ' + _data_filename + '\n')
+        with stage('parse', filename=_data_filename) as record:
+            abundances = pd.read_table(_data_filename, header=0, 
+                                       index_col=0, sep='\t')
+            record['shape'] = list(abundances.shape)
+    else:
+        abundances = _data_filename
+    abundances, otu_ids, sample_ids = table_counts(abundances)
+    if scipy.sparse.issparse(abundances):
+        # Sparse mode: biom Table / scipy.sparse matrix, never densified
+        file.write('Corresponding sparse table: ' + str(abundances.shape[0]) + \
+                   ' otus x ' + str(abundances.shape[1]) + ' samples, ' + \
+                   str(abundances.nnz) + ' non-zero entries \n')
 
-    # Determine uniform read depth
-    if arg_rarefaction_level == 0 or arg_rarefaction_level > max(abundances.sum(0)):
-        arg_rarefaction_level = min(abundances.sum(0))
-        file.write ('rarefying to highest possible uniform read depth'),
+    if _taxonomy_filename != None:
+        # Join with taxonomic information (optional)
+        taxonomy = pd.read_table(_taxonomy_filename, header=0, 
+                                 index_col=0, sep='\t')
     else:
-        file.write ('rarefying to custom rarefaction level'),
-    file.write ('(' + str(arg_rarefaction_level) + \
-                ' reads per sample) \n')
+        taxonomy = None
+    
+    return _neufit(file, abundances, otu_ids, sample_ids, taxonomy,
+                   arg_rarefaction_level, arg_ignore_level, file_header, seed,
+                   jobs, bootstrap)
+
+
+def _neufit(file, abundances, otu_ids, sample_ids, taxonomy,
+            arg_rarefaction_level, arg_ignore_level, file_header, seed, 
+            jobs, bootstrap=0):
+    '''Shared core of neufit() and neufit_table()
+    
+    Filters, rarefies and fits the neutral model to an already loaded 
+    count matrix (dense numpy array or scipy.sparse matrix with OTUs as 
+    rows), writing the report to the open file object file. Output csv 
+    files are only written when file_header is not None. Returns the same 
+    tuple as neufit().
+    '''
+
+    with stage('filter', table=abundances):
+        keep = row_sums(abundances) > arg_ignore_level
+        abundances, otu_ids = abundances[keep], otu_ids[keep]
+    sample_reads = col_sums(abundances)
+    arg_rarefaction_level = _report_depth(file, sample_ids, sample_reads, 
+                                          arg_rarefaction_level)
 
     # Optionally subsample the abundance table, unless all samples 
     # already have the required uniform read depth
-    if not all(n_reads == arg_rarefaction_level for n_reads in abundances.sum(0)):
-        abundances = subsample(abundances, arg_rarefaction_level)
-        abundances = abundances[abundances.sum(1) > 0]
+    if not all(n_reads == arg_rarefaction_level for n_reads in sample_reads):
+        with stage('rarefy', table=abundances, depth=arg_rarefaction_level, 
+                   jobs=jobs):
+            abundances, keep = rarefy(abundances, arg_rarefaction_level, 
+                                      sample_ids, seed, jobs)
+            sample_ids = sample_ids[keep]
+            keep = row_sums(abundances) > 0
+            abundances, otu_ids = abundances[keep], otu_ids[keep]
 
     # Dataset shape
     n_otus, n_samples = abundances.shape
@@ -261,54 +1304,110 @@ def neufit(output_filename, file_header, _data_filename,
                 ' otus \n \n')
 
     # Calculate mean relative abundances and occurrence frequencies
-    mean_relative_abundance = (1.0*abundances.sum(1))/n_reads/n_samples
-    occurrence_frequency = (1.0*np.count_nonzero(abundances, 
-                                                 axis=1))/n_samples
+    with stage('occurrence_frequencies', table=abundances):
+        occurr_freqs = occurrence_frequencies(abundances, otu_ids, n_reads)
+
+    return _fit_occurrences(file, occurr_freqs, taxonomy, n_reads, n_samples,
+                            file_header, bootstrap, abundances, seed, jobs)
+
+
+def _report_depth(file, sample_ids, sample_reads, arg_rarefaction_level):
+    '''Writes the reads per sample and picks the rarefaction depth, see 
+        rarefaction_depth()'''
+    file.write ('Dataset contains ' + str(len(sample_ids)) + \
+                ' samples (sample_id, reads): \n')
     
-    occurr_freqs = pd.DataFrame(mean_relative_abundance, 
-                                columns=['mean_abundance'])
-    occurr_freqs.index.name = 'otu_id'
-    occurr_freqs['occurrence'] = occurrence_frequency
-    occurr_freqs = occurr_freqs.sort_values(by=['mean_abundance'])
+    ##Caitlin
+    # The following loop is used instead of 'print abundances.sum(0)' 
+    # so that it can be written to a file
+    for index, col_sum in zip(sample_ids, sample_reads):
+        file.write (str(index) + '\t' + str(col_sum) + '\n')
+    file.write ('\n')
+    ##
 
-    if _taxonomy_filename != None:
-        # Join with taxonomic information (optional)
-        if _taxonomy_filename != None: #Changed <> to !=
-            taxonomy = pd.read_table(_taxonomy_filename, header=0, 
-                                         index_col=0, sep='\t')
-            occurr_freqs = occurr_freqs.join(taxonomy)
+    # Determine uniform read depth
+    arg_rarefaction_level, highest = rarefaction_depth(sample_reads, 
+                                                       arg_rarefaction_level)
+    if highest:
+        file.write ('rarefying to highest possible uniform read depth'),
+    else:
+        file.write ('rarefying to custom rarefaction level'),
+    file.write ('(' + str(arg_rarefaction_level) + \
+                ' reads per sample) \n')
+    return arg_rarefaction_level
+
+
+def _fit_occurrences(file, occurr_freqs, taxonomy, n_reads, n_samples, 
+                     file_header, bootstrap=0, abundances=None, seed=None, 
+                     jobs=1):
+    '''Fits the neutral model to occurrence frequencies and writes the 
+        report and non-neutral outputs (second half of _neufit())
+    
+    abundances, the rarefied table, is only needed for bootstrap > 0.
+    '''
+    n_otus = len(occurr_freqs)
+    if taxonomy is not None:
+        # Join with taxonomic information (optional); ids are compared as 
+        # strings since biom ids are strings but csv ids often parse as int
+        occurr_freqs.index = occurr_freqs.index.astype(str)
+        taxonomy = taxonomy.copy()
+        taxonomy.index = taxonomy.index.astype(str)
+        occurr_freqs = occurr_freqs.join(taxonomy)
         
     # Fit the neutral model
-    params = Parameters()
-    params.add('N', value=n_reads, vary=False)
-    params.add('m', value=0.5, min=0.0, max=1.0)
-    beta_model = Model(beta_cdf)
-    beta_fit = beta_model.fit(occurr_freqs['occurrence'], params, 
-                              p=occurr_freqs['mean_abundance'])
+    with stage('fit', n_otus=n_otus):
+        beta_fit, r_square = fit_neutral_model(occurr_freqs, n_reads)
 
     # Report fit statistics
-    r_square = 1.0 - np.sum(np.square(occurr_freqs['occurrence'] - beta_fit.best_fit))/np.sum(np.square(occurr_freqs['occurrence'] - np.mean(occurr_freqs['occurrence'])))
+    from lmfit import fit_report
     file.write (fit_report(beta_fit))
     file.write ('\n R^2 = ' + '{:1.2f}'.format(r_square))
     print(fit_report(beta_fit))
     print('\n R^2 = ' + '{:1.2f}'.format(r_square))
+
+    # Compare with the null and free N models, fitted to the same 
+    # occurrence statistics
+    with stage('compare_models', n_otus=n_otus):
+        comparison = compare_models(occurr_freqs, n_reads, beta_fit)
+    file.write ('\n' + comparison_report(comparison))
+    print(comparison_report(comparison))
+
+    # Bootstrap the samples for a percentile confidence interval of m
+    if bootstrap > 0:
+        with stage('bootstrap', resamples=bootstrap, jobs=jobs):
+            m_bootstrap = bootstrap_m(abundances, n_reads, bootstrap, seed, jobs)
+        m_ci_lower, m_ci_upper = np.percentile(m_bootstrap, [2.5, 97.5])
+        bootstrap_report = '\n bootstrap m 95% CI = [' + \
+                           '{:1.4f}'.format(m_ci_lower) + ', ' + \
+                           '{:1.4f}'.format(m_ci_upper) + '] (' + \
+                           str(bootstrap) + ' resamples of samples, std = ' + \
+                           '{:1.4f}'.format(np.std(m_bootstrap)) + ')'
+        file.write (bootstrap_report)
+        print(bootstrap_report)
     print('=========================================================')
 
     # Adding the neutral prediction to results
     occurr_freqs['predicted_occurrence'] = beta_fit.best_fit
-    occurr_freqs['lower_conf_int'], occurr_freqs['upper_conf_int'] = proportion_confint(occurr_freqs['predicted_occurrence']*n_samples, n_samples, alpha=0.05, method='wilson')
+    with stage('confint', n_otus=n_otus):
+        occurr_freqs['lower_conf_int'], occurr_freqs['upper_conf_int'] = neutral_confint(occurr_freqs['predicted_occurrence'], n_samples)
 
-    # Save non-neutral otus (here simply determined by lying outside the confidence intervals)
-    above = occurr_freqs[occurr_freqs['occurrence'] > occurr_freqs['upper_conf_int']]
-    below = occurr_freqs[occurr_freqs['occurrence'] < occurr_freqs['lower_conf_int']]
-    
-    file.close()
+    occurr_freqs.attrs['model_comparison'] = comparison_attrs(comparison)
+    if bootstrap > 0:
+        occurr_freqs.attrs.update({'bootstrap': bootstrap, 
+                                   'm_ci_lower': m_ci_lower,
+                                   'm_ci_upper': m_ci_upper,
+                                   'm_bootstrap_std': np.std(m_bootstrap)})
 
-    #Create non-neutral output file from Neufit (unordered file that comes with orginal input)
-    pd.concat((above, below)).to_csv(str(file_header) + \
-                                    '_FullNonNeutral.csv')
+    file.close()
 
-    #Create most non-neutral file (top non-neutral microbes based on a threshold)
-    non_neutral_outliers(file_header, occurr_freqs, threshold = 0.5)
+    if file_header is not None:
+        #Save non-neutral otus (here simply determined by lying outside the 
+        #confidence intervals) and the most non-neutral otus (based on a 
+        #threshold) in one pass
+        non_neutral_outliers(file_header, occurr_freqs, threshold = 0.5, 
+                             full = True)
     
+    # Keep the results as float32/categorical columns once the fit and the 
+    # non-neutral calls are made
+    occurr_freqs = compact_occurrences(occurr_freqs)
     return(occurr_freqs, n_reads, n_samples, r_square, beta_fit)
\ No newline at end of file
@@ -1,6 +1,11 @@
 import os
 import numpy as np
-from scipy.stats import beta 
+from functools import lru_cache
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import minimize_scalar
+from scipy.special import betainc
+from comad.parallel import SharedArrays, map_shared, split_columns, resolve_jobs
 
 def beta_cdf(p, N, m):
     '''Expected long term distribution under the 
@@ -66,12 +71,99 @@ def beta_cdf(p, N, m):
     S., Hentschel, U., Schulenburg, H., Bosch, T. C. G. and Traulsen, A. 
     (2018). The Neutral Metaorganism. bioRxiv. https://doi.org/10.1101/367243
     '''
-    return beta.cdf(1.0, N*m*p, N*m*(1.0-p)) - beta.cdf(1.0/N, N*m*p, N*m*(1.0-p))
+    # beta.cdf(1.0, a, b) is exactly 1, so only the lower tail is needed; 
+    # betainc is the regularized incomplete beta function, i.e. beta.cdf
+    return 1.0 - betainc(N*m*p, N*m*(1.0-p), 1.0/N)
 
-def subsample(counts, depth):
+class NeutralCurve:
+    '''beta_cdf(p, N, m) tabulated once on a log-spaced grid of p
+    
+    The grid covers p in [p_min, 1] and is refined (doubled) until linear 
+    interpolation in log(p) reproduces beta_cdf() at every grid midpoint 
+    to within tol. Values of p below p_min are evaluated exactly. Use 
+    neutral_curve() to share one table per (N, m).
+    
+    Parameters
+    ----------
+    N: int
+        Rarefaction depth.
+    m: float
+        Migration rate.
+    tol: float, optional
+        Maximum absolute interpolation error. Default is 1e-6.
+    p_min: float, optional
+        Smallest tabulated mean relative abundance. Default is 1e-12.
+    '''
+    def __init__(self, N, m, tol=1e-6, p_min=1e-12):
+        self.N, self.m, self.tol, self.p_min = N, m, tol, p_min
+        log_p = np.linspace(np.log10(p_min), 0.0, 257)
+        values = self._exact(10.0**log_p)
+        while log_p.size < 2**20:
+            midpoints = 0.5*(log_p[1:] + log_p[:-1])
+            exact = self._exact(10.0**midpoints)
+            error = np.abs(exact - 0.5*(values[1:] + values[:-1]))
+            merged_p, merged = np.empty(2*log_p.size - 1), np.empty(2*log_p.size - 1)
+            merged_p[0::2], merged_p[1::2] = log_p, midpoints
+            merged[0::2], merged[1::2] = values, exact
+            log_p, values = merged_p, merged
+            if error.max() <= tol:
+                break
+        self.log_p, self.values = log_p, values
+    
+    def _exact(self, p):
+        # beta_cdf is undefined at p = 1 where it tends to 1
+        values = beta_cdf(p, self.N, self.m)
+        return np.where(p >= 1.0, 1.0, values)
+    
+    def __call__(self, p):
+        '''Predicted occurrence frequency at mean relative abundance p'''
+        p = np.asarray(p, dtype=float)
+        with np.errstate(divide='ignore'):
+            values = np.interp(np.log10(p), self.log_p, self.values)
+        below = p < self.p_min
+        if below.any():
+            values[below] = self._exact(p[below])
+        return values
+    
+    def confint(self, p, n_samples):
+        '''Predicted occurrence frequency at p and its 95% Wilson 
+            confidence interval, see neutral_confint()'''
+        predicted = self(p)
+        lower, upper = neutral_confint(predicted, n_samples)
+        return predicted, lower, upper
+
+@lru_cache(maxsize=64)
+def neutral_curve(N, m, tol=1e-6):
+    '''Cached NeutralCurve for (N, m), shared by the fit, the confidence 
+        intervals and plotting'''
+    return NeutralCurve(N, m, tol)
+
+def subsample(counts, depth, seed=None, jobs=1):
     '''Subsamples counts to uniform depth, dropping all samples 
         without enough depth 
     
+    Each sample is drawn from a multivariate hypergeometric distribution 
+    (see rarefy()), which is the same distribution as drawing depth reads 
+    without replacement but needs memory proportional to the number of 
+    OTUs rather than the number of reads.
+    
+    Parameters
+    ----------
+    counts: pandas df
+        Integer OTU abundance table with OTUs as rows and samples as 
+        columns.
+    depth: int
+        Number of reads to keep per sample.
+    seed: int or numpy.random.Generator, optional
+        Seed of the random draws. Default uses fresh OS entropy.
+    jobs: int, optional
+        Number of worker processes; 0 uses all CPUs. Default is 1.
+    
+    Returns
+    -------
+    counts: pandas df
+        Rarefied abundance table containing only the kept samples.
+    
     Copyright
     ---------
     Github: https://github.com/misieber/neufit
@@ -112,16 +204,10 @@ def subsample(counts, depth):
     S., Hentschel, U., Schulenburg, H., Bosch, T. C. G. and Traulsen, A. 
     (2018). The Neutral Metaorganism. bioRxiv. https://doi.org/10.1101/367243    
     '''
-    for sample in counts:
-        if counts[sample].sum() >= depth:
-            flattened = np.repeat(np.arange(counts[sample].size), counts[sample])
-            subsample = np.random.choice(flattened, depth, replace=False)
-            counts[sample] = np.bincount(subsample, minlength=counts[sample].size)
-        else:
-            #CG: changed the following print statment from Python2 to Python3 
-            print('dropping sample ' + sample + ' with ' + str(counts[sample].sum()) + ' reads < ' + str(depth))
-            counts = counts.drop(sample, axis=1)
-    return counts
+    rarefied, keep = rarefy(counts.to_numpy(), depth, counts.columns, seed, 
+                            jobs)
+    return pd.DataFrame(rarefied, index=counts.index, 
+                        columns=counts.columns[keep])
 
 def non_negative_int(arg):
     '''Argparser type: non-negative int
@@ -170,4 +256,557 @@ def non_negative_int(arg):
     nnint = int(arg)
     if nnint < 0:
         raise ArgumentTypeError(arg + ' < 0, must be non-negative')
-    return nnint
\ No newline at end of file
+    return nnint
+
+def row_sums(counts):
+    '''Total reads per OTU (row) of a dense or scipy.sparse count matrix
+    
+    Parameters
+    ----------
+    counts: pandas df, numpy array or scipy.sparse matrix
+        OTU abundance table with OTUs as rows and samples as columns.
+    
+    Returns
+    -------
+    sums: numpy array
+        One entry per row of counts; int64 for (compact) integer counts.
+    '''
+    return _wide_sums(counts.sum(1))
+
+def col_sums(counts):
+    '''Total reads per sample (column) of a dense or scipy.sparse 
+        count matrix
+    
+    Parameters
+    ----------
+    counts: pandas df, numpy array or scipy.sparse matrix
+        OTU abundance table with OTUs as rows and samples as columns.
+    
+    Returns
+    -------
+    sums: numpy array
+        One entry per column of counts; int64 for (compact) integer counts.
+    '''
+    return _wide_sums(counts.sum(0))
+
+def _wide_sums(sums):
+    # numpy sums unsigned counts as uint64, which mixes badly with int64
+    # (e.g. uint64 - int64 is float64); report read totals as int64
+    sums = np.asarray(sums).ravel()
+    if sums.dtype.kind == 'u':
+        return sums.astype(np.int64)
+    return sums
+
+COUNT_DTYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+def count_dtype(max_count):
+    '''Smallest unsigned integer dtype that holds counts up to max_count
+    
+    Rarefaction never increases a count, so rarefied tables keep the 
+    dtype of their input.
+    '''
+    for dtype in COUNT_DTYPES:
+        if max_count <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError('counts of ' + str(max_count) + ' do not fit in 64 bits')
+
+def compact_counts(counts):
+    '''Non-negative integer counts (numpy array) in the smallest safe 
+        dtype; no copy if they already have it'''
+    counts = np.asarray(counts)
+    if counts.size == 0:
+        return counts.astype(np.uint8, copy=False)
+    if counts.dtype.kind != 'u' and counts.min() < 0:
+        raise ValueError('counts must be non-negative')
+    return counts.astype(count_dtype(int(counts.max())), copy=False)
+
+class CountTable(tuple):
+    '''(counts, otu_ids, sample_ids) whose counts are known to be compact 
+        already (see compact_counts()), e.g. a table written by 
+        convert_table(); table_counts() passes it on without reading the 
+        counts'''
+    __slots__ = ()
+
+def compact_occurrences(occurr_freqs):
+    '''Stores the float columns of occurr_freqs (abundances, occurrences, 
+        predictions, confidence intervals) as float32 and the taxonomy as 
+        categoricals, which cuts the frame's memory 2-4x
+    
+    Meant for results that are kept, cached or plotted: the fit and the 
+    non-neutral calls are made on the float64 values beforehand, and 
+    float32 keeps about 7 significant digits.
+    '''
+    occurr_freqs = occurr_freqs.copy()
+    occurr_freqs.attrs = dict(occurr_freqs.attrs)
+    for column in occurr_freqs.columns:
+        values = occurr_freqs[column]
+        if values.dtype == np.float64:
+            occurr_freqs[column] = values.astype(np.float32)
+        elif values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            occurr_freqs[column] = values.astype('category')
+    return occurr_freqs
+
+def count_nonzero(counts):
+    '''Number of samples each OTU (row) occurs in
+    
+    For scipy.sparse input only the stored entries are inspected, so 
+    explicit zeros left behind by rarefaction are not counted and the 
+    matrix is never densified.
+    
+    Parameters
+    ----------
+    counts: pandas df, numpy array or scipy.sparse matrix
+        OTU abundance table with OTUs as rows and samples as columns.
+    
+    Returns
+    -------
+    occurrences: numpy array
+        One entry per row of counts.
+    '''
+    if sparse.issparse(counts):
+        counts = counts.tocoo()
+        return np.bincount(counts.row[counts.data != 0], 
+                           minlength=counts.shape[0])
+    return np.count_nonzero(counts, axis=1)
+
+def rarefy_sample(sample_counts, depth, rng):
+    '''Draws depth reads without replacement from one sample
+    
+    Uses a multivariate hypergeometric draw over the non-zero entries, so 
+    the cost is O(OTUs in the sample) instead of O(reads in the sample).
+    
+    Parameters
+    ----------
+    sample_counts: numpy array
+        Non-negative integer counts of one sample.
+    depth: int
+        Number of reads to keep; must not exceed sample_counts.sum().
+    rng: numpy.random.Generator
+        Source of randomness.
+    
+    Returns
+    -------
+    rarefied: numpy array
+        Rarefied counts, same shape as sample_counts.
+    '''
+    if sample_counts.sum() >= 10**9:
+        raise ValueError('samples with 10^9 or more reads cannot be rarefied')
+    return rng.multivariate_hypergeometric(sample_counts.astype(np.int64), 
+                                           depth, method='marginals')
+
+def sample_seeds(seed):
+    '''Root entropy from which every sample gets its own random stream
+    
+    Sample j is always rarefied with SeedSequence(entropy, spawn_key=(j,)), 
+    so a given seed gives the same result however the samples are split 
+    across worker processes.
+    
+    Parameters
+    ----------
+    seed: None, int or numpy.random.Generator
+        None draws fresh OS entropy; a Generator is advanced once.
+    
+    Returns
+    -------
+    entropy: int
+    '''
+    if isinstance(seed, np.random.Generator):
+        return int(seed.integers(2**63))
+    return np.random.SeedSequence(seed).entropy
+
+def _rarefy_columns(values, indptr, rarefied, columns, keys, depth, entropy):
+    '''Rarefies the given columns in place (worker of rarefy())
+    
+    For dense tables values/rarefied are (samples x OTUs) arrays and indptr 
+    is empty; for sparse tables they are the CSC data arrays.
+    '''
+    for j, key in zip(columns, keys):
+        rng = np.random.default_rng(np.random.SeedSequence(entropy, 
+                                                           spawn_key=(key,)))
+        if indptr.size == 0:
+            nonzero = np.flatnonzero(values[j])
+            rarefied[j, nonzero] = rarefy_sample(values[j, nonzero], depth, rng)
+        else:
+            start, end = indptr[j], indptr[j + 1]
+            rarefied[start:end] = rarefy_sample(values[start:end], depth, rng)
+
+def _rarefy_chunk(values, indptr, rarefied, keys, chunk, depth, entropy):
+    _rarefy_columns(values, indptr, rarefied, chunk, keys[chunk], depth, 
+                    entropy)
+
+def rarefy(counts, depth, sample_ids=None, seed=None, jobs=1, first_key=0):
+    '''Subsamples a dense or scipy.sparse count matrix to uniform depth, 
+        dropping all samples without enough depth
+    
+    Samples below depth are removed in a single step; every remaining 
+    sample is rarefied with rarefy_sample(). Dense input is rarefied on a 
+    contiguous (samples x OTUs) copy, sparse input only touches the stored 
+    non-zero entries, so memory scales with nnz. With jobs > 1 the samples 
+    are split across a process pool that reads the counts from shared 
+    memory; results only depend on seed, not on jobs.
+    
+    Parameters
+    ----------
+    counts: numpy array or scipy.sparse matrix
+        Integer OTU abundance table with OTUs as rows and samples as 
+        columns.
+    depth: int
+        Number of reads to keep per sample.
+    sample_ids: array-like, optional
+        Sample names, only used for reporting dropped samples.
+    seed: int or numpy.random.Generator, optional
+        Seed of the random draws. Default uses fresh OS entropy.
+    jobs: int, optional
+        Number of worker processes; 0 uses all CPUs. Default is 1.
+    first_key: int, optional
+        Column j is rarefied with the stream of sample first_key + j (see 
+        sample_seeds()), so a table can be rarefied in batches of columns 
+        with the same result. Default is 0.
+    
+    Returns
+    -------
+    rarefied: numpy array or scipy.sparse.csc_matrix
+        Rarefied abundance table containing only the kept samples.
+    keep: numpy array of bool
+        Which columns of counts were kept.
+    '''
+    entropy = sample_seeds(seed)
+    jobs = resolve_jobs(jobs)
+    depths = col_sums(counts)
+    keep = depths >= depth
+    keys = np.flatnonzero(keep) + first_key
+    if sample_ids is None:
+        sample_ids = np.arange(counts.shape[1]).astype(str)
+    for sample, reads in zip(np.asarray(sample_ids)[~keep], depths[~keep]):
+        #CG: changed the following print statment from Python2 to Python3 
+        print('dropping sample ' + str(sample) + ' with ' + str(reads) + ' reads < ' + str(depth))
+    
+    is_sparse = sparse.issparse(counts)
+    if is_sparse:
+        counts = sparse.csc_matrix(counts)[:, keep]
+    n_samples = int(keep.sum())
+    
+    with SharedArrays() as shared:
+        if jobs > 1 and n_samples > 1:
+            empty, copy = shared.empty, shared.copy
+        else:
+            empty, copy = np.empty, np.asarray
+        
+        if is_sparse:
+            values, indptr = copy(counts.data), copy(counts.indptr)
+        else:
+            values = empty((n_samples, counts.shape[0]), np.asarray(counts).dtype)
+            values[...] = np.asarray(counts)[:, keep].T
+            indptr = copy(np.empty(0, dtype=np.int64))
+        rarefied = empty(values.shape, values.dtype)
+        rarefied[...] = 0
+        keys = copy(keys)
+        
+        if jobs > 1 and n_samples > 1:
+            map_shared(_rarefy_chunk, shared, split_columns(n_samples, jobs),
+                       jobs, depth, entropy)
+        else:
+            _rarefy_columns(values, indptr, rarefied, range(n_samples), keys, 
+                            depth, entropy)
+        rarefied = np.array(rarefied)
+    
+    if is_sparse:
+        rarefied = sparse.csc_matrix((rarefied, counts.indices, counts.indptr), 
+                                     shape=counts.shape)
+        rarefied.eliminate_zeros()
+        return rarefied, keep
+    return rarefied.T, keep
+
+def rarefaction_depth(sample_reads, arg_rarefaction_level):
+    '''Uniform read depth used for rarefaction
+    
+    Parameters
+    ----------
+    sample_reads: array-like
+        Total reads per sample.
+    arg_rarefaction_level: int
+        Requested rarefaction level; 0 (or a level above every sample) 
+        selects the highest possible uniform read depth.
+    
+    Returns
+    -------
+    depth: int
+    highest: bool
+        True if the highest possible uniform read depth was selected.
+    '''
+    if arg_rarefaction_level == 0 or arg_rarefaction_level > max(sample_reads):
+        return min(sample_reads), True
+    return arg_rarefaction_level, False
+
+def occurrence_frequencies(abundances, otu_ids, n_reads):
+    '''Mean relative abundance and occurrence frequency of every OTU of 
+        a rarefied table
+    
+    Parameters
+    ----------
+    abundances: numpy array or scipy.sparse matrix
+        Rarefied OTU abundance table, OTUs as rows and samples as columns.
+    otu_ids: array-like
+        OTU ids (rows).
+    n_reads: int
+        Rarefaction depth.
+    
+    Returns
+    -------
+    occurr_freqs: pandas df
+        Df header: otu_id, mean_abundance, occurrence; sorted by 
+        mean_abundance.
+    '''
+    n_samples = abundances.shape[1]
+    mean_relative_abundance = (1.0*row_sums(abundances))/n_reads/n_samples
+    occurrence_frequency = (1.0*count_nonzero(abundances))/n_samples
+    
+    occurr_freqs = pd.DataFrame({'mean_abundance': mean_relative_abundance}, 
+                                index=otu_ids)
+    occurr_freqs.index.name = 'otu_id'
+    occurr_freqs['occurrence'] = occurrence_frequency
+    return occurr_freqs.sort_values(by=['mean_abundance'])
+
+class NeutralFit:
+    '''Result of fit_neutral_model()
+    
+    Exposes the attributes of lmfit.model.ModelResult that comad uses 
+    (params, best_values, best_fit, residual and the fit statistics), so it 
+    can be passed to lmfit.fit_report() and plotting.neufit_plot() in place 
+    of a ModelResult.
+    '''
+    def __init__(self, params, best_fit, data, nfev, method, success=True, 
+                 message=''):
+        self.params = params
+        self.best_values = {name: par.value for name, par in params.items()}
+        self.init_values = {name: par.init_value for name, par in params.items()}
+        self.best_fit = best_fit
+        self.data = data
+        self.residual = best_fit - data
+        self.nfev = nfev
+        self.method = method
+        self.success = success
+        self.message = message
+        self.ndata = data.size
+        self.nvarys = sum(par.vary for par in params.values())
+        self.nfree = self.ndata - self.nvarys
+        self.chisqr = float(np.sum(self.residual**2))
+        self.redchi = self.chisqr / max(self.nfree, 1)
+        _neg2_log_likel = self.ndata * np.log(self.chisqr / self.ndata)
+        self.aic = _neg2_log_likel + 2 * self.nvarys
+        self.bic = _neg2_log_likel + np.log(self.ndata) * self.nvarys
+        self.rsquared = 1.0 - self.chisqr / np.sum((data - data.mean())**2)
+        self.errorbars = all(par.stderr is not None 
+                             for par in params.values() if par.vary)
+    
+    def fit_report(self, **kws):
+        from lmfit import fit_report
+        return fit_report(self, **kws)
+
+def fit_neutral_model(occurr_freqs, n_reads, method='scalar', curve_tol=1e-6,
+                      curve_min_otus=20000):
+    '''Fits the migration rate m of beta_cdf() to the occurrence 
+        frequencies, with N fixed to the rarefaction depth
+    
+    The default 'scalar' method treats this as the bounded one-parameter 
+    problem it is: the residual sum of squares is minimised over log(m) in 
+    [1e-8, 1] with Brent's method, evaluating beta_cdf() vectorized via 
+    scipy.special.betainc and only once per distinct mean abundance. The 
+    standard error of m is taken from 
+    a central-difference derivative at the optimum, scaled by the reduced 
+    chi-square as lmfit does. method='lmfit' runs the previous generic 
+    lmfit Model.fit (Levenberg-Marquardt) instead.
+    
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+        Needs mean_abundance and occurrence columns.
+    n_reads: int
+        Rarefaction depth.
+    method: str, optional
+        'scalar' (default) or 'lmfit'.
+    curve_tol: float, optional
+        Accuracy bound of the cached neutral_curve() used for best_fit 
+        when there are more than curve_min_otus distinct abundances; below 
+        that beta_cdf() is evaluated exactly. Default is 1e-6.
+    curve_min_otus: int, optional
+        Default is 20000, about where interpolating the table becomes 
+        cheaper than exact evaluation.
+    
+    Returns
+    -------
+    beta_fit: NeutralFit or lmfit.model.ModelResult object
+        Holds the stats on the preformance of the model.
+    r_square: float
+        R^2 value of the fit of data to neutral curve.
+    '''
+    # lmfit (slow to import) is only loaded once a model is fitted
+    from lmfit import Parameters, Model
+    params = Parameters()
+    params.add('N', value=n_reads, vary=False)
+    params.add('m', value=0.5, min=0.0, max=1.0)
+    
+    if method == 'lmfit':
+        beta_model = Model(beta_cdf)
+        beta_fit = beta_model.fit(occurr_freqs['occurrence'], params, 
+                                  p=occurr_freqs['mean_abundance'])
+    elif method == 'scalar':
+        occurrence = np.asarray(occurr_freqs['occurrence'], dtype=float)
+        N = float(n_reads)
+        
+        # mean_abundance is a read total / (N * n_samples), so many OTUs 
+        # share a value; the curve is only evaluated once per distinct p 
+        # and the residual sum of squares is expanded per group
+        p, inverse = np.unique(np.asarray(occurr_freqs['mean_abundance'], 
+                                          dtype=float), return_inverse=True)
+        weights = np.bincount(inverse, minlength=p.size)
+        occurrence_sums = np.bincount(inverse, occurrence, minlength=p.size)
+        sum_of_squares = np.sum(occurrence**2)
+        
+        def rss(log_m):
+            predicted = beta_cdf(p, N, 10.0**log_m)
+            return sum_of_squares - 2.0*np.dot(predicted, occurrence_sums) + \
+                   np.dot(weights, predicted**2)
+        
+        opt = minimize_scalar(rss, bounds=(-8.0, 0.0), method='bounded',
+                              options={'xatol': 1e-10})
+        m = 10.0**opt.x
+        if p.size > curve_min_otus:
+            best_fit = neutral_curve(n_reads, m, curve_tol)(p)[inverse]
+        else:
+            best_fit = beta_cdf(p, N, m)[inverse]
+        
+        # d(prediction)/dm by central differences, kept inside [0, 1]
+        h = 1e-6 * m
+        upper, lower = min(m + h, 1.0), m - h
+        jacobian = (beta_cdf(p, N, upper) - beta_cdf(p, N, lower)) / (upper - lower)
+        curvature = np.dot(weights, jacobian**2)
+        
+        params['m'].value = m
+        nfree = max(occurrence.size - 1, 1)
+        if curvature > 0:
+            params['m'].stderr = np.sqrt(np.sum((best_fit - occurrence)**2) / nfree / curvature)
+        beta_fit = NeutralFit(params, best_fit, occurrence, opt.nfev + 3, 
+                              'bounded', opt.success, opt.message)
+    else:
+        raise ValueError("method must be 'scalar' or 'lmfit'")
+    
+    r_square = 1.0 - np.sum(np.square(occurr_freqs['occurrence'] - beta_fit.best_fit))/np.sum(np.square(occurr_freqs['occurrence'] - np.mean(occurr_freqs['occurrence'])))
+    return beta_fit, r_square
+
+def neutral_confint(predicted_occurrence, n_samples):
+    '''95% Wilson confidence interval around the predicted occurrence 
+        frequencies
+    
+    Returns
+    -------
+    lower, upper: numpy arrays or pandas series
+    '''
+    from statsmodels.stats.proportion import proportion_confint
+    return proportion_confint(predicted_occurrence*n_samples, n_samples, 
+                              alpha=0.05, method='wilson')
+
+BOOTSTRAP_KEY = 0xB007
+
+# Dense tables are multiplied in blocks of OTU rows of about this many 
+# entries, so a worker never holds a float64 copy of the whole table
+BOOTSTRAP_BLOCK = 2**22
+
+def _bootstrap_sums(data, indices, indptr, shape, weights):
+    '''Per OTU read sums and occurrence counts of every column of 
+        weights'''
+    if indptr.size > 0:
+        abundances = sparse.csc_matrix((data, indices, indptr), shape=shape)
+        presence = sparse.csc_matrix((data > 0, indices, indptr), shape=shape)
+        return abundances @ weights, presence @ weights
+    reads = np.empty((shape[0], weights.shape[1]))
+    occurrences = np.empty_like(reads)
+    rows = max(BOOTSTRAP_BLOCK // max(shape[1], 1), 1)
+    for start in range(0, shape[0], rows):
+        block = data[start:start + rows]
+        reads[start:start + rows] = block.astype(np.float64) @ weights
+        occurrences[start:start + rows] = (block > 0) @ weights
+    return reads, occurrences
+
+def _bootstrap_chunk(data, indices, indptr, chunk, shape, n_reads, entropy):
+    '''Fits m to the bootstrap replicates in chunk (worker of 
+        bootstrap_m())'''
+    n_samples = shape[1]
+    
+    # Sample multiplicities of each replicate, as columns of weights
+    weights = np.empty((n_samples, len(chunk)))
+    for i, replicate in enumerate(chunk):
+        rng = np.random.default_rng(np.random.SeedSequence(
+            entropy, spawn_key=(BOOTSTRAP_KEY, replicate)))
+        weights[:, i] = np.bincount(rng.integers(n_samples, size=n_samples),
+                                    minlength=n_samples)
+    reads, occurrences = _bootstrap_sums(data, indices, indptr, shape, weights)
+    
+    m = np.empty(len(chunk))
+    for i in range(len(chunk)):
+        present = reads[:, i] > 0
+        occurr_freqs = pd.DataFrame({
+            'mean_abundance': reads[present, i]/n_reads/n_samples,
+            'occurrence': occurrences[present, i]/n_samples})
+        beta_fit, r_square = fit_neutral_model(occurr_freqs, n_reads)
+        m[i] = beta_fit.best_values['m']
+    return m
+
+def bootstrap_m(abundances, n_reads, bootstrap, seed=None, jobs=1, 
+                chunk_size=None):
+    '''Bootstrap distribution of the migration rate m
+    
+    Samples (columns) of the rarefied table are resampled with 
+    replacement. Each replicate is a vector of sample multiplicities, so 
+    its per OTU read sums and occurrence counts are a single sparse 
+    matrix-vector product over the already rarefied table; nothing is 
+    re-read or re-rarefied. Replicates are refitted with 
+    fit_neutral_model() across a pool of jobs worker processes that share 
+    the table through shared memory.
+    
+    Parameters
+    ----------
+    abundances: numpy array or scipy.sparse matrix
+        Rarefied OTU abundance table, OTUs as rows and samples as columns.
+    n_reads: int
+        Rarefaction depth.
+    bootstrap: int
+        Number of bootstrap replicates.
+    seed: int or numpy.random.Generator, optional
+        Seed of the resampling. Replicate b always uses the same stream, 
+        whatever the number of jobs.
+    jobs: int, optional
+        Number of worker processes; 0 uses all CPUs. Default is 1.
+    chunk_size: int, optional
+        Replicates evaluated per matrix product. Default keeps each 
+        OTUs x chunk_size block around 20 million entries.
+    
+    Returns
+    -------
+    m: numpy array
+        Fitted m of every replicate.
+    '''
+    entropy = sample_seeds(seed)
+    jobs = resolve_jobs(jobs)
+    if sparse.issparse(abundances):
+        abundances = sparse.csc_matrix(abundances)
+        arrays = (abundances.data, abundances.indices, abundances.indptr)
+    else:
+        abundances = np.ascontiguousarray(abundances)
+        arrays = (abundances, np.empty(0, dtype=np.int64), 
+                  np.empty(0, dtype=np.int64))
+    if chunk_size is None:
+        chunk_size = int(np.clip(2*10**7 // max(abundances.shape[0], 1), 1, 256))
+    n_chunks = max(-(-bootstrap // chunk_size), jobs if jobs > 1 else 1)
+    chunks = np.array_split(np.arange(bootstrap), min(n_chunks, max(bootstrap, 1)))
+    
+    if jobs > 1 and len(chunks) > 1:
+        with SharedArrays() as shared:
+            for array in arrays:
+                shared.copy(array)
+            results = map_shared(_bootstrap_chunk, shared, chunks, jobs, 
+                                 abundances.shape, n_reads, entropy)
+    else:
+        results = [_bootstrap_chunk(*arrays, chunk, abundances.shape, n_reads, 
+                                    entropy) for chunk in chunks]
+    return np.concatenate(results) if results else np.empty(0)
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+class SharedArrays:
+    '''Numpy arrays held in named shared memory blocks
+
+    Arrays created through empty()/copy() can be handed to map_shared()
+    workers without pickling them; each worker attaches to the same
+    memory. All blocks are released when the context manager exits, so
+    results must be copied out before then.
+
+    Examples
+    --------
+    >>> with SharedArrays() as shared:
+    ...     counts = shared.copy(counts)
+    ...     results = map_shared(func, shared, chunks, jobs)
+    '''
+    def __init__(self):
+        self._blocks = []
+        self.specs = []
+
+    def empty(self, shape, dtype):
+        '''Uninitialised shared array'''
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._blocks.append(block)
+        self.specs.append((block.name, tuple(shape), dtype.str))
+        return np.ndarray(shape, dtype, buffer=block.buf)
+
+    def copy(self, array):
+        '''Shared copy of array'''
+        array = np.asarray(array)
+        shared = self.empty(array.shape, array.dtype)
+        shared[...] = array
+        return shared
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks, self.specs = [], []
+
+
+def _attach(specs):
+    '''Attaches a worker to the blocks described by SharedArrays.specs'''
+    blocks, arrays = [], []
+    for name, shape, dtype in specs:
+        try:
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13: pool workers share the parent's resource
+            # tracker, so attaching registers nothing new
+            block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays.append(np.ndarray(shape, np.dtype(dtype), buffer=block.buf))
+    return blocks, arrays
+
+
+def _call_shared(func, specs, chunk, args):
+    blocks, arrays = _attach(specs)
+    try:
+        return func(*arrays, chunk, *args)
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+
+
+def map_shared(func, shared, chunks, jobs, *args):
+    '''Runs func(*shared_arrays, chunk, *args) for every chunk on a pool
+        of jobs worker processes
+
+    Parameters
+    ----------
+    func: callable
+        Module level function (it is sent to the workers by reference).
+    shared: SharedArrays
+        Arrays passed to func, in creation order. Workers may write into
+        them.
+    chunks: list
+        One work item per call, e.g. arrays of column indices.
+    jobs: int
+        Number of worker processes.
+
+    Returns
+    -------
+    results: list
+        Return values of func, in the order of chunks.
+    '''
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(_call_shared, repeat(func), repeat(shared.specs),
+                             chunks, repeat(args)))
+
+
+def split_columns(n_columns, jobs):
+    '''Splits range(n_columns) into contiguous chunks for jobs workers;
+        a few chunks per worker keep the pool balanced'''
+    n_chunks = max(min(n_columns, 4 * jobs), 1)
+    return np.array_split(np.arange(n_columns), n_chunks)
+
+
+def resolve_jobs(jobs):
+    '''Number of worker processes; 0 or negative values count back from
+        the number of CPUs (0 = all CPUs)'''
+    jobs = int(jobs)
+    if jobs <= 0:
+        jobs = max((os.cpu_count() or 1) + jobs, 1)
+    return jobs
@@ -1,63 +1,237 @@
-import os
-import pandas as pd
+import sys
 import numpy as np
-from matplotlib import pyplot
 from math import log10
-from statsmodels.stats.proportion import proportion_confint
-from scipy.stats import beta
-from lmfit import fit_report
+from matplotlib import rcParams
+from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from comad.neufit_utils import neutral_curve
+from comad.profiling import stage
 
-def beta_cdf(p, N, m):
-    # Expected long term distribution under the neutral model (truncated cumulative beta-distribution)
-    return beta.cdf(1.0, N*m*p, N*m*(1.0-p)) - beta.cdf(1.0/N, N*m*p, N*m*(1.0-p))
+# Above this many OTUs the scatter is rasterized inside the vector pdf,
+# above DENSITY_ABOVE it is drawn as a (log count) hexbin density
+RASTERIZE_ABOVE = 10000
+DENSITY_ABOVE = 200000
+
+HP_LABEL = 'k__Bacteria;p__Proteobacteria;c__Epsilonproteobacteria;o__Campylobacterales;f__Helicobacteraceae;g__Helicobacter;s__Helicobacter pylori'
+
+
+def interactive_session():
+    '''True inside IPython/Jupyter, where plots are shown by default'''
+    ipython = sys.modules.get('IPython')
+    return ipython is not None and ipython.get_ipython() is not None
+
+
+def neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square, save_plot,
+                HP_color, show=None, rasterize_above=RASTERIZE_ABOVE,
+                density_above=DENSITY_ABOVE):
+    '''Plots occurrence against mean relative abundance with the fitted
+        neutral curve and its 95% confidence interval
+
+    The figure is drawn on its own Agg canvas, without pyplot's global
+    state, so plots can be made in parallel worker processes or threads.
+
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+        As returned by neufit().
+    beta_fit: NeutralFit or lmfit.model.ModelResult object
+        m is read from beta_fit.best_values.
+    n_samples, n_reads: int
+    r_square: float
+    save_plot: str or False
+        Path prefix of the [save_plot].pdf plot and [save_plot].tsv table;
+        False saves nothing.
+    HP_color: bool
+        Highlights Helicobacter pylori (HP_LABEL) in magenta when it is in
+        occurr_freqs.
+    show: bool, optional
+        Display the plot. Default (None) only shows it in IPython/Jupyter
+        sessions, never in scripts, batch runs or workers.
+    rasterize_above, density_above: int, optional
+        OTU counts above which the scatter is rasterized, or replaced by a
+        hexbin density, to keep large pdfs small and quick to render.
+
+    Returns
+    -------
+    fig: matplotlib.figure.Figure
+    '''
+    with stage('plot', n_otus=len(occurr_freqs)):
+        return _neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads,
+                            r_square, save_plot, HP_color, show,
+                            rasterize_above, density_above)
+
+
+def _new_figure(show, **kws):
+    # pyplot figure for interactive plots, otherwise a figure on its own
+    # Agg canvas (no global state, safe in workers and threads)
+    if show:
+        from matplotlib import pyplot
+        return pyplot.figure(**kws)
+    fig = Figure(**kws)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square, save_plot,
+                 HP_color, show, rasterize_above, density_above):
 
-def neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square, save_plot, HP_color):
-    
     #Taken from : https://github.com/cguccione/neufit_gillespie_pipeline/blob/main/Fig4_selectionPlotting.ipynb#enroll-beta
-    
-    pyplot.cla() #Clears previous plot - to avoid double keys
 
+    if show is None:
+        show = interactive_session()
+    fig = _new_figure(show)
+    ax = fig.add_subplot()
+    _draw_neufit(ax, occurr_freqs, beta_fit, n_samples, n_reads, r_square,
+                 HP_color, rasterize_above, density_above)
+
+    if save_plot != False:
+        #Save plot
+        fig.tight_layout()
+        fig.savefig(save_plot + '.pdf', dpi=200)
+
+        #Save df
+        occurr_freqs.to_csv(save_plot + '.tsv', sep='\t')
+
+    if show:
+        from matplotlib import pyplot
+        pyplot.show()
+    return fig
+
+
+def _draw_neufit(ax, occurr_freqs, beta_fit, n_samples, n_reads, r_square,
+                 HP_color, rasterize_above, density_above, x_min=None,
+                 fontsize=16):
+    # One neufit panel: data points, fitted curve, confidence interval
+    # and the m/R^2 labels
+    
     #Prepare results plot
-    pyplot.xlabel('Mean relative abundance across samples', fontsize=18)
-    pyplot.xscale('log')
-    x_range = np.logspace(log10(min(occurr_freqs['mean_abundance'])/10), 0, 1000)
-    pyplot.xlim(min(x_range), max(x_range))
-    pyplot.xticks(fontsize=16)
-    pyplot.ylabel('Occurrence frequency in samples', fontsize=18)
-    pyplot.ylim(-0.05, 1.05)
-    pyplot.yticks(fontsize=16)
+    ax.set_xlabel('Mean relative abundance across samples', fontsize=fontsize + 2)
+    ax.set_xscale('log')
+    if x_min is None:
+        x_min = min(occurr_freqs['mean_abundance'])/10
+    x_range = np.logspace(log10(x_min), 0, 1000)
+    ax.set_xlim(min(x_range), max(x_range))
+    ax.tick_params(labelsize=fontsize)
+    ax.set_ylabel('Occurrence frequency in samples', fontsize=fontsize + 2)
+    ax.set_ylim(-0.05, 1.05)
 
     # Plot data points
-    pyplot.plot(occurr_freqs['mean_abundance'], occurr_freqs['occurrence'], 'o', markersize=6, fillstyle='full', color='black')
+    mean_abundance = occurr_freqs['mean_abundance'].to_numpy()
+    occurrence = occurr_freqs['occurrence'].to_numpy()
+    if len(occurr_freqs) > density_above:
+        #Single OTUs stay clearly visible, dense regions turn black
+        ax.hexbin(mean_abundance, occurrence, xscale='log', gridsize=150,
+                  norm=LogNorm(vmin=0.05), mincnt=1, cmap='Greys', zorder=2,
+                  extent=(log10(min(x_range)), 0, -0.05, 1.05))
+    else:
+        ax.plot(mean_abundance, occurrence, 'o', markersize=6, fillstyle='full',
+                color='black', rasterized=len(occurr_freqs) > rasterize_above)
 
-    #>>Calculate lower and upper range
-    lower, upper = proportion_confint(beta_cdf(x_range, n_reads, beta_fit.best_values['m'])*n_samples, n_samples, alpha=0.05, method='wilson')
+    #>>Calculate the main fit line and lower and upper range (one cached
+    #  evaluation of the neutral curve, shared with the fit)
+    m = beta_fit.best_values['m']
+    curve = neutral_curve(n_reads, m)
+    predicted, lower, upper = curve.confint(x_range, n_samples)
 
-    #>>Calculate/plot the main fit line
+    #>>Plot the main fit line
     #Orginal plotting colors
-    pyplot.plot(x_range, beta_cdf(x_range, n_reads, beta_fit.best_values['m']), '-', lw=5, color='darkred')
-    pyplot.plot(x_range, lower, '--', lw=2, color='darkred')
-    pyplot.plot(x_range, upper, '--', lw=2, color='darkred')
-    pyplot.fill_between(x_range, lower, upper, color='lightgrey')
-
-    #Extract m value
-    m = fit_report(beta_fit).split('(fixed)')[1]
-    m = 'm = ' + str(round(float(m.strip('\n').split('+')[0].strip(' ').strip('m: ')),3))
+    ax.plot(x_range, predicted, '-', lw=5, color='darkred')
+    ax.plot(x_range, lower, '--', lw=2, color='darkred')
+    ax.plot(x_range, upper, '--', lw=2, color='darkred')
+    ax.fill_between(x_range, lower, upper, color='lightgrey')
 
     #Plot R^2 and m values
-    pyplot.text(0.05, 0.9, m, fontsize=16, transform=pyplot.gca().transAxes)
-    pyplot.text(0.05, 0.8, '$R^2 = ' + '{:1.2f}'.format(r_square) + '$', fontsize=16, transform=pyplot.gca().transAxes)
-    
+    ax.text(0.05, 0.9, 'm = ' + str(round(float(m), 3)), fontsize=fontsize,
+            transform=ax.transAxes)
+    ax.text(0.05, 0.8, '$R^2 = ' + '{:1.2f}'.format(r_square) + '$', fontsize=fontsize,
+            transform=ax.transAxes)
+
     if HP_color != False:
-        hp_occurr_freqs = occurr_freqs.loc['k__Bacteria;p__Proteobacteria;c__Epsilonproteobacteria;o__Campylobacterales;f__Helicobacteraceae;g__Helicobacter;s__Helicobacter pylori' , :]
-        pyplot.plot(hp_occurr_freqs['mean_abundance'], hp_occurr_freqs['occurrence'], 'o', markersize=6, fillstyle='full', color='magenta')
-    
-    if save_plot != False:
-        #Save plot
-        pyplot.tight_layout()
-        pyplot.savefig(save_plot + '.pdf')
-        
-        #Save df
-        occurr_freqs.to_csv(save_plot + '.tsv', sep='\t')
+        if HP_LABEL in occurr_freqs.index:
+            hp_occurr_freqs = occurr_freqs.loc[[HP_LABEL], :]
+            ax.plot(hp_occurr_freqs['mean_abundance'], hp_occurr_freqs['occurrence'],
+                    'o', markersize=6, fillstyle='full', color='magenta')
+        else:
+            print('Helicobacter pylori not found, not highlighted')
+
+
+def neufit_group_plot(group_results, save_plot, HP_color=False, show=None,
+                      overlay=False, rasterize_above=RASTERIZE_ABOVE,
+                      density_above=DENSITY_ABOVE):
+    '''Compares the neutral fits of several sample groups, one panel per 
+        group or overlaid in one panel
+
+    Parameters
+    ----------
+    group_results: dict
+        Group name -> (occurr_freqs, n_reads, n_samples, r_square, 
+        beta_fit), as returned by neufit_groups().
+    save_plot: str or False
+        Path prefix of the [save_plot]_groups.pdf plot; False saves 
+        nothing.
+    HP_color: bool, optional
+        Highlights Helicobacter pylori in every panel (facets only).
+    show: bool, optional
+        See neufit_plot().
+    overlay: bool, optional
+        Draw all groups in one panel, each in its own color, instead of 
+        one panel per group. Default is False.
+    rasterize_above, density_above: int, optional
+        See neufit_plot().
+
+    Returns
+    -------
+    fig: matplotlib.figure.Figure
+    '''
+    with stage('group_plot', n_groups=len(group_results)):
+        if show is None:
+            show = interactive_session()
+        x_min = min(min(results[0]['mean_abundance'])
+                    for results in group_results.values())/10
+        if overlay:
+            fig = _new_figure(show, figsize=(8, 6))
+            _overlay_groups(fig.add_subplot(), group_results, x_min,
+                            rasterize_above)
+        else:
+            n_columns = min(len(group_results), 3)
+            n_rows = -(-len(group_results) // n_columns)
+            fig = _new_figure(show, figsize=(6 * n_columns, 5 * n_rows))
+            for i, (group, results) in enumerate(group_results.items()):
+                occurr_freqs, n_reads, n_samples, r_square, beta_fit = results
+                ax = fig.add_subplot(n_rows, n_columns, i + 1)
+                _draw_neufit(ax, occurr_freqs, beta_fit, n_samples, n_reads,
+                             r_square, HP_color, rasterize_above, density_above,
+                             x_min, fontsize=11)
+                ax.set_title(str(group) + ' (' + str(n_samples) + ' samples)',
+                             fontsize=13)
+
+        if save_plot != False:
+            fig.tight_layout()
+            fig.savefig(save_plot + '_groups.pdf', dpi=200)
+        if show:
+            from matplotlib import pyplot
+            pyplot.show()
+        return fig
+
 
-    pyplot.show()
\ No newline at end of file
+def _overlay_groups(ax, group_results, x_min, rasterize_above):
+    # All groups in one panel: points and fitted curve in the group's color
+    x_range = np.logspace(log10(x_min), 0, 1000)
+    ax.set_xscale('log')
+    ax.set_xlim(min(x_range), max(x_range))
+    ax.set_ylim(-0.05, 1.05)
+    ax.set_xlabel('Mean relative abundance across samples', fontsize=14)
+    ax.set_ylabel('Occurrence frequency in samples', fontsize=14)
+    colors = [color['color'] for color in rcParams['axes.prop_cycle']]
+    for i, (group, results) in enumerate(group_results.items()):
+        occurr_freqs, n_reads, n_samples, r_square, beta_fit = results
+        color = colors[i % len(colors)]
+        ax.plot(occurr_freqs['mean_abundance'], occurr_freqs['occurrence'], 'o',
+                markersize=3, alpha=0.4, color=color,
+                rasterized=len(occurr_freqs) > rasterize_above)
+        m = beta_fit.best_values['m']
+        ax.plot(x_range, neutral_curve(n_reads, m)(x_range), '-', lw=3,
+                color=color, label=str(group) + ': m = ' + str(round(float(m), 3)) +
+                ', $R^2$ = ' + '{:1.2f}'.format(r_square))
+    ax.legend(fontsize=11, loc='lower right')
@@ -0,0 +1,177 @@
+import json
+import time
+import resource
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from scipy import sparse
+from comad import __version__
+
+# Profiler of the running pipeline; stage() is a no-op without one
+_active = ContextVar('comad_profiler', default=None)
+
+# Callables run with every finished stage record, e.g. to forward the
+# timings to an external metrics system
+HOOKS = []
+
+
+def register_hook(hook):
+    '''Calls hook(record) for every stage finished by any Profiler
+
+    record is the stage dict described in Profiler; hooks must not modify
+    it. Returns hook so it can be used as a decorator.
+    '''
+    HOOKS.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    '''Undoes register_hook()'''
+    HOOKS.remove(hook)
+
+
+def table_info(table):
+    '''shape and nnz of a dense or sparse count table, as stage info'''
+    info = {'shape': list(getattr(table, 'shape', ()))}
+    if sparse.issparse(table):
+        info['nnz'] = int(table.nnz)
+    elif hasattr(table, 'shape'):
+        info['nnz'] = int((table != 0).sum())
+    return info
+
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage / 1024, children / 1024
+
+
+class Profiler:
+    '''Per-stage wall time, CPU time and memory of one comad run
+
+    Stages are opened with stage() anywhere in comad while the profiler is
+    active (``with profiler:``); nested stages record their parent. Every
+    stage record is a dict with name, parent, start_s (relative to the
+    profiler), wall_s, cpu_s, peak_traced_mb (peak tracemalloc memory
+    during the stage, None if tracemalloc is off), max_rss_mb and
+    children_max_rss_mb (process lifetime maxima, the latter for worker
+    processes) plus stage specific info such as table shape and nnz.
+
+    Parameters
+    ----------
+    trace_memory: bool, optional
+        Start tracemalloc while the profiler is active (if it is not
+        already running). Python allocations are then about 2x slower.
+        Default is True.
+    hooks: list of callables, optional
+        Called with every finished stage record, in addition to the hooks
+        of register_hook().
+
+    Examples
+    --------
+    >>> with Profiler() as profiler:
+    ...     comad_pipeline(...)
+    >>> profiler.write('run_profile.json')
+    '''
+    def __init__(self, trace_memory=True, hooks=None):
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks or [])
+        self.stages = []
+        self._stack = []
+        self._started_tracing = False
+        self._token = None
+        self._start = None
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._token = _active.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _active.reset(self._token)
+        self.wall_s = time.perf_counter() - self._start
+        self.cpu_s = time.process_time() - self._start_cpu
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name, **info):
+        record = {'name': name,
+                  'parent': self._stack[-1]['name'] if self._stack else None,
+                  'start_s': time.perf_counter() - self._start}
+        record.update(info)
+        self.stages.append(record)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            #Keep the peak seen so far for the enclosing stage before
+            #resetting it for this one
+            peak = tracemalloc.get_traced_memory()[1]
+            for parent in self._stack:
+                parent['_peak'] = max(parent.get('_peak', 0), peak)
+            tracemalloc.reset_peak()
+        self._stack.append(record)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - start
+            record['cpu_s'] = time.process_time() - start_cpu
+            self._stack.pop()
+            if tracing:
+                peak = max(record.pop('_peak', 0),
+                           tracemalloc.get_traced_memory()[1])
+                record['peak_traced_mb'] = peak / 1024 ** 2
+            else:
+                record.pop('_peak', None)
+                record['peak_traced_mb'] = None
+            record['max_rss_mb'], record['children_max_rss_mb'] = _max_rss_mb()
+            for hook in self.hooks + HOOKS:
+                hook(record)
+
+    def report(self):
+        '''All stages and run totals as a json serialisable dict'''
+        max_rss_mb, children_max_rss_mb = _max_rss_mb()
+        return {'comad_version': __version__,
+                'wall_s': getattr(self, 'wall_s', None),
+                'cpu_s': getattr(self, 'cpu_s', None),
+                'max_rss_mb': max_rss_mb,
+                'children_max_rss_mb': children_max_rss_mb,
+                'stages': self.stages}
+
+    def write(self, filename):
+        '''Writes report() as json'''
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=_json_default)
+
+
+def _json_default(value):
+    # numpy scalars in stage info
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+@contextmanager
+def stage(name, table=None, **info):
+    '''Times the enclosed block as a stage of the active Profiler
+
+    table (a count matrix) adds its table_info() to the record; it is only
+    inspected while profiling. Yields the stage record (a dict) so callers
+    can add info that is only known inside the block, e.g.
+    ``record['n_otus'] = n_otus``; without an active Profiler a throwaway
+    dict is yielded and nothing is measured.
+    '''
+    profiler = _active.get()
+    if profiler is None:
+        yield {}
+    else:
+        if table is not None:
+            info.update(table_info(table))
+        with profiler.stage(name, **info) as record:
+            yield record
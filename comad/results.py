@@ -0,0 +1,138 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from comad import __version__
+from comad.utils import non_neutral_masks
+
+# Output formats of write_results() and their file suffixes
+RESULTS_SUFFIXES = {'parquet': '_results.parquet',
+                    'feather': '_results.feather'}
+
+# Key of the fit metadata in the arrow schema metadata
+METADATA_KEY = b'comad'
+
+
+def _arrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Parquet/Feather results need pyarrow '
+                          '(pip install pyarrow, or comad[parquet])')
+    return pyarrow
+
+
+def fit_metadata(beta_fit, n_reads, n_samples, r_square, threshold=0.5,
+                 attrs=None):
+    '''Fit statistics stored with the results: m (with its standard
+        error), R^2, N (the rarefaction depth), n_samples, the outlier
+        threshold and any occurr_freqs.attrs, e.g. the bootstrap interval
+        of m'''
+    m = beta_fit.params['m']
+    metadata = {'m': float(m.value),
+                'm_stderr': None if m.stderr is None else float(m.stderr),
+                'r_square': float(r_square), 'N': int(n_reads),
+                'n_samples': int(n_samples), 'threshold': threshold,
+                'comad_version': __version__}
+    for name, value in (attrs or {}).items():
+        metadata[name] = value.item() if hasattr(value, 'item') else value
+    return metadata
+
+
+def results_table(occurr_freqs, threshold=0.5):
+    '''occurr_freqs with its index as an otu_id column and the non-neutral
+        sets as flags instead of separate tables
+
+    difference is |occurrence - predicted_occurrence|; above/below mark
+    the OTUs outside the confidence interval (the rows of
+    _FullNonNeutral.csv) and outlier those with difference > threshold
+    (the rows of _NonNeutral_Outliers.csv), see non_neutral_masks().
+    '''
+    difference, above, below, outlier = non_neutral_masks(occurr_freqs, threshold)
+    table = occurr_freqs.rename_axis('otu_id').reset_index()
+    table['difference'] = difference.astype(np.float32)
+    table['above'], table['below'], table['outlier'] = above, below, outlier
+    return table
+
+
+def write_results(file_header, occurr_freqs, beta_fit, n_reads, n_samples,
+                  r_square, format='parquet', threshold=0.5,
+                  compression='zstd'):
+    '''Writes all results of a fit to one compressed columnar file
+
+    Parameters
+    ----------
+    file_header: str, path
+        Path prefix; writes [file_header]_results.parquet (or .feather).
+    occurr_freqs, n_reads, n_samples, r_square, beta_fit:
+        As returned by neufit().
+    format: str, optional
+        'parquet' (default) or 'feather' (Arrow IPC).
+    threshold: float, optional
+        See non_neutral_masks(). Default is 0.5.
+    compression: str, optional
+        Default is 'zstd'.
+
+    Returns
+    -------
+    filename: str
+    '''
+    if format not in RESULTS_SUFFIXES:
+        raise ValueError('Unknown results format ' + str(format) + ', use ' +
+                         ' or '.join(RESULTS_SUFFIXES))
+    pyarrow = _arrow()
+    metadata = fit_metadata(beta_fit, n_reads, n_samples, r_square, threshold,
+                            occurr_freqs.attrs)
+    table = pyarrow.Table.from_pandas(results_table(occurr_freqs, threshold),
+                                      preserve_index=False)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[METADATA_KEY] = json.dumps(metadata)
+    table = table.replace_schema_metadata(schema_metadata)
+    filename = str(file_header) + RESULTS_SUFFIXES[format]
+    if format == 'parquet':
+        from pyarrow import parquet
+        parquet.write_table(table, filename, compression=compression)
+    else:
+        from pyarrow import feather
+        feather.write_feather(table, filename, compression=compression)
+    return filename
+
+
+def write_results_async(*args, **kws):
+    '''Starts write_results() on a background thread, e.g. while the plot
+        is drawn
+
+    pyarrow releases the GIL while encoding and writing. Returns a
+    concurrent.futures.Future whose result() is (filename, seconds spent
+    writing); call it before reading the file or exiting.
+    '''
+    def write():
+        start = time.perf_counter()
+        return write_results(*args, **kws), time.perf_counter() - start
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(write)
+    executor.shutdown(wait=False)
+    return future
+
+
+def read_results(filename):
+    '''Results written by write_results()
+
+    Returns
+    -------
+    results: pandas df
+        Indexed by otu_id, with the occurr_freqs columns and the
+        difference/above/below/outlier flags; the fit metadata is in
+        results.attrs. The non-neutral tables are views such as
+        results[results['above'] | results['below']].
+    '''
+    _arrow()
+    if str(filename).endswith(RESULTS_SUFFIXES['feather']):
+        from pyarrow import feather
+        table = feather.read_table(filename)
+    else:
+        from pyarrow import parquet
+        table = parquet.read_table(filename)
+    results = table.to_pandas().set_index('otu_id')
+    results.attrs.update(json.loads(table.schema.metadata[METADATA_KEY]))
+    return results
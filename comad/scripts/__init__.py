@@ -17,4 +17,8 @@ def cli(ctx):
     ctx.call_on_close(_terribly_handle_brokenpipeerror)
 
 
-import_module('comad.scripts._neufit')
\ No newline at end of file
+import_module('comad.scripts._neufit')
+import_module('comad.scripts._batch')
+import_module('comad.scripts._convert')
+import_module('comad.scripts._incremental')
+import_module('comad.scripts._serve')
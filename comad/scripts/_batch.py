@@ -0,0 +1,51 @@
+import click
+from .__init__ import cli
+
+
+@cli.command(name='batch')
+@click.argument(
+    'manifest',
+    type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--jobs',
+    type=int,
+    default=1,
+    show_default=True,
+    help='Datasets processed in parallel (0 = all CPUs)')
+@click.option(
+    '--summary',
+    default=None,
+    help='Summary table path (default: [manifest]_summary.tsv)')
+@click.option(
+    '--output_folder_path',
+    default=None,
+    help='Output folder for manifest rows without an output_filepath')
+@click.option(
+    '--cache/--no-cache',
+    default=True,
+    show_default=True,
+    help='Reuse the results of identical earlier seeded runs')
+def batch(manifest : str,
+          jobs : int,
+          summary : str,
+          output_folder_path : str,
+          cache : bool):
+    '''Runs full_comad on every dataset listed in a tab separated MANIFEST
+    
+    Parameters
+    ----------
+    manifest: str
+        One row per dataset with input_filename and output_filename
+        columns, plus optional output_filepath and comad_pipeline()
+        arguments (arg_rarefaction_level, arg_ignore_level, seed, sparse,
+        jobs, rarefaction_iterations, bootstrap, ...).
+    '''
+    from comad.batch import run_batch
+    results = run_batch(manifest, jobs=jobs, summary_filename=summary,
+                        output_filepath=output_folder_path, cache=cache)
+    failed = results[results['status'] != 'ok']
+    for _, row in failed.iterrows():
+        click.echo('failed: ' + row['output_filename'] + ': ' + str(row['error']),
+                   err=True)
+    click.echo(str(len(results) - len(failed)) + '/' + str(len(results)) +
+               ' datasets fitted')
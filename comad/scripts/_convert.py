@@ -0,0 +1,42 @@
+import click
+from .__init__ import cli
+
+
+@cli.command(name='convert')
+@click.argument(
+    'input_filename',
+    type=click.Path(exists=True, dir_okay=False))
+@click.argument(
+    'output_filename',
+    required=False,
+    default=None)
+@click.option(
+    '--sparse/--dense',
+    default=None,
+    help='Store a CSC matrix or dense counts (default: sparse for biom, '
+         'dense for tsv)')
+@click.option(
+    '--taxonomy',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='[]_taxonomy.csv file to store with the counts')
+def convert(input_filename : str,
+            output_filename : str,
+            sparse : bool,
+            taxonomy : str):
+    '''Converts a tsv or biom INPUT_FILENAME once into a memory-mapped
+    .comad folder (OUTPUT_FILENAME, default [input].comad) that full_comad
+    opens without parsing
+
+    Parameters
+    ----------
+    input_filename: str
+        .tsv or .biom table.
+    '''
+    from comad.columnar import convert_table, read_meta
+    output_filename = convert_table(input_filename, output_filename, sparse,
+                                    taxonomy)
+    meta = read_meta(output_filename)
+    click.echo(output_filename + ': ' + str(meta['shape'][0]) + ' otus x ' +
+               str(meta['shape'][1]) + ' samples, ' + str(meta['nnz']) +
+               ' non-zero entries (' + meta['layout'] + ')')
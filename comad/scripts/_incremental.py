@@ -0,0 +1,115 @@
+import os
+import click
+from .__init__ import cli
+
+
+@cli.command(name='update')
+@click.argument(
+    'state_filename',
+    type=click.Path(dir_okay=False))
+@click.option(
+    '--biom',
+    default=None,
+    help='Batch of new samples (.biom, .tsv or .comad table)')
+@click.option(
+    '--output_filename',
+    required=True,
+    help='Name/nickname of the dataset, used in the output file names')
+@click.option(
+    '--output_folder_path',
+    required=True,
+    help='Folder of the outputs')
+@click.option(
+    '--remove',
+    default=None,
+    help='Samples to remove from the fit: comma separated ids or a file '
+         'with one id per line')
+@click.option(
+    '--window',
+    type=int,
+    default=None,
+    help='Only keep the last this many samples (in the order added)')
+@click.option(
+    '--rarefaction_level',
+    type=int,
+    default=0,
+    show_default=True,
+    help='Rarefaction depth of a new state (0 = lowest depth of the '
+         'first batch); must match an existing state')
+@click.option(
+    '--seed',
+    type=int,
+    default=None,
+    help='Seed of the rarefaction draws of a new state; must match an '
+         'existing state')
+@click.option(
+    '--jobs',
+    type=int,
+    default=1,
+    show_default=True,
+    help='Worker processes for rarefaction (0 = all CPUs)')
+@click.option(
+    '--taxonomy',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='[]_taxonomy.csv file joined to the results')
+def update(state_filename : str,
+           biom : str,
+           output_filename : str,
+           output_folder_path : str,
+           remove : str,
+           window : int,
+           rarefaction_level : int,
+           seed : int,
+           jobs : int,
+           taxonomy : str):
+    '''Adds a batch of samples to (or removes samples from) the saved
+    incremental fit STATE_FILENAME, created if missing, and refits m
+
+    Only the new samples are rarefied; samples already in the state keep
+    their rarefied reads.
+
+    Parameters
+    ----------
+    state_filename: str
+        Pickled comad.incremental.IncrementalFit.
+    '''
+    from comad.incremental import IncrementalFit, load_incremental
+    from comad.neufit import make_file_header
+    from comad.utils import load_abundances, read_sample_list
+    if os.path.isfile(state_filename):
+        state = load_incremental(state_filename)
+        #Depth and seed are fixed when the state is created
+        if rarefaction_level != 0 and rarefaction_level != state.depth:
+            raise click.BadParameter(str(state_filename) + ' rarefies to ' +
+                                     str(state.depth) + ' reads, not ' +
+                                     str(rarefaction_level),
+                                     param_hint='--rarefaction_level')
+        if seed is not None and seed != state.entropy:
+            raise click.BadParameter(str(state_filename) + ' was created with '
+                                     'another seed', param_hint='--seed')
+        state.jobs = jobs
+    else:
+        state = IncrementalFit(rarefaction_level, seed, jobs)
+
+    if remove is not None:
+        removed = state.remove(read_sample_list(remove))
+        click.echo('removed ' + str(len(removed)) + ' samples')
+    if biom is not None:
+        table = load_abundances(biom, sparse=True)
+        if table is None:
+            raise click.BadParameter('Invlaid file format: ' + str(biom))
+        if window is not None:
+            added, removed = state.slide(table, window)
+            click.echo('added ' + str(len(added)) + ' samples, removed the ' +
+                       str(len(removed)) + ' oldest')
+        else:
+            added = state.add(table)
+            click.echo('added ' + str(len(added)) + ' samples')
+    elif window is not None:
+        state.remove(state.sample_ids[:max(state.n_samples - window, 0)])
+    state.save(state_filename)
+
+    os.makedirs(output_folder_path, exist_ok=True)
+    file_header = make_file_header(output_folder_path, output_filename)
+    state.fit(taxonomy, output_filename, file_header)
@@ -1,9 +1,9 @@
 import os
 import click
 from .__init__ import cli
-from comad.utils import (biom2data_tax,
-                          non_neutral_outliers)
-from comad.neufit import comad_pipeline, neufit
+
+# comad.neufit and pandas are imported inside the commands so that
+# `comad --help`/`--version` and other commands start without them
 
 @cli.command(name='full_comad')
 @click.option(
@@ -18,9 +18,105 @@ from comad.neufit import comad_pipeline, neufit
     '--output_folder_path',
     required=True,
     help='TODO')
+@click.option(
+    '--sparse/--dense',
+    default=False,
+    help='Keep the biom table sparse instead of building a dense table')
+@click.option(
+    '--save-data-tax',
+    is_flag=True,
+    default=False,
+    help='Also write the intermediate data_tax_csv/ files')
+@click.option(
+    '--seed',
+    type=int,
+    default=None,
+    help='Seed of the rarefaction draws')
+@click.option(
+    '--jobs',
+    type=int,
+    default=1,
+    show_default=True,
+    help='Worker processes for rarefaction (0 = all CPUs)')
+@click.option(
+    '--rarefaction-iterations',
+    type=int,
+    default=1,
+    show_default=True,
+    help='Fit this many independent rarefactions and report m/R^2 '
+         'intervals and per OTU non-neutral call frequencies')
+@click.option(
+    '--bootstrap',
+    type=int,
+    default=0,
+    show_default=True,
+    help='Bootstrap resamples of the samples for a percentile CI of m')
+@click.option(
+    '--cache/--no-cache',
+    default=True,
+    show_default=True,
+    help='Reuse the results of an identical earlier seeded run')
+@click.option(
+    '--profile',
+    is_flag=True,
+    default=False,
+    help='Write per stage timing and memory to [output]_profile.json')
+@click.option(
+    '--chunksize',
+    type=int,
+    default=None,
+    help='Stream tsv tables from disk in chunks of this many OTU rows '
+         'instead of loading them into memory')
+@click.option(
+    '--samples',
+    default=None,
+    help='Only fit these samples: comma separated ids or a file with one '
+         'id per line')
+@click.option(
+    '--metadata',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='Sample metadata tsv for --where (default: the biom sample '
+         'metadata)')
+@click.option(
+    '--where',
+    multiple=True,
+    help='Only fit samples with this metadata, as column=value; repeat '
+         'for alternatives or further columns')
+@click.option(
+    '--group-by',
+    default=None,
+    help='Fit every group of samples of this metadata column, plus all '
+         'of them combined, and compare the fits')
+@click.option(
+    '--results-format',
+    type=click.Choice(['parquet', 'feather']),
+    default=None,
+    help='Also write all results and fit statistics to one compressed '
+         '[output]_results.parquet/.feather file (needs pyarrow)')
+@click.option(
+    '--ranks',
+    default=None,
+    help='Comma separated taxonomic ranks (e.g. genus,family,phylum, or '
+         'otu); rarefy once, sum the counts into every rank and fit each')
 def standalone_neufit(biom : str,
                       output_filename : str,
-                      output_folder_path: str):
+                      output_folder_path: str,
+                      sparse : bool,
+                      save_data_tax : bool,
+                      seed : int,
+                      jobs : int,
+                      rarefaction_iterations : int,
+                      bootstrap : int,
+                      cache : bool,
+                      profile : bool,
+                      chunksize : int,
+                      samples : str,
+                      metadata : str,
+                      where : tuple,
+                      group_by : str,
+                      results_format : str,
+                      ranks : str):
     '''Calls all functions needed to create neutral model 
     
     Written by: Caitlin Guccione, 08-25-2021
@@ -32,18 +128,28 @@ def standalone_neufit(biom : str,
         filename of all comad outputs. 
     '''
     # run within wrapper
+    from comad.neufit import comad_pipeline
     comad_pipeline(biom, output_filename,
-           output_folder_path)
+           output_folder_path, sparse=sparse, save_data_tax=save_data_tax,
+           seed=seed, jobs=jobs,
+           rarefaction_iterations=rarefaction_iterations,
+           bootstrap=bootstrap, cache=cache, profile=profile,
+           chunksize=chunksize, samples=samples, metadata=metadata,
+           where=list(where) or None, group_by=group_by,
+           results_format=results_format, ranks=ranks)
 
 
 @cli.command(name='neufit')
 @click.option(
     '--fnData',
+    'fnData',
     required=True,
     help='TODO')
 @click.option(
     '--fnTaxonomy',
-    required=True,
+    'fnTaxonomy',
+    required=False,
+    default=None,
     help='TODO')
 @click.option(
     '--output-filename',
@@ -53,10 +159,45 @@ def standalone_neufit(biom : str,
     '--output_folder_path',
     required=True,
     help='TODO')
+@click.option(
+    '--seed',
+    type=int,
+    default=None,
+    help='Seed of the rarefaction draws')
+@click.option(
+    '--jobs',
+    type=int,
+    default=1,
+    show_default=True,
+    help='Worker processes for rarefaction (0 = all CPUs)')
+@click.option(
+    '--rarefaction-iterations',
+    type=int,
+    default=1,
+    show_default=True,
+    help='Fit this many independent rarefactions and report m/R^2 '
+         'intervals and per OTU non-neutral call frequencies')
+@click.option(
+    '--bootstrap',
+    type=int,
+    default=0,
+    show_default=True,
+    help='Bootstrap resamples of the samples for a percentile CI of m')
+@click.option(
+    '--chunksize',
+    type=int,
+    default=None,
+    help='Stream tsv tables from disk in chunks of this many OTU rows '
+         'instead of loading them into memory')
 def standalone_neufit(fnData : str,
                       fnTaxonomy : str,
                       output_filename : str,
-                      output_folder_path: str):
+                      output_folder_path: str,
+                      seed : int,
+                      jobs : int,
+                      rarefaction_iterations : int,
+                      bootstrap : int,
+                      chunksize : int):
     '''Calls all functions needed to create neutral model 
     
     Written by: Caitlin Guccione, 08-25-2021
@@ -67,6 +208,28 @@ def standalone_neufit(fnData : str,
         Name/nickname of dataset (ex. 'combined'). Will be incorperated into 
         filename of all comad outputs. 
     '''
-    # run within wrapper
-    neufit(fnData, fnTaxonomy, output_filename,
-           output_folder_path)
\ No newline at end of file
+    # run within wrapper; the data file is parsed once and fitted in memory
+    import pandas as pd
+    from comad.neufit import (neufit_table, neufit_ensemble, neufit_stream,
+                              make_file_header, check_chunksize)
+    if chunksize is not None:
+        try:
+            check_chunksize(rarefaction_iterations, bootstrap, jobs)
+        except ValueError as error:
+            raise click.UsageError(str(error))
+    os.makedirs(output_folder_path, exist_ok=True)
+    file_header = make_file_header(output_folder_path, output_filename)
+    if chunksize is not None:
+        #Stream the data file instead of loading it
+        neufit_stream(fnData, fnTaxonomy, output_filename=output_filename,
+                      file_header=file_header, seed=seed, chunksize=chunksize)
+        return
+    table = pd.read_table(fnData, header=0, index_col=0, sep='\t')
+    if rarefaction_iterations > 1:
+        neufit_ensemble(table, rarefaction_iterations, fnTaxonomy,
+                        output_filename=output_filename,
+                        file_header=file_header, seed=seed, jobs=jobs)
+    else:
+        neufit_table(table, fnTaxonomy, output_filename=output_filename,
+                     file_header=file_header, seed=seed, jobs=jobs,
+                     bootstrap=bootstrap)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import json
+import click
+from .__init__ import cli
+from comad.server import DEFAULT_PORT
+
+
+@cli.command(name='serve')
+@click.option(
+    '--port',
+    type=int,
+    default=DEFAULT_PORT,
+    show_default=True,
+    help='Listen on 127.0.0.1:PORT')
+@click.option(
+    '--socket',
+    'socket_path',
+    type=click.Path(dir_okay=False),
+    default=None,
+    help='Listen on this Unix socket instead of a port')
+@click.option(
+    '--workers',
+    type=int,
+    default=1,
+    show_default=True,
+    help='Worker processes, i.e. jobs run at the same time (0 = all CPUs)')
+@click.option(
+    '--table-cache-size',
+    type=int,
+    default=None,
+    help='MiB of loaded tables kept in memory by every worker (default: '
+         '$COMAD_TABLE_CACHE_SIZE bytes or 2 GiB)')
+@click.option(
+    '--quiet',
+    is_flag=True,
+    default=False,
+    help='Do not log requests')
+def serve(port : int,
+          socket_path : str,
+          workers : int,
+          table_cache_size : int,
+          quiet : bool):
+    '''Runs a long lived local worker that accepts full_comad jobs as json
+
+    Imports happen once and loaded tables stay in memory (least recently
+    used first out), so many small jobs skip most of their start up
+    time. POST /jobs takes a job (the columns of a batch manifest) and
+    streams its progress as json lines; GET /status and GET /jobs/<id>
+    report on the server and on jobs; POST /shutdown stops it.
+
+    There is no authentication: any client that can reach the port or
+    the socket can read and write any path the server's user can. Only
+    run it on trusted machines, and prefer a --socket with restrictive
+    permissions.
+    '''
+    from comad.server import serve
+    if table_cache_size is not None:
+        table_cache_size = table_cache_size * 1024 ** 2
+    click.echo('comad serve on ' + (socket_path or '127.0.0.1:' + str(port)) +
+               ' with ' + str(workers) + ' workers', err=True)
+    serve(port, socket_path, workers, table_cache_size, quiet)
+
+
+@cli.command(name='submit')
+@click.argument(
+    'input_filename')
+@click.argument(
+    'output_filename')
+@click.argument(
+    'output_folder_path')
+@click.option(
+    '--port',
+    type=int,
+    default=DEFAULT_PORT,
+    show_default=True,
+    help='Port of `comad serve`')
+@click.option(
+    '--socket',
+    'socket_path',
+    default=None,
+    help='Unix socket of `comad serve`')
+@click.option(
+    '--param', '-p',
+    multiple=True,
+    help='Further comad_pipeline argument as name=value (manifest '
+         'columns, e.g. -p seed=1 -p sparse=true)')
+@click.option(
+    '--shutdown',
+    is_flag=True,
+    default=False,
+    help='Stop the server after the job')
+def submit(input_filename : str,
+           output_filename : str,
+           output_folder_path : str,
+           port : int,
+           socket_path : str,
+           param : tuple,
+           shutdown : bool):
+    '''Sends one full_comad job to a running `comad serve` and prints its
+    progress as json lines; exits with status 1 if the job failed
+    '''
+    from comad.server import submit, request
+    job = {'input_filename': input_filename, 'output_filename': output_filename,
+           'output_filepath': output_folder_path}
+    for assignment in param:
+        name, _, value = assignment.partition('=')
+        job[name.strip()] = value
+    status = None
+    try:
+        for event in submit(job, port, socket_path):
+            click.echo(json.dumps(event))
+            status = event['status']
+    except (OSError, ValueError) as error:
+        raise click.ClickException(str(error))
+    if shutdown:
+        request('POST', '/shutdown', port, socket_path)
+    if status != 'ok':
+        raise SystemExit(1)
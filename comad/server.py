@@ -0,0 +1,329 @@
+import os
+import json
+import queue
+import socket
+import itertools
+import multiprocessing
+import threading
+import http.client
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from comad import __version__
+
+# Default localhost port of `comad serve`
+DEFAULT_PORT = 8765
+
+# Finished jobs whose status is kept for GET /jobs/<id>
+KEEP_JOBS = 1000
+
+
+class ComadService:
+    '''Runs comad_pipeline() jobs on a pool of long lived worker
+        processes, each with warm imports and its own TableCache
+
+    Jobs are dicts with the keys of a batch manifest row (see
+    comad.batch.MANIFEST_COLUMNS), parsed with parse_job(). Every job
+    reports its progress as a sequence of events (dicts with job_id and
+    status: queued, running, then ok or failed with the run_job()
+    summary).
+
+    Jobs run in separate processes, so CPU bound jobs run side by side
+    and a job that crashes its worker only fails that job; the pool is
+    started again for the next one. A table stays cached in the worker
+    that loaded it.
+
+    Parameters
+    ----------
+    workers: int, optional
+        Jobs run at the same time, one worker process each; 0 uses all
+        CPUs. Default is 1.
+    table_cache_size: int, optional
+        Bytes of loaded tables kept in memory by every worker, see
+        comad.cache.TableCache.
+    '''
+    def __init__(self, workers=1, table_cache_size=None):
+        from comad.parallel import resolve_jobs
+        self.workers = resolve_jobs(workers)
+        self.table_cache_size = table_cache_size
+        self.processes = self._start_processes()
+        #One dispatching thread per worker process, so a job is running
+        #once its thread has picked it up
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.jobs = OrderedDict()
+        self.tables = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _start_processes(self):
+        # spawn: forking the threaded server process is not safe
+        processes = ProcessPoolExecutor(max_workers=self.workers,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_service_worker,
+                                        initargs=(self.table_cache_size,))
+        #Start the workers and their imports before the first request
+        for future in [processes.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+        return processes
+
+    def _event(self, job_id, events, event):
+        event = dict(event, job_id=job_id)
+        with self._lock:
+            self.jobs[job_id] = event
+            while len(self.jobs) > KEEP_JOBS:
+                self.jobs.popitem(last=False)
+        events.put(event)
+
+    def submit(self, job):
+        '''Queues a job; returns a queue.Queue of its events, the last one
+            has status ok or failed'''
+        from comad.batch import parse_job
+        job = parse_job(job)
+        if 'output_filepath' not in job:
+            raise ValueError('Job needs an output_filepath')
+        job_id = next(self._ids)
+        events = queue.Queue()
+        self._event(job_id, events, {'status': 'queued',
+                                     'output_filename': job['output_filename']})
+        self.pool.submit(self._run, job_id, job, events)
+        return events
+
+    def _run(self, job_id, job, events):
+        self._event(job_id, events, {'status': 'running'})
+        processes = self.processes
+        failed = {'output_filename': job['output_filename'],
+                  'input_filename': job['input_filename'], 'status': 'failed'}
+        try:
+            summary, pid, tables = processes.submit(_run_service_job, job).result()
+        except BrokenProcessPool:
+            summary = dict(failed, error='worker process died')
+            with self._lock:
+                if self.processes is processes:
+                    self.processes = self._start_processes()
+                    self.tables = {}
+        except Exception as error:
+            summary = dict(failed, error=repr(error))
+        else:
+            with self._lock:
+                self.tables[pid] = tables
+        self._event(job_id, events, _json_safe(summary))
+
+    def status(self):
+        '''Server, job and table cache status, json serialisable; the
+            table cache counts are summed over the workers'''
+        with self._lock:
+            counts = {}
+            for event in self.jobs.values():
+                counts[event['status']] = counts.get(event['status'], 0) + 1
+            tables = list(self.tables.values())
+        table_cache = {name: sum(info[name] for info in tables)
+                       for name in ('size', 'hits', 'misses')}
+        table_cache['max_size_per_worker'] = max([info['max_size'] for info in tables],
+                                                  default=None)
+        table_cache['tables'] = [table for info in tables for table in info['tables']]
+        return {'comad_version': __version__, 'pid': os.getpid(),
+                'workers': self.workers, 'jobs': counts,
+                'table_cache': table_cache}
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.processes.shutdown(wait=True)
+
+
+# TableCache of a worker process of ComadService
+_worker_tables = None
+
+
+def _init_service_worker(table_cache_size):
+    global _worker_tables
+    from comad.batch import _init_worker
+    from comad.cache import TableCache
+    _init_worker()
+    import lmfit  # noqa: F401
+    import biom  # noqa: F401
+    _worker_tables = TableCache(table_cache_size)
+
+
+def _run_service_job(job):
+    # One job in a worker process: summary, worker pid and its table cache
+    from comad.batch import run_job
+    with _worker_tables.activate():
+        summary = run_job(job)
+    return summary, os.getpid(), _worker_tables.info()
+
+
+def _json_safe(summary):
+    # numpy scalars and pandas NA of run_job() summaries
+    safe = {}
+    for name, value in summary.items():
+        if hasattr(value, 'item'):
+            value = value.item()
+        elif value is not None and not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        safe[name] = value
+    return safe
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # GET /status, GET /jobs/<id>, POST /jobs (streams ndjson events),
+    # POST /shutdown
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def _send_json(self, code, body):
+        data = (json.dumps(body) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/status':
+            return self._send_json(200, service.status())
+        if self.path.startswith('/jobs/'):
+            try:
+                job_id = int(self.path[len('/jobs/'):])
+            except ValueError:
+                job_id = None
+            with service._lock:
+                event = service.jobs.get(job_id)
+            if event is None:
+                return self._send_json(404, {'error': 'unknown job ' + self.path[6:]})
+            return self._send_json(200, event)
+        self._send_json(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path == '/shutdown':
+            self._send_json(200, {'status': 'shutting down'})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        if self.path != '/jobs':
+            return self._send_json(404, {'error': 'unknown path ' + self.path})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            events = self.server.service.submit(json.loads(self.rfile.read(length)))
+        except (ValueError, KeyError, TypeError) as error:
+            return self._send_json(400, {'error': str(error)})
+
+        #One json line per event, flushed as it happens; the connection
+        #closes after the final event
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        while True:
+            event = events.get()
+            try:
+                self.wfile.write((json.dumps(event) + '\n').encode())
+                self.wfile.flush()
+            except OSError:
+                #Client went away, the job still finishes
+                return
+            if event['status'] not in ('queued', 'running'):
+                return
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, port=DEFAULT_PORT, socket_path=None, quiet=False):
+    '''HTTP server of service on 127.0.0.1:port, or on the Unix socket
+        socket_path (replaced if it exists)'''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        server.daemon_threads = True
+    server.service, server.quiet = service, quiet
+    return server
+
+
+def serve(port=DEFAULT_PORT, socket_path=None, workers=1,
+          table_cache_size=None, quiet=False):
+    '''Runs `comad serve` until interrupted or POST /shutdown'''
+    service = ComadService(workers, table_cache_size)
+    server = make_server(service, port, socket_path, quiet)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _connection(port=DEFAULT_PORT, socket_path=None, timeout=None):
+    if socket_path is not None:
+        return _UnixHTTPConnection(socket_path, timeout)
+    return http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+
+
+def request(method, path, port=DEFAULT_PORT, socket_path=None):
+    '''One json request to a running `comad serve`'''
+    connection = _connection(port, socket_path)
+    try:
+        connection.request(method, path)
+        response = connection.getresponse()
+        body = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise ValueError(body.get('error', 'HTTP ' + str(response.status)))
+    return body
+
+
+def submit(job, port=DEFAULT_PORT, socket_path=None):
+    '''Submits a job to a running `comad serve` and yields its events as
+        they arrive
+
+    Only the standard library is imported, so clients start quickly.
+    Relative input_filename, output_filepath and metadata paths are made
+    absolute, as the server may run in another folder.
+    '''
+    job = dict(job)
+    for name in ('input_filename', 'output_filepath', 'metadata'):
+        if job.get(name) is not None:
+            job[name] = os.path.abspath(job[name])
+    if isinstance(job.get('samples'), str) and os.path.isfile(job['samples']):
+        job['samples'] = os.path.abspath(job['samples'])
+
+    connection = _connection(port, socket_path)
+    try:
+        connection.request('POST', '/jobs', body=json.dumps(job),
+                           headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        if response.status != 200:
+            raise ValueError(json.loads(response.read()).get('error'))
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        connection.close()
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+from comad.neufit_utils import rarefy_sample
+
+# Default number of OTU rows held in memory at a time
+CHUNKSIZE = 10000
+
+
+def tsv_sample_ids(tsv_filename):
+    '''Sample ids (header row) of a tsv table'''
+    return pd.read_csv(tsv_filename, sep='\t', index_col=0, nrows=0).columns.to_numpy()
+
+
+def read_tsv_chunks(tsv_filename, chunksize=CHUNKSIZE):
+    '''Yields (otu_ids, counts) for every chunksize OTU rows of a tsv table
+        with OTUs as rows and samples as columns'''
+    for chunk in pd.read_csv(tsv_filename, sep='\t', index_col=0,
+                             chunksize=chunksize):
+        yield chunk.index.to_numpy(), chunk.to_numpy().astype(np.int64)
+
+
+def scan_tsv(tsv_filename, arg_ignore_level=0, chunksize=CHUNKSIZE):
+    '''First pass over a tsv table: reads per sample, counting only the
+        OTUs above the ignore level
+
+    Parameters
+    ----------
+    tsv_filename: str, path
+        Tab separated table, OTUs as rows and samples as columns.
+    arg_ignore_level: int, optional
+        OTUs with this many reads or fewer are ignored. Default is 0.
+    chunksize: int, optional
+        OTU rows held in memory at a time.
+
+    Returns
+    -------
+    sample_ids: numpy array
+    sample_reads: numpy array
+        Reads per sample.
+    n_otus: int
+        Number of OTUs above the ignore level.
+    '''
+    sample_ids = tsv_sample_ids(tsv_filename)
+    sample_reads = np.zeros(len(sample_ids), dtype=np.int64)
+    n_otus = 0
+    for otu_ids, counts in read_tsv_chunks(tsv_filename, chunksize):
+        counts = counts[counts.sum(1) > arg_ignore_level]
+        sample_reads += counts.sum(0)
+        n_otus += counts.shape[0]
+    return sample_ids, sample_reads, n_otus
+
+
+def stream_occurrence_frequencies(tsv_filename, sample_reads, depth,
+                                  sample_ids=None, arg_ignore_level=0,
+                                  seed=None, chunksize=CHUNKSIZE):
+    '''Second pass over a tsv table: rarefies every sample to depth chunk
+        by chunk and accumulates the per OTU read sums and occurrences
+
+    Rarefying sample j draws depth of its sample_reads[j] reads without
+    replacement. Chunk by chunk this is a hypergeometric draw of how many
+    of the remaining draws fall in the chunk (given the reads still left
+    in later chunks), followed by rarefy_sample() within the chunk, which
+    gives exactly the distribution of rarefying the whole table at once.
+    Memory is bounded by chunksize plus two numbers per OTU. Results are
+    reproducible for a given seed and chunksize but differ from rarefy().
+
+    Parameters
+    ----------
+    tsv_filename: str, path
+    sample_reads: numpy array
+        Reads per sample, from scan_tsv() with the same arg_ignore_level.
+    depth: int
+        Rarefaction depth; samples with fewer reads are dropped.
+    sample_ids: array-like, optional
+        Sample names, only used for reporting dropped samples.
+    arg_ignore_level: int, optional
+    seed: int or numpy.random.Generator, optional
+    chunksize: int, optional
+
+    Returns
+    -------
+    occurr_freqs: pandas df
+        Same as occurrence_frequencies() of the rarefied table: otu_id,
+        mean_abundance, occurrence, sorted by mean_abundance; OTUs without
+        reads after rarefaction are left out.
+    keep: numpy array of bool
+        Samples with at least depth reads.
+    '''
+    rng = np.random.default_rng(seed)
+    keep = sample_reads >= depth
+    if sample_ids is None:
+        sample_ids = np.arange(len(sample_reads)).astype(str)
+    for sample, reads in zip(np.asarray(sample_ids)[~keep], sample_reads[~keep]):
+        print('dropping sample ' + str(sample) + ' with ' + str(reads) + ' reads < ' + str(depth))
+    n_samples = int(keep.sum())
+    remaining_reads = sample_reads[keep].astype(np.int64)
+    remaining_draws = np.full(n_samples, depth, dtype=np.int64)
+
+    ids, sums, occurrences = [], [], []
+    for otu_ids, counts in read_tsv_chunks(tsv_filename, chunksize):
+        rows = counts.sum(1) > arg_ignore_level
+        counts, otu_ids = counts[rows][:, keep], otu_ids[rows]
+        if counts.shape[0] == 0:
+            continue
+
+        #Reads drawn from this chunk, given the reads left in later chunks
+        chunk_reads = counts.sum(0)
+        drawn = rng.hypergeometric(chunk_reads, remaining_reads - chunk_reads,
+                                   remaining_draws)
+        remaining_reads -= chunk_reads
+        remaining_draws -= drawn
+
+        rarefied = np.zeros_like(counts)
+        for j in np.flatnonzero(drawn):
+            nonzero = np.flatnonzero(counts[:, j])
+            rarefied[nonzero, j] = rarefy_sample(counts[nonzero, j], drawn[j], rng)
+        ids.append(otu_ids)
+        sums.append(rarefied.sum(1))
+        occurrences.append(np.count_nonzero(rarefied, axis=1))
+
+    if ids:
+        otu_ids, otu_sums = np.concatenate(ids), np.concatenate(sums)
+        occurrence = np.concatenate(occurrences)
+    else:
+        otu_ids, otu_sums, occurrence = np.array([]), np.array([]), np.array([])
+    present = otu_sums > 0
+
+    occurr_freqs = pd.DataFrame({'mean_abundance':
+                                 (1.0*otu_sums[present])/depth/n_samples},
+                                index=otu_ids[present])
+    occurr_freqs.index.name = 'otu_id'
+    occurr_freqs['occurrence'] = (1.0*occurrence[present])/n_samples
+    return occurr_freqs.sort_values(by=['mean_abundance']), keep
+
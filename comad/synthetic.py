@@ -0,0 +1,200 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import brentq
+from scipy.stats import nbinom
+from comad.neufit_utils import neutral_curve
+
+
+def _zero_probability(a, prob):
+    # P(count = 0) of a negative binomial with shape a
+    return np.exp(a * np.log(prob))
+
+
+def metacommunity(n_otus, depth, m, sparsity=None, sigma=2.0, rng=None):
+    '''Lognormal metacommunity relative abundances p of n_otus OTUs
+
+    Parameters
+    ----------
+    n_otus: int
+    depth: int
+        Reads per sample (the community size N).
+    m: float
+        Immigration probability.
+    sparsity: float, optional
+        Target expected fraction of zero entries of the table, i.e. one 
+        minus the mean neutral occurrence. The spread sigma is solved for; 
+        the least sparse table possible has all p equal. Default uses 
+        sigma.
+    sigma: float, optional
+        Standard deviation of log(p). Default is 2.0.
+    rng: numpy.random.Generator, optional
+
+    Returns
+    -------
+    p: numpy array
+        Relative abundances summing to 1.
+    '''
+    rng = np.random.default_rng(rng)
+    z = rng.standard_normal(n_otus)
+    curve = neutral_curve(depth, m)
+
+    def relative_abundances(sigma):
+        log_p = sigma * z
+        p = np.exp(log_p - log_p.max())
+        return p / p.sum()
+
+    if sparsity is not None:
+        def excess(sigma):
+            return 1.0 - np.mean(curve(relative_abundances(sigma))) - sparsity
+        if excess(0.0) > 0:
+            raise ValueError('sparsity ' + str(sparsity) + ' is below the ' +
+                             'minimum of ' + str(excess(0.0) + sparsity) +
+                             ' for this number of OTUs, depth and m')
+        if excess(30.0) < 0:
+            raise ValueError('sparsity ' + str(sparsity) + ' is too high')
+        sigma = brentq(excess, 0.0, 30.0, xtol=1e-4)
+    return relative_abundances(sigma)
+
+
+def _bernoulli_positions(q, n, rng):
+    '''Rows and columns of the successes of independent Bernoulli(q_i)
+        trials in n columns, drawn with geometric gaps so the cost scales
+        with the number of successes'''
+    rows, columns = [], []
+    last = np.full(len(q), -1, dtype=np.int64)
+    active = np.flatnonzero(q > 0)
+    while active.size:
+        q_active = q[active]
+        expected = (n - 1 - last[active]) * q_active
+        draws = np.ceil(expected + 5 * np.sqrt(expected) + 2).astype(np.int64)
+        ends = np.cumsum(draws)
+        gaps = rng.geometric(np.repeat(q_active, draws))
+        positions = np.cumsum(gaps)
+        #Restart the cumulative sum at the start of every OTU's segment
+        offsets = np.concatenate(([0], positions[ends[:-1] - 1]))
+        positions += np.repeat(last[active] - offsets, draws)
+        keep = positions < n
+        rows.append(np.repeat(active, draws)[keep])
+        columns.append(positions[keep])
+        #OTUs whose gaps did not reach the last column need more draws
+        last[active] = positions[ends - 1]
+        active = active[last[active] < n - 1]
+    return np.concatenate(rows), np.concatenate(columns)
+
+
+def _truncated_negative_binomial(a, prob, rng, max_steps=200):
+    '''Negative binomial draws (shape a, probability prob) conditioned on
+        being positive'''
+    counts = np.zeros(len(a), dtype=np.int64)
+    zero_probability = _zero_probability(a, prob)
+
+    #Frequent OTUs: redraw the rare zeros
+    redraw = np.flatnonzero(zero_probability < 0.5)
+    while redraw.size:
+        counts[redraw] = rng.negative_binomial(a[redraw], prob)
+        redraw = redraw[counts[redraw] == 0]
+
+    #Rare OTUs: inverse cdf over k >= 1, the mass above zero is tiny
+    rare = np.flatnonzero(zero_probability >= 0.5)
+    a_rare = a[rare]
+    target = rng.random(len(rare)) * -np.expm1(a_rare * np.log(prob))
+    pmf = a_rare * np.exp(a_rare * np.log(prob)) * (1 - prob)
+    cdf = pmf.copy()
+    k, active = 1, np.arange(len(rare))
+    while active.size and k <= max_steps:
+        done = cdf[active] >= target[active]
+        counts[rare[active[done]]] = k
+        active = active[~done]
+        pmf[active] *= (k + a_rare[active]) / (k + 1) * (1 - prob)
+        cdf[active] += pmf[active]
+        k += 1
+    if active.size:
+        #Long tails: exact but slower scipy quantile
+        counts[rare[active]] = nbinom.isf(target[active], a_rare[active], prob)
+    return counts
+
+
+def neutral_table(n_otus, n_samples, depth, m=0.1, sparsity=None,
+                  sigma=2.0, seed=None, dense=False):
+    '''Synthetic OTU table drawn from the neutral community model
+
+    Each OTU i gets a metacommunity relative abundance p_i (see 
+    metacommunity()) and occurs in every sample independently with the 
+    neutral model's occurrence probability for N = depth, so fitting the 
+    table with neufit recovers m. Present OTUs get one read plus a 
+    multinomial share of the remaining reads, weighted by negative 
+    binomial (gamma-Poisson) draws of their local abundance; every sample 
+    has exactly depth reads and needs no rarefaction. Only the non-zero 
+    entries are drawn, so the cost scales with nnz and 10^6 OTUs x 10^4 
+    samples tables can be generated as long as they are sparse.
+
+    Parameters
+    ----------
+    n_otus: int
+        Number of OTUs (rows). OTUs that never occur are kept.
+    n_samples: int
+        Number of samples (columns).
+    depth: int
+        Reads per sample.
+    m: float, optional
+        Immigration probability. Default is 0.1.
+    sparsity: float, optional
+        Target expected fraction of zero entries, see metacommunity().
+    sigma: float, optional
+        Spread of log(p) when sparsity is not given. Default is 2.0.
+    seed: int or numpy.random.Generator, optional
+    dense: bool, optional
+        Return a pandas df instead of the sparse tuple. Default is False.
+
+    Returns
+    -------
+    (counts, otu_ids, sample_ids): tuple
+        counts is a scipy.sparse.csc_matrix with OTUs as rows, as 
+        returned by biom2sparse(); or a pandas df if dense is True.
+    '''
+    rng = np.random.default_rng(seed)
+    p = metacommunity(n_otus, depth, m, sparsity, sigma, rng)
+    a = depth * m * p
+    prob = m / (1.0 + m)
+
+    #Presence/absence with the neutral occurrence probabilities
+    rows, columns = _bernoulli_positions(neutral_curve(depth, m)(p),
+                                         n_samples, rng)
+    weights = _truncated_negative_binomial(a[rows], prob, rng)
+    counts = sparse.csc_matrix((weights, (rows, columns)),
+                               shape=(n_otus, n_samples))
+    counts.sort_indices()
+
+    #Spread each sample's depth over its present OTUs
+    for j in range(n_samples):
+        start, end = counts.indptr[j], counts.indptr[j + 1]
+        if start == end:
+            continue
+        weights = counts.data[start:end]
+        extra = max(depth - (end - start), 0)
+        counts.data[start:end] = 1 + rng.multinomial(extra, weights / weights.sum())
+
+    otu_ids = np.array(['otu' + str(i) for i in range(n_otus)])
+    sample_ids = np.array(['sample' + str(j) for j in range(n_samples)])
+    if dense:
+        return pd.DataFrame(counts.toarray(), otu_ids, sample_ids)
+    return counts, otu_ids, sample_ids
+
+
+def write_biom(table, filename):
+    '''Writes a (counts, otu_ids, sample_ids) tuple as an HDF5 biom file'''
+    from biom import Table
+    from biom.util import biom_open
+    counts, otu_ids, sample_ids = table
+    with biom_open(filename, 'w') as f:
+        Table(counts, otu_ids, sample_ids).to_hdf5(f, 'comad synthetic')
+
+
+def write_tsv(table, filename):
+    '''Writes a (counts, otu_ids, sample_ids) tuple or pandas df as a tsv
+        table readable by load_abundances()'''
+    if isinstance(table, tuple):
+        counts, otu_ids, sample_ids = table
+        table = pd.DataFrame(counts.toarray(), otu_ids, sample_ids)
+    table.to_csv(filename, sep='\t')
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Taxonomic ranks of a k__;p__;c__;o__;f__;g__;s__ lineage, in order
+RANKS = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+RANK_PREFIXES = ['k__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__']
+
+# Pseudo rank of the features themselves (no aggregation)
+OTU_RANK = 'OTU'
+
+
+def parse_ranks(ranks):
+    '''Rank names from a comma separated string or a list, e.g.
+        'genus,family,phylum'; case insensitive, 'otu' is the features
+        themselves
+
+    Returns
+    -------
+    ranks: list of str
+        Names in RANKS (or OTU_RANK), in the given order.
+    '''
+    if isinstance(ranks, str):
+        ranks = ranks.split(',')
+    names = {rank.lower(): rank for rank in RANKS + [OTU_RANK]}
+    names['domain'] = 'Kingdom'
+    parsed = []
+    for rank in ranks:
+        rank = rank.strip()
+        if rank == '':
+            continue
+        if rank.lower() not in names:
+            raise ValueError('Unknown rank ' + rank + ', use ' +
+                             ', '.join(RANKS + [OTU_RANK]))
+        if names[rank.lower()] not in parsed:
+            parsed.append(names[rank.lower()])
+    if not parsed:
+        raise ValueError('No ranks given')
+    return parsed
+
+
+def lineage_table(lineages, otu_ids):
+    '''One column per rank of RANKS from lineage strings or lists
+
+    Parameters
+    ----------
+    lineages: pandas Series, df or list
+        'k__Bacteria; p__Firmicutes; ...' strings or lists of levels, one
+        per OTU (a Series is aligned to otu_ids by its index), or a df of
+        levels with one column per rank.
+    otu_ids: array-like
+
+    Returns
+    -------
+    levels: pandas df
+        Indexed by otu_ids (as str), columns RANKS; missing or empty levels
+        are the bare prefix ('g__'), i.e. unassigned at that rank.
+    '''
+    otu_ids = pd.Index(np.asarray(otu_ids).astype(str))
+    if isinstance(lineages, pd.DataFrame):
+        lineages = lineages.copy()
+        lineages.index = lineages.index.astype(str)
+        rows = lineages.reindex(otu_ids).to_numpy(dtype=object).tolist()
+    else:
+        if isinstance(lineages, pd.Series):
+            lineages = lineages.copy()
+            lineages.index = lineages.index.astype(str)
+            lineages = lineages.reindex(otu_ids)
+        rows = list(lineages)
+    levels = []
+    for row in rows:
+        if isinstance(row, str):
+            row = row.split(';')
+        elif not isinstance(row, (list, tuple, np.ndarray)):
+            row = []
+        row = [level.strip() if isinstance(level, str) else '' for level in row]
+        row = (row + [''] * len(RANKS))[:len(RANKS)]
+        levels.append([level if level not in ('', prefix[:1]) else prefix
+                       for level, prefix in zip(row, RANK_PREFIXES)])
+    return pd.DataFrame(levels, index=otu_ids, columns=RANKS)
+
+
+def encode_lineages(levels):
+    '''Integer codes of every OTU's taxon at every rank
+
+    Each rank is factorized once, then combined with the code of the
+    parent taxon, so taxa with the same name in different lineages (e.g.
+    an unassigned g__) stay apart. Only the distinct taxa get a label.
+
+    Parameters
+    ----------
+    levels: pandas df
+        As returned by lineage_table().
+
+    Returns
+    -------
+    codes: numpy array
+        (OTUs x ranks) int64 taxon codes.
+    labels: list of numpy arrays
+        Per rank, the lineage (levels joined by ';', down to that rank) of
+        every code.
+    '''
+    n_otus = len(levels)
+    codes = np.zeros((n_otus, len(RANKS)), dtype=np.int64)
+    labels = []
+    parent, parent_labels = np.zeros(n_otus, dtype=np.int64), np.array([''], dtype=object)
+    for i, rank in enumerate(RANKS):
+        names, uniques = pd.factorize(levels[rank].to_numpy(dtype=object))
+        pairs = parent * len(uniques) + names
+        taxa, codes[:, i] = np.unique(pairs, return_inverse=True)
+        taxon_parents, taxon_names = np.divmod(taxa, len(uniques))
+        prefix = parent_labels[taxon_parents]
+        labels.append(np.array([(p + ';' if p else '') + name for p, name in
+                                zip(prefix, np.asarray(uniques, dtype=object)[taxon_names])],
+                               dtype=object))
+        parent, parent_labels = codes[:, i], labels[-1]
+    return codes, labels
+
+
+def aggregation_matrix(codes, n_taxa):
+    '''Sparse (taxa x OTUs) 0/1 matrix summing OTU rows into their taxa'''
+    n_otus = len(codes)
+    return sparse.csr_matrix((np.ones(n_otus, dtype=np.int64),
+                              (codes, np.arange(n_otus))), shape=(n_taxa, n_otus))
+
+
+def rank_taxonomy(labels, rank):
+    '''Taxonomy df of the taxa of one rank: index the lineage labels,
+        one column per rank down to rank'''
+    depth = RANKS.index(rank) + 1
+    return pd.DataFrame([label.split(';') for label in labels],
+                        index=pd.Index(labels, name='otu_id'), columns=RANKS[:depth])
@@ -1,7 +1,32 @@
+import os
+import json
+import sys
+import shutil
+import subprocess
+import tempfile
+import threading
 import unittest
+from importlib.util import find_spec
+import numpy as np
+import pandas as pd
+from scipy import sparse
 from skbio.util import get_data_path
 
-from comad.neufit import neufit
+from comad.neufit import (neufit, neufit_table, neufit_ensemble, make_file_header,
+	comad_pipeline, neufit_stream, neufit_ranks)
+from comad.batch import run_batch
+from comad.cache import ResultCache
+from comad.columnar import convert_table, load_columnar, write_columnar
+from comad.incremental import IncrementalFit, load_incremental
+from comad.models import compare_models, register_model, MODELS
+from comad.profiling import Profiler
+from comad.results import read_results
+from comad.server import ComadService, make_server, submit, request
+from comad.synthetic import neutral_table
+from comad.utils import (non_neutral_outliers, non_neutral_rank_summary,
+	read_biom_subset, table_counts)
+from comad.neufit_utils import (rarefy, beta_cdf, fit_neutral_model,
+	neutral_curve, bootstrap_m, compact_counts, row_sums, occurrence_frequencies)
 
 class TestCore(unittest.TestCase):
 
@@ -30,8 +55,561 @@ class TestCore(unittest.TestCase):
 				self._data_filename, 
 				self._taxonomy_filename,
 				arg_rarefraction_level)
-			
+
+
+class TableTestCase(unittest.TestCase):
+	'''Small random OTU table, also written as a tab separated data file'''
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		rng = np.random.default_rng(0)
+		counts = rng.poisson(0.3, size=(200, 30)) * rng.integers(1, 50, size=(200, 30))
+		self.counts = counts[counts.sum(1) > 0]
+		self._data_filename = os.path.join(self.tmpdir, 'data.csv')
+		pd.DataFrame(self.counts).to_csv(self._data_filename, sep='\t')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+
+class TestSparse(TableTestCase):
+
+	def test_sparse_matches_dense(self):
+		dense = neufit('dense', os.path.join(self.tmpdir, 'dense'),
+			self._data_filename, None, 0, 1, seed=42)
+		sparse_ = neufit('sparse', os.path.join(self.tmpdir, 'sparse'),
+			sparse.csr_matrix(self.counts), None, 0, 1, seed=42)
+		self.assertEqual(dense[1:3], sparse_[1:3])
+		np.testing.assert_allclose(dense[0]['occurrence'].to_numpy(),
+			sparse_[0]['occurrence'].to_numpy())
+		np.testing.assert_allclose(dense[0]['mean_abundance'].to_numpy(),
+			sparse_[0]['mean_abundance'].to_numpy())
+		self.assertAlmostEqual(dense[3], sparse_[3])
+
+	def test_neufit_table_matches_neufit(self):
+		from_file = neufit('file', os.path.join(self.tmpdir, 'file'),
+			self._data_filename, None, 0, 0, seed=7)
+		for table in (pd.DataFrame(self.counts), self.counts):
+			in_memory = neufit_table(table, seed=7)
+			self.assertEqual(from_file[1:3], in_memory[1:3])
+			self.assertAlmostEqual(from_file[3], in_memory[3])
+		self.assertEqual(sorted(os.listdir(self.tmpdir)), ['data.csv',
+			'file.txt', 'file_FullNonNeutral.csv', 'file_NonNeutral_Outliers.csv'])
+
+
+class TestFileHeader(TableTestCase):
+
+	def test_file_header_is_unique(self):
+		first = make_file_header(self.tmpdir, 'run')
+		second = make_file_header(self.tmpdir, 'run')
+		self.assertNotEqual(first, second)
+		self.assertTrue(os.path.exists(first + '.txt'))
+		self.assertTrue(os.path.exists(second + '.txt'))
+
+
+class TestEnsemble(TableTestCase):
+
+	def test_ensemble(self):
+		summary, otus, iterations = neufit_ensemble(self.counts, 4, seed=2)
+		self.assertEqual(len(iterations), 4)
+		self.assertTrue(summary.loc['m', 'ci_lower'] <= summary.loc['m', 'mean'] <= summary.loc['m', 'ci_upper'])
+		self.assertTrue(((otus['non_neutral_frequency'] >= 0) & (otus['non_neutral_frequency'] <= 1)).all())
+		first = neufit_table(self.counts, seed=np.random.default_rng(
+			np.random.SeedSequence(np.random.SeedSequence(2).entropy, spawn_key=(0,))))
+		self.assertAlmostEqual(iterations.loc[0, 'm'], first[4].best_values['m'])
+
+	def test_bootstrap(self):
+		occurr_freqs = neufit_table(self.counts, seed=5, bootstrap=20)[0]
+		self.assertEqual(occurr_freqs.attrs['bootstrap'], 20)
+		self.assertLess(occurr_freqs.attrs['m_ci_lower'], occurr_freqs.attrs['m_ci_upper'])
+		rarefied, _ = rarefy(self.counts, 100, seed=0)
+		np.testing.assert_array_equal(bootstrap_m(rarefied, 100, 12, seed=3),
+			bootstrap_m(sparse.csc_matrix(rarefied), 100, 12, seed=3, jobs=2, chunk_size=5))
+
+
+class TestBatch(TableTestCase):
+
+	def test_batch(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		manifest = os.path.join(self.tmpdir, 'manifest.tsv')
+		pd.DataFrame({'input_filename': [table_filename, table_filename + '.missing'],
+			'output_filename': ['ok', 'missing'],
+			'neufit_plot_bool': ['false', 'false'],
+			'seed': ['1', '']}).to_csv(manifest, sep='\t', index=False)
+		summary = run_batch(manifest, output_filepath=os.path.join(self.tmpdir, 'out'),
+			cache=False)
+		self.assertEqual(list(summary['status']), ['ok', 'failed'])
+		self.assertEqual(summary.loc[0, 'n_samples'], self.counts.shape[1])
+		single = neufit_table(self.counts, seed=1)
+		self.assertAlmostEqual(summary.loc[0, 'm'], single[4].best_values['m'])
+		self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'manifest_summary.tsv')))
+
+
+class TestResultCache(TableTestCase):
+
+	def test_result_cache(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		cache = ResultCache(os.path.join(self.tmpdir, 'cache'))
+		out = os.path.join(self.tmpdir, 'out')
+		first = comad_pipeline(table_filename, 'a', out, neufit_plot_bool=False,
+			seed=3, cache=cache)
+		second = comad_pipeline(table_filename, 'b', out, neufit_plot_bool=False,
+			seed=3, cache=cache)
+		pd.testing.assert_frame_equal(first[0], second[0])
+		self.assertEqual(first[4].best_values, second[4].best_values)
+		outputs = sorted(os.listdir(os.path.join(out, 'a')))
+		self.assertEqual(len(os.listdir(os.path.join(out, 'b'))), len(outputs))
+		self.assertEqual(len(os.listdir(cache.cache_dir)), 1)
+		comad_pipeline(table_filename, 'c', out, neufit_plot_bool=False, seed=4,
+			cache=ResultCache(cache.cache_dir, max_size=0))
+		self.assertEqual(os.listdir(cache.cache_dir), [])
+
+
+class TestPlot(TableTestCase):
+
+	def test_plot_is_headless(self):
+		from comad.plotting import neufit_plot
+		occurr_freqs, n_reads, n_samples, r_square, beta_fit = neufit_table(self.counts, seed=1)
+		save_plot = os.path.join(self.tmpdir, 'plot')
+		for density_above in (10**6, 10):
+			fig = neufit_plot(occurr_freqs, beta_fit, n_samples, n_reads, r_square,
+				save_plot, True, density_above=density_above)
+			self.assertIn('m = ' + str(round(beta_fit.best_values['m'], 3)),
+				[text.get_text() for text in fig.axes[0].texts])
+		self.assertTrue(os.path.exists(save_plot + '.pdf'))
+		self.assertNotIn('matplotlib.pyplot', sys.modules)
+
+
+class TestProfile(TableTestCase):
+
+	def test_profile(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		records = []
+		profiler = Profiler(hooks=[records.append])
+		comad_pipeline(table_filename, 'p', self.tmpdir, neufit_plot_bool=False,
+			seed=1, cache=False, profile=profiler)
+		stages = [record['name'] for record in records]
+		for name in ('parse', 'rarefy', 'fit', 'confint', 'outliers'):
+			self.assertIn(name, stages)
+		profile_filename = [fn for fn in os.listdir(os.path.join(self.tmpdir, 'p'))
+			if fn.endswith('_profile.json')]
+		with open(os.path.join(self.tmpdir, 'p', profile_filename[0])) as f:
+			report = json.load(f)
+		rarefy_stage = [record for record in report['stages'] if record['name'] == 'rarefy'][0]
+		self.assertEqual(rarefy_stage['shape'], list(self.counts.shape))
+		self.assertGreater(rarefy_stage['peak_traced_mb'], 0)
+
+
+class TestStream(TableTestCase):
+
+	def test_stream_matches_in_memory(self):
+		#Samples already at the depth are kept as they are, chunk by chunk
+		depth = 100
+		rarefied, keep = rarefy(self.counts, depth, seed=0)
+		rarefied = rarefied[rarefied.sum(1) > 0]
+		rarefied_filename = os.path.join(self.tmpdir, 'rarefied.tsv')
+		pd.DataFrame(rarefied).to_csv(rarefied_filename, sep='\t')
+		expected = occurrence_frequencies(rarefied, np.arange(len(rarefied)), depth)
+		for chunksize in (7, 1000):
+			streamed = neufit_stream(rarefied_filename, seed=3, chunksize=chunksize)
+			self.assertEqual(streamed[1:3], (depth, keep.sum()))
+			np.testing.assert_allclose(streamed[0].loc[expected.index, ['mean_abundance',
+				'occurrence']].to_numpy(), expected.to_numpy(), rtol=1e-6)
+		#Otherwise every kept sample contributes exactly depth reads, drawn
+		#from its own reads
+		in_memory = neufit_table(pd.DataFrame(self.counts), arg_ignore_level=1, seed=3)
+		n_reads, n_samples = in_memory[1:3]
+		for chunksize in (7, 1000):
+			streamed = neufit_stream(self._data_filename, arg_ignore_level=1,
+				seed=3, chunksize=chunksize)
+			self.assertEqual(in_memory[1:3], streamed[1:3])
+			reads = streamed[0]['mean_abundance'].to_numpy(dtype=float) * n_reads * n_samples
+			occurrences = streamed[0]['occurrence'].to_numpy(dtype=float) * n_samples
+			np.testing.assert_allclose(reads, np.round(reads), atol=1e-3)
+			np.testing.assert_allclose(occurrences, np.round(occurrences), atol=1e-3)
+			self.assertEqual(int(np.round(reads).sum()), n_reads * n_samples)
+			kept = self.counts[:, self.counts.sum(0) >= n_reads][streamed[0].index.astype(int)]
+			self.assertTrue((np.round(reads) <= kept.sum(1)).all())
+			self.assertTrue((np.round(occurrences) <= (kept > 0).sum(1)).all())
+		again = neufit_stream(self._data_filename, arg_ignore_level=1, seed=3,
+			chunksize=1000)
+		pd.testing.assert_frame_equal(streamed[0], again[0])
+
+	def test_stream_rejects_unsupported(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		converted = convert_table(table_filename, os.path.join(self.tmpdir, 'table.comad'))
+		for input_filename, jobs in ((os.path.join(self.tmpdir, 'table.biom'), 1),
+				(converted, 1), (table_filename, 2)):
+			with self.assertRaises(ValueError):
+				comad_pipeline(input_filename, 'r', self.tmpdir, neufit_plot_bool=False,
+					seed=1, cache=False, chunksize=10, jobs=jobs)
+
+
+class TestColumnar(TableTestCase):
+
+	def test_columnar(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		expected = neufit_table(pd.DataFrame(self.counts), seed=5)
+		for layout_sparse in (False, True):
+			converted = convert_table(table_filename, os.path.join(self.tmpdir,
+				'table_' + str(layout_sparse) + '.comad'), sparse=layout_sparse)
+			table = load_columnar(converted)
+			self.assertEqual(sparse.issparse(table[0]), layout_sparse)
+			counts = table[0].data if layout_sparse else table[0]
+			self.assertFalse(counts.flags.writeable)
+			self.assertIs(table_counts(table), table)
+			results = neufit_table(table, seed=5)
+			self.assertEqual(expected[1:3], results[1:3])
+			self.assertAlmostEqual(expected[3], results[3])
+		results = comad_pipeline(converted, 'c', self.tmpdir, neufit_plot_bool=False,
+			seed=5, cache=False)
+		self.assertAlmostEqual(expected[3], results[3])
+
+	def test_columnar_cache_key(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		converted = os.path.join(self.tmpdir, 'table.comad')
+		cache = ResultCache(os.path.join(self.tmpdir, 'cache'))
+		for phylum in ('p__A', 'p__B'):
+			taxonomy = pd.DataFrame({'Phylum': phylum}, index=range(len(self.counts)))
+			convert_table(table_filename, converted, taxonomy=taxonomy)
+			results = comad_pipeline(converted, phylum, self.tmpdir,
+				neufit_plot_bool=False, seed=3, cache=cache)
+			self.assertEqual(set(results[0]['Phylum']), {phylum})
+		#Same shape, nnz and dtype, different counts
+		write_columnar(pd.DataFrame(self.counts[::-1]), converted)
+		cached = comad_pipeline(converted, 'r', self.tmpdir, neufit_plot_bool=False,
+			seed=3, cache=cache)
+		fresh = comad_pipeline(converted, 'f', self.tmpdir, neufit_plot_bool=False,
+			seed=3, cache=False)
+		self.assertEqual(cached[4].best_values['m'], fresh[4].best_values['m'])
+		self.assertNotEqual(cached[4].best_values['m'], results[4].best_values['m'])
+
+
+class TestBiomSubset(TableTestCase):
+
+	def test_biom_subset(self):
+		from biom import Table
+		from biom.util import biom_open
+		biom_filename = os.path.join(self.tmpdir, 'table.biom')
+		sample_ids = ['s' + str(j) for j in range(self.counts.shape[1])]
+		metadata = [{'site': 'gut' if j % 3 else 'skin'} for j in range(len(sample_ids))]
+		with biom_open(biom_filename, 'w') as f:
+			Table(self.counts, ['o' + str(i) for i in range(self.counts.shape[0])],
+				sample_ids, sample_metadata=metadata).to_hdf5(f, 'test')
+		gut = np.array([j % 3 != 0 for j in range(len(sample_ids))])
+		expected = self.counts[:, gut]
+		expected = expected[expected.sum(1) > 2]
+		counts, otu_ids, subset_ids = read_biom_subset(biom_filename,
+			where='site=gut', arg_ignore_level=2)
+		np.testing.assert_array_equal(counts.toarray(), expected)
+		self.assertEqual(list(subset_ids), list(np.array(sample_ids)[gut]))
+		counts, otu_ids, subset_ids = read_biom_subset(biom_filename,
+			samples=['s1', 's4', 'missing'], where=['site=gut', 'site=skin'])
+		self.assertEqual(list(subset_ids), ['s1', 's4'])
+		results = comad_pipeline(biom_filename, 'b', self.tmpdir, neufit_plot_bool=False,
+			seed=2, cache=False, where='site=gut', sparse=True)
+		self.assertEqual(results[2], gut.sum())
+		with self.assertRaises(ValueError):
+			read_biom_subset(biom_filename, where='site=lung')
+
+
+class TestGroups(TableTestCase):
+
+	def test_group_by(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		metadata_filename = os.path.join(self.tmpdir, 'metadata.tsv')
+		sites = ['gut' if j % 3 else 'skin' for j in range(self.counts.shape[1])]
+		sites[0] = ''
+		pd.DataFrame({'site': sites}).replace('', np.nan).to_csv(metadata_filename,
+			sep='\t')
+		summary, group_results = comad_pipeline(table_filename, 'g', self.tmpdir,
+			seed=3, cache=False, metadata=metadata_filename, group_by='site')
+		self.assertEqual(list(summary.index), ['gut', 'skin', 'combined'])
+		self.assertEqual(list(summary['n_samples']), [20, 9, 29])
+		self.assertEqual(len(set(summary['n_reads'])), 1)
+		self.assertEqual(group_results['skin'][2], 9)
+		outputs = os.listdir(os.path.join(self.tmpdir, 'g'))
+		for suffix in ('_groups.tsv', '_groups.pdf', '_skin.txt', '_combined_NonNeutral_Outliers.csv'):
+			self.assertTrue(any(fn.endswith(suffix) for fn in outputs))
+
+
+class TestRanks(TableTestCase):
+
+	def test_ranks(self):
+		families = ['f__F' + str(i % 40) for i in range(len(self.counts))]
+		genera = ['g__G' + str(i % 7) if i % 5 else 'g__' for i in range(len(self.counts))]
+		lineages = ['k__Bacteria;p__P' + str(i % 2) + ';c__;o__;' + family + ';' + genus
+			for i, (family, genus) in enumerate(zip(families, genera))]
+		table = pd.DataFrame(self.counts, index=lineages)
+		summary, rank_results = neufit_ranks(table, 'otu,Genus,family', seed=5,
+			file_header=os.path.join(self.tmpdir, 'r'))
+		self.assertEqual(list(summary.index), ['OTU', 'Genus', 'Family'])
+		#Unassigned genera (g__) of different families stay apart
+		self.assertEqual(list(summary['n_taxa']), [len(table),
+			len(set(zip(families, genera))), 40])
+		full = neufit_table(table, seed=5)
+		self.assertEqual(rank_results['OTU'][4].best_values['m'], full[4].best_values['m'])
+		rarefied, keep = rarefy(table.to_numpy(), full[1], seed=5)
+		collapsed = pd.DataFrame(rarefied, index=[lineage.rsplit(';', 1)[0]
+			for lineage in lineages]).groupby(level=0).sum()
+		expected = occurrence_frequencies(collapsed.to_numpy(), collapsed.index, full[1])
+		pd.testing.assert_frame_equal(rank_results['Family'][0][['mean_abundance',
+			'occurrence']].astype(float).sort_index(), expected.sort_index())
+		self.assertEqual(rank_results['Family'][0].loc[lineages[1].rsplit(';', 1)[0],
+			'Family'], 'f__F1')
+		self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, 'r_Genus_FullNonNeutral.csv')))
+		self.assertEqual(len(pd.read_csv(os.path.join(self.tmpdir, 'r_ranks.tsv'), sep='\t')), 3)
+		with self.assertRaises(ValueError):
+			neufit_ranks(table, 'strain')
+
+
+class TestCompactDtypes(TableTestCase):
+
+	def test_compact_dtypes(self):
+		counts, otu_ids, sample_ids = table_counts(pd.DataFrame(self.counts))
+		self.assertEqual(counts.dtype, np.uint8)
+		self.assertEqual(row_sums(counts).dtype, np.int64)
+		self.assertEqual(compact_counts(np.array([0, 256])).dtype, np.uint16)
+		with self.assertRaises(ValueError):
+			compact_counts(np.array([-1, 2]))
+		wide = neufit_table((self.counts.astype(np.int64), otu_ids, sample_ids), seed=2)
+		compact = neufit_table((counts, otu_ids, sample_ids), seed=2)
+		self.assertEqual(wide[4].best_values['m'], compact[4].best_values['m'])
+		self.assertEqual(compact[0]['occurrence'].dtype, np.float32)
+
+
+class TestIncremental(TableTestCase):
+
+	def test_incremental(self):
+		table = pd.DataFrame(self.counts, columns=['s' + str(j) for j in range(30)])
+		depth = int(np.sort(self.counts.sum(0))[3])
+		state = IncrementalFit(depth, seed=4)
+		added = state.add(table.iloc[:, :12]) + state.add(table.iloc[:, 12:])
+		self.assertEqual(len(added), 27)
+		full = neufit_table(table, arg_rarefaction_level=depth, seed=4)
+		result = state.fit()
+		self.assertEqual(result[4].best_values['m'], full[4].best_values['m'])
+		pd.testing.assert_frame_equal(result[0].sort_index(), full[0].sort_index())
+		state_filename = os.path.join(self.tmpdir, 'state.pkl')
+		state.save(state_filename)
+		state = load_incremental(state_filename)
+		state.remove(added[:5])
+		rarefied, keep = rarefy(self.counts, depth, seed=4)
+		window = occurrence_frequencies(rarefied[:, 5:], np.arange(len(self.counts)), depth)
+		pd.testing.assert_frame_equal(state.occurrence_frequencies().sort_index(),
+			window[window['mean_abundance'] > 0].sort_index())
+		state.slide(table.iloc[:, 12:13].rename(columns=str.upper), 10)
+		self.assertEqual(state.sample_ids, added[-9:] + ['S12'])
+
+
+class TestResults(TableTestCase):
+
+	@unittest.skipUnless(find_spec('pyarrow'), 'needs pyarrow')
+	def test_results_file(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		for results_format in ('parquet', 'feather'):
+			occurr_freqs, n_reads, n_samples, r_square, beta_fit = comad_pipeline(
+				table_filename, results_format, self.tmpdir, seed=1, cache=False,
+				neufit_plot_bool=False, results_format=results_format)
+			folder = os.path.join(self.tmpdir, results_format)
+			fn = [fn for fn in os.listdir(folder) if fn.endswith('_results.' + results_format)]
+			results = read_results(os.path.join(folder, fn[0]))
+			self.assertEqual(results.attrs['m'], beta_fit.best_values['m'])
+			self.assertEqual(results.attrs['N'], n_reads)
+			self.assertEqual(results.attrs['n_samples'], n_samples)
+			np.testing.assert_array_equal(results['occurrence'],
+				occurr_freqs['occurrence'])
+			full = pd.read_csv(os.path.join(folder, fn[0].replace('_results.' +
+				results_format, '_FullNonNeutral.csv')), index_col=0)
+			self.assertEqual(sorted(results.index[results['above'] | results['below']]),
+				sorted(full.index))
+
+
+class TestServe(TableTestCase):
+
+	def test_serve(self):
+		table_filename = os.path.join(self.tmpdir, 'table.tsv')
+		pd.DataFrame(self.counts).to_csv(table_filename, sep='\t')
+		socket_path = os.path.join(self.tmpdir, 'comad.sock')
+		service = ComadService()
+		server = make_server(service, socket_path=socket_path, quiet=True)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.start()
+		try:
+			for i in range(2):
+				events = list(submit({'input_filename': table_filename,
+					'output_filename': 'run' + str(i), 'output_filepath': self.tmpdir,
+					'seed': '1', 'cache': False, 'neufit_plot_bool': 'false'},
+					socket_path=socket_path))
+				self.assertEqual([event['status'] for event in events],
+					['queued', 'running', 'ok'])
+			direct = neufit_table(pd.read_csv(table_filename, sep='\t', index_col=0), seed=1)
+			self.assertEqual(events[-1]['m'], direct[4].best_values['m'])
+			status = request('GET', '/status', socket_path=socket_path)
+			self.assertEqual(status['table_cache']['hits'], 1)
+			self.assertEqual(status['jobs'], {'ok': 2})
+			with self.assertRaises(ValueError):
+				list(submit({'input_filename': table_filename, 'output_filename': 'x',
+					'output_filepath': self.tmpdir, 'bogus': 1}, socket_path=socket_path))
+			request('POST', '/shutdown', socket_path=socket_path)
+			thread.join(10)
+			self.assertFalse(thread.is_alive())
+		finally:
+			server.shutdown()
+			server.server_close()
+			service.close()
+
+
+class TestRarefy(unittest.TestCase):
+
+	def setUp(self):
+		rng = np.random.default_rng(1)
+		self.counts = rng.integers(0, 20, size=(50, 12))
+		self.counts[:, 3] = 0
+		self.counts[0, 3] = 5
+
+	def test_depth_and_dropped_samples(self):
+		for counts in (self.counts, sparse.csc_matrix(self.counts)):
+			rarefied, keep = rarefy(counts, 100, seed=0)
+			self.assertFalse(keep[3])
+			self.assertEqual(keep.sum(), 11)
+			rarefied = rarefied.toarray() if sparse.issparse(rarefied) else rarefied
+			np.testing.assert_array_equal(rarefied.sum(0), 100)
+			self.assertTrue((rarefied <= self.counts[:, keep]).all())
+
+	def test_jobs_do_not_change_result(self):
+		for counts in (self.counts, sparse.csc_matrix(self.counts)):
+			serial, _ = rarefy(counts, 100, seed=3)
+			parallel, _ = rarefy(counts, 100, seed=3, jobs=2)
+			self.assertEqual(abs(serial - parallel).sum(), 0)
+
+	def test_expected_counts(self):
+		# Drawing without replacement keeps the expected proportions
+		column = self.counts[:, :1]
+		draws = np.hstack([rarefy(column, 100, seed=i)[0] for i in range(2000)])
+		np.testing.assert_allclose(draws.mean(1), 100.0*column[:, 0]/column.sum(),
+			atol=0.5)
+
+
+class TestFit(unittest.TestCase):
+
+	def test_scalar_fit_matches_lmfit(self):
+		rng = np.random.default_rng(4)
+		mean_abundance = rng.integers(1, 500, 3000) / 50000.0
+		occurrence = np.clip(beta_cdf(mean_abundance, 1000, 0.3) +
+			rng.normal(0, 0.05, 3000), 0, 1)
+		occurr_freqs = pd.DataFrame({'mean_abundance': mean_abundance,
+			'occurrence': occurrence})
+		scalar, r_square = fit_neutral_model(occurr_freqs, 1000)
+		lmfit_, lmfit_r_square = fit_neutral_model(occurr_freqs, 1000, 'lmfit')
+		self.assertAlmostEqual(scalar.best_values['m'], lmfit_.best_values['m'], places=5)
+		self.assertAlmostEqual(scalar.params['m'].stderr / lmfit_.params['m'].stderr, 1, places=3)
+		self.assertAlmostEqual(r_square, lmfit_r_square, places=8)
+		np.testing.assert_allclose(scalar.best_fit, lmfit_.best_fit, atol=1e-5)
+
+	def test_synthetic_table_recovers_m(self):
+		counts, otu_ids, sample_ids = neutral_table(2000, 300, 5000, m=0.05,
+			sparsity=0.9, seed=0)
+		self.assertEqual(counts.shape, (2000, 300))
+		self.assertAlmostEqual(1 - counts.nnz / (2000 * 300), 0.9, delta=0.01)
+		np.testing.assert_array_equal(np.asarray(counts.sum(0)).ravel(), 5000)
+		beta_fit = neufit_table((counts, otu_ids, sample_ids), seed=0)[4]
+		self.assertAlmostEqual(beta_fit.best_values['m'], 0.05, delta=0.01)
+
+	def test_neutral_curve(self):
+		p = np.logspace(-14, 0, 5001)[:-1]
+		for tol in (1e-4, 1e-7):
+			curve = neutral_curve(2000, 0.25, tol)
+			self.assertLessEqual(np.abs(curve(p) - beta_cdf(p, 2000, 0.25)).max(), 2*tol)
+		self.assertIs(neutral_curve(2000, 0.25, 1e-7), curve)
+
+	def test_compare_models(self):
+		rng = np.random.default_rng(5)
+		mean_abundance = rng.integers(1, 500, 3000) / 50000.0
+		occurrence = np.clip(beta_cdf(mean_abundance, 1000, 0.3) +
+			rng.normal(0, 0.02, 3000), 0, 1)
+		occurr_freqs = pd.DataFrame({'mean_abundance': mean_abundance,
+			'occurrence': occurrence})
+		beta_fit, r_square = fit_neutral_model(occurr_freqs, 1000)
+		comparison = compare_models(occurr_freqs, 1000)
+		self.assertAlmostEqual(comparison.loc['neutral', 'm'], beta_fit.best_values['m'])
+		self.assertAlmostEqual(comparison.loc['neutral', 'r_square'], r_square)
+		self.assertAlmostEqual(comparison.loc['neutral', 'aic'], beta_fit.aic)
+		self.assertLess(comparison.loc['neutral', 'aic'], comparison.loc['binomial', 'aic'])
+		self.assertLessEqual(comparison.loc['neutral_free_N', 'rss'],
+			comparison.loc['neutral', 'rss'] + 1e-9)
+		binomial = 1 - (1 - mean_abundance)**1000
+		self.assertAlmostEqual(comparison.loc['binomial', 'rss'],
+			np.sum((occurrence - binomial)**2))
+		register_model('constant', lambda p, N, c: np.full(p.size, c),
+			[('c', -3.0, 0.0, None)])
+		try:
+			constant = compare_models(occurr_freqs, 1000, beta_fit, ['constant'])
+			self.assertAlmostEqual(constant.loc['constant', 'c'], occurrence.mean(), places=5)
+		finally:
+			del MODELS['constant']
+
+
+class TestOutliers(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.occurr_freqs = pd.DataFrame({'mean_abundance': [0.1, 0.2, 0.3, 0.4, 0.5],
+			'occurrence': [0.9, 0.1, 0.5, 0.0, 1.0],
+			'Phylum': ['a', 'b', 'a', 'b', 'a'],
+			'predicted_occurrence': [0.2, 0.7, 0.5, 0.3, 0.4]},
+			index=['o1', 'o2', 'o3', 'o4', 'o5'])
+		self.occurr_freqs['lower_conf_int'] = self.occurr_freqs['predicted_occurrence'] - 0.1
+		self.occurr_freqs['upper_conf_int'] = self.occurr_freqs['predicted_occurrence'] + 0.1
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_outliers(self):
+		file_header = os.path.join(self.tmpdir, 'run')
+		standout = non_neutral_outliers(file_header, self.occurr_freqs, full=True,
+			ranks=['Phylum'])
+		np.testing.assert_allclose(standout['Difference off Neutral Model'], [0.7, 0.6, 0.6])
+		self.assertEqual(list(standout.columns), ['Difference off Neutral Model', 'Phylum'])
+		full = pd.read_csv(file_header + '_FullNonNeutral.csv', index_col=0)
+		self.assertEqual(list(full.index), ['o1', 'o5', 'o2', 'o4'])
+		top = non_neutral_outliers(file_header, self.occurr_freqs, top=1)
+		self.assertEqual(list(top['Phylum']), ['a'])
+		summary = non_neutral_rank_summary(self.occurr_freqs, 'Phylum')
+		self.assertEqual(summary.loc['a', 'n_above'], 2)
+		self.assertEqual(summary.loc['b', 'n_below'], 2)
+		self.assertTrue(os.path.exists(file_header + '_NonNeutral_Phylum.csv'))
+
+
+class TestImports(unittest.TestCase):
+	'''Heavy dependencies must only be imported by the code that uses them'''
+
+	def loaded_modules(self, code):
+		root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+		output = subprocess.run([sys.executable, '-c', code + '\nimport sys\n' +
+			'print(\' \'.join(sorted(m for m in sys.modules if \'.\' not in m)))'],
+			cwd=root, capture_output=True, text=True, check=True).stdout
+		return set(output.splitlines()[-1].split())
+
+	def test_cli_startup(self):
+		modules = self.loaded_modules('from comad.scripts import cli\n' +
+			'try:\n    cli([\'--help\'])\nexcept SystemExit:\n    pass')
+		for heavy in ('pandas', 'scipy', 'matplotlib', 'biom', 'lmfit', 'statsmodels'):
+			self.assertNotIn(heavy, modules)
+
+	def test_package_imports(self):
+		modules = self.loaded_modules('import comad.neufit')
+		for heavy in ('matplotlib', 'biom', 'lmfit', 'statsmodels'):
+			self.assertNotIn(heavy, modules)
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1,7 +1,11 @@
 import pandas as pd
-from biom import load_table 
 import os
 import numpy as np
+from scipy import sparse
+from comad.profiling import stage
+from comad.cache import active_table_cache
+from comad.columnar import is_columnar, load_columnar
+from comad.neufit_utils import compact_counts, CountTable
 
 def biom2data_tax(biom_filename, output_filename, output_folder_path):
     '''Imports biom file -> pandas dataframe -> data.csv, taxonomy.csv 
@@ -49,15 +53,20 @@ def biom2data_tax(biom_filename, output_filename, output_folder_path):
 
     
     #Make filename and import data
-    featureTable = load_table(biom_filename) 
-    #https://biom-format.org/documentation/generated/biom.load_table.html
+    with stage('parse', filename=biom_filename) as record:
+        from biom import load_table
+        featureTable = load_table(biom_filename) 
+        #https://biom-format.org/documentation/generated/biom.load_table.html
+        record['shape'] = list(featureTable.shape)
+        record['nnz'] = int(featureTable.nnz)
     
     #Create _data.csv
-    pandas_featureTable = pd.DataFrame(featureTable.matrix_data.toarray(),
-                                       featureTable.ids('observation'), 
-                                       featureTable.ids())
-    fnD = data_tax_path +  output_filename + '_data.csv'
-    pandas_featureTable.to_csv(fnD, sep='\t')
+    with stage('write_data_tax'):
+        pandas_featureTable = pd.DataFrame(_dense_counts(featureTable.matrix_data),
+                                           featureTable.ids('observation'), 
+                                           featureTable.ids())
+        fnD = data_tax_path +  output_filename + '_data.csv'
+        pandas_featureTable.to_csv(fnD, sep='\t')
     
     '''
     #Create _taxonomy.csv
@@ -72,6 +81,447 @@ def biom2data_tax(biom_filename, output_filename, output_folder_path):
     
     return(fnD, fnT)
 
+def _dense_counts(matrix_data):
+    # Dense compact counts of a biom matrix, narrowed before densifying
+    dtype = compact_counts(matrix_data.data).dtype
+    return matrix_data.astype(dtype).toarray()
+
+def sparse_counts(table):
+    '''Converts a biom Table or scipy.sparse matrix into a sparse 
+        integer count matrix without densifying it
+    
+    Parameters
+    ----------
+    table: biom.Table, scipy.sparse matrix or tuple
+        OTU abundance table with OTUs as rows and samples as columns. A 
+        (counts, otu_ids, sample_ids) tuple, as returned by biom2sparse(), 
+        is also accepted.
+    
+    Returns
+    -------
+    counts: scipy.sparse.csc_matrix
+        Integer counts in the smallest safe unsigned dtype (see 
+        neufit_utils.count_dtype()), one column per sample.
+    otu_ids: numpy array
+        OTU ids (rows); positional for a bare scipy.sparse matrix.
+    sample_ids: numpy array
+        Sample ids (columns); positional for a bare scipy.sparse matrix.
+    '''
+    if isinstance(table, tuple):
+        counts, otu_ids, sample_ids = table
+        otu_ids, sample_ids = np.asarray(otu_ids), np.asarray(sample_ids)
+    elif sparse.issparse(table):
+        counts = table
+        otu_ids = np.arange(counts.shape[0]).astype(str)
+        sample_ids = np.arange(counts.shape[1]).astype(str)
+    else:
+        counts = table.matrix_data
+        otu_ids = np.asarray(table.ids('observation'))
+        sample_ids = np.asarray(table.ids())
+    
+    counts = sparse.csc_matrix(counts)
+    data = compact_counts(counts.data)
+    if data is counts.data and data.all():
+        #Already clean compact counts (e.g. memory-mapped ones), no copy
+        return counts, otu_ids, sample_ids
+    counts = sparse.csc_matrix((data, counts.indices, counts.indptr), 
+                               shape=counts.shape)
+    counts.eliminate_zeros()
+    return counts, otu_ids, sample_ids
+
+def biom2sparse(biom_filename):
+    '''Imports biom file -> scipy.sparse count matrix
+    
+    Unlike biom2data_tax() the table is never converted into a dense 
+    dataframe or written to disk, so memory scales with the number of 
+    non-zero entries.
+    
+    Parameters
+    ----------
+    biom_filename: str
+        The filename of biom file
+    
+    Returns
+    -------
+    counts: scipy.sparse.csc_matrix
+        Integer counts, one column per sample.
+    otu_ids: numpy array
+        Observation ids of the biom table.
+    sample_ids: numpy array
+        Sample ids of the biom table.
+    '''
+    from biom import load_table
+    return sparse_counts(load_table(biom_filename))
+
+def read_sample_list(samples):
+    '''Sample ids from a list, a comma separated string or a file with
+        one id per line'''
+    if isinstance(samples, str):
+        if os.path.isfile(samples):
+            with open(samples) as f:
+                return [line.strip() for line in f if line.strip()]
+        return [sample.strip() for sample in samples.split(',') if sample.strip()]
+    return [str(sample) for sample in samples]
+
+def parse_where(where):
+    '''Metadata filter {column: [accepted values]} from a dict or from
+        'column=value' strings (a list of them, or one string with the 
+        conditions separated by ;)
+
+    Values given for the same column are alternatives, different columns
+    must all match.
+    '''
+    if isinstance(where, dict):
+        return {column: [str(value) for value in np.atleast_1d(values)]
+                for column, values in where.items()}
+    if isinstance(where, str):
+        where = where.split(';')
+    conditions = {}
+    for condition in where:
+        if '=' not in condition:
+            raise ValueError('Metadata filter ' + str(condition) +
+                             ' is not of the form column=value')
+        column, value = condition.split('=', 1)
+        conditions.setdefault(column.strip(), []).append(value.strip())
+    return conditions
+
+def select_samples(sample_ids, samples=None, metadata=None, where=None):
+    '''Which samples of a table to keep
+
+    Parameters
+    ----------
+    sample_ids: array-like
+        Sample ids of the table.
+    samples: list, str or path, optional
+        Sample ids to keep, see read_sample_list(). Ids missing from the
+        table are reported and skipped.
+    metadata: pandas df, optional
+        Sample metadata indexed by sample id; needed for where.
+    where: dict, str or list of str, optional
+        Metadata filter, see parse_where(). Samples without metadata are
+        dropped.
+
+    Returns
+    -------
+    keep: numpy array of bool
+    '''
+    sample_ids = np.asarray(sample_ids).astype(str)
+    keep = np.ones(len(sample_ids), dtype=bool)
+    if samples is not None:
+        samples = read_sample_list(samples)
+        keep &= np.isin(sample_ids, samples)
+        missing = set(samples) - set(sample_ids)
+        if missing:
+            print(str(len(missing)) + ' requested samples not found, e.g. ' +
+                  sorted(missing)[0])
+    if where is not None:
+        if metadata is None:
+            raise ValueError('Filtering samples by metadata needs sample metadata')
+        metadata = metadata.copy()
+        metadata.index = metadata.index.astype(str)
+        for column, values in parse_where(where).items():
+            if column not in metadata.columns:
+                raise ValueError('No metadata column ' + str(column))
+            accepted = metadata.index[metadata[column].astype(str).isin(values)]
+            keep &= np.isin(sample_ids, accepted)
+    if not keep.any():
+        raise ValueError('No samples selected')
+    return keep
+
+def read_metadata(metadata_filename):
+    '''Sample metadata tsv (first column sample ids) as strings'''
+    return pd.read_csv(metadata_filename, sep='\t', index_col=0, dtype=str,
+                       comment='#')
+
+def load_sample_metadata(input_filename, metadata=None):
+    '''Sample metadata for where and group_by: the metadata tsv (or df) 
+        if given, else the sample metadata stored in a biom input
+    
+    Returns
+    -------
+    metadata: pandas df
+        Indexed by sample id.
+    '''
+    if isinstance(metadata, str):
+        return read_metadata(metadata)
+    if metadata is not None:
+        return metadata
+    if input_filename.split('.')[1] == 'biom':
+        import h5py
+        if h5py.is_hdf5(input_filename):
+            with h5py.File(input_filename, 'r') as f:
+                metadata = _biom_sample_metadata(f, _hdf5_strings(f['sample/ids']))
+        else:
+            from biom import load_table
+            featureTable = load_table(input_filename)
+            if featureTable.metadata(axis='sample') is not None:
+                metadata = featureTable.metadata_to_dataframe('sample')
+    if metadata is None:
+        raise ValueError('No sample metadata for ' + str(input_filename) + 
+                         ', pass a metadata tsv')
+    return metadata
+
+def _hdf5_strings(dataset):
+    # Variable length strings come back as bytes from h5py
+    import h5py
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        return np.asarray(dataset.asstr()[:], dtype=object)
+    return dataset[:]
+
+def _biom_sample_metadata(biom_file, sample_ids):
+    # Per-sample metadata of an HDF5 biom file: one dataset per column
+    group = biom_file.get('sample/metadata')
+    if group is None or len(group) == 0:
+        return None
+    return pd.DataFrame({column: _hdf5_strings(group[column])
+                         for column in group
+                         if getattr(group[column], 'ndim', 0) == 1},
+                        index=sample_ids)
+
+def load_lineages(input_filename, otu_ids, taxonomy=None):
+    '''Lineage of every OTU, one column per rank, for neufit_ranks()
+
+    Taken from the first of: taxonomy (a df with one column per rank or
+    one column of ';' separated lineages, e.g. the taxonomy of a .comad
+    folder), the observation taxonomy of a biom input, or the OTU ids
+    themselves when they are lineages ('k__...;p__...;...').
+
+    Returns
+    -------
+    levels: pandas df
+        See taxonomy.lineage_table().
+    '''
+    from comad.taxonomy import lineage_table
+    otu_ids = np.asarray(otu_ids).astype(str)
+    if isinstance(taxonomy, str):
+        taxonomy = pd.read_table(taxonomy, header=0, index_col=0, sep='\t')
+    if taxonomy is not None:
+        if taxonomy.shape[1] == 1:
+            taxonomy = taxonomy.iloc[:, 0]
+        return lineage_table(taxonomy, otu_ids)
+
+    lineages = None
+    if input_filename.split('.')[1] == 'biom':
+        import h5py
+        if h5py.is_hdf5(input_filename):
+            with h5py.File(input_filename, 'r') as f:
+                if 'observation/metadata/taxonomy' in f:
+                    values = _hdf5_strings(f['observation/metadata/taxonomy'])
+                    if values.dtype.kind == 'S':
+                        values = values.astype(str).astype(object)
+                    lineages = pd.Series(list(values),
+                                         index=_hdf5_strings(f['observation/ids']))
+        else:
+            from biom import load_table
+            featureTable = load_table(input_filename)
+            observation_metadata = featureTable.metadata(axis='observation')
+            if observation_metadata is not None:
+                lineages = pd.Series([None if row is None else row.get('taxonomy')
+                                      for row in observation_metadata],
+                                     index=featureTable.ids('observation'))
+    if lineages is None and any('__' in otu for otu in otu_ids[:100]):
+        lineages = otu_ids
+    if lineages is None:
+        raise ValueError('No taxonomy for ' + str(input_filename) + ': OTU ids '
+                         'are not lineages and the input has none')
+    return lineage_table(lineages, otu_ids)
+
+def _subset_counts(counts, otu_ids, sample_ids, keep, arg_ignore_level=0):
+    # Kept sample columns, then OTUs with more than arg_ignore_level reads
+    counts, sample_ids = counts[:, keep], np.asarray(sample_ids)[keep]
+    rows = np.asarray(counts.sum(1)).ravel() > arg_ignore_level
+    return counts[rows], np.asarray(otu_ids)[rows], sample_ids
+
+def read_biom_subset(biom_filename, samples=None, metadata=None, where=None,
+                     arg_ignore_level=0):
+    '''Reads only the selected samples, and the OTUs above the ignore
+        level in them, from a biom file
+
+    For HDF5 (BIOM 2.x) files only the sample ids, the column pointers,
+    the selected metadata and the stored non-zero entries of the selected
+    samples are read (from the CSC sample/matrix group), and OTUs are
+    filtered before the matrix is built; memory and read time scale with
+    the selection instead of the whole file. Other biom files are loaded
+    with biom's load_table() and filtered afterwards.
+
+    Parameters
+    ----------
+    biom_filename: str
+        The filename of biom file
+    samples, where: optional
+        Sample ids and metadata filter, see select_samples().
+    metadata: str, path or pandas df, optional
+        Sample metadata (tsv file, first column sample ids) for where.
+        Default uses the sample metadata stored in the biom file.
+    arg_ignore_level: int, optional
+        Only OTUs with more reads than this in the selected samples are
+        read. Default is 0 (OTUs without reads are dropped).
+
+    Returns
+    -------
+    (counts, otu_ids, sample_ids): tuple
+        As returned by biom2sparse(), for the selected samples and OTUs.
+    '''
+    import h5py
+    if isinstance(metadata, str):
+        metadata = read_metadata(metadata)
+
+    if not h5py.is_hdf5(biom_filename):
+        from biom import load_table
+        featureTable = load_table(biom_filename)
+        if metadata is None and where is not None and \
+           featureTable.metadata(axis='sample') is not None:
+            metadata = featureTable.metadata_to_dataframe('sample')
+        counts, otu_ids, sample_ids = sparse_counts(featureTable)
+        keep = select_samples(sample_ids, samples, metadata, where)
+        return _subset_counts(counts, otu_ids, sample_ids, keep, arg_ignore_level)
+
+    with h5py.File(biom_filename, 'r') as f:
+        n_otus, n_samples = f.attrs['shape']
+        sample_ids = _hdf5_strings(f['sample/ids'])
+        if metadata is None and where is not None:
+            metadata = _biom_sample_metadata(f, sample_ids)
+        keep = select_samples(sample_ids, samples, metadata, where)
+        columns = np.flatnonzero(keep)
+
+        #Read the non-zero entries of consecutive selected samples at once
+        indptr = f['sample/matrix/indptr'][:]
+        runs = np.split(columns, np.flatnonzero(np.diff(columns) != 1) + 1)
+        data, indices = [], []
+        for run in runs:
+            start, end = indptr[run[0]], indptr[run[-1] + 1]
+            data.append(f['sample/matrix/data'][start:end])
+            indices.append(f['sample/matrix/indices'][start:end])
+        data = compact_counts(np.concatenate(data))
+        indices = np.concatenate(indices)
+        column_nnz = indptr[columns + 1] - indptr[columns]
+
+        #Drop OTUs at or below the ignore level before building the matrix
+        otu_reads = np.bincount(indices, weights=data, minlength=n_otus)
+        rows = otu_reads > arg_ignore_level
+        entries = rows[indices]
+        new_row = np.cumsum(rows) - 1
+        kept = np.concatenate(([0], np.cumsum(entries)))
+        new_indptr = kept[np.concatenate(([0], np.cumsum(column_nnz)))]
+        counts = sparse.csc_matrix((data[entries], new_row[indices[entries]],
+                                    new_indptr),
+                                   shape=(int(rows.sum()), len(columns)))
+        otu_ids = _hdf5_strings(f['observation/ids'])[rows]
+    counts.eliminate_zeros()
+    return counts, otu_ids, sample_ids[keep]
+
+def table_counts(table):
+    '''Converts any supported abundance table into an integer count 
+        matrix plus OTU and sample ids
+    
+    Parameters
+    ----------
+    table: pandas df, numpy array, biom.Table, scipy.sparse matrix or tuple
+        OTU abundance table with OTUs as rows and samples as columns. 
+        biom Tables, scipy.sparse matrices and (counts, otu_ids, 
+        sample_ids) tuples are handled by sparse_counts(); tuples of a 
+        dense array (e.g. from load_columnar()) stay dense. A CountTable 
+        is returned as it is, its counts are not read.
+    
+    Returns
+    -------
+    counts: numpy array or scipy.sparse.csc_matrix
+        Integer counts in the smallest unsigned dtype that holds the 
+        largest count (uint8 to uint64), one column per sample. Dense 
+        inputs stay dense.
+    otu_ids: numpy array
+        OTU ids (rows); positional for a bare numpy array.
+    sample_ids: numpy array
+        Sample ids (columns); positional for a bare numpy array.
+    '''
+    if isinstance(table, CountTable):
+        return table
+    if isinstance(table, pd.DataFrame):
+        return (compact_counts(table.to_numpy()), table.index.to_numpy(), 
+                table.columns.to_numpy())
+    if isinstance(table, np.ndarray):
+        return (compact_counts(table), np.arange(table.shape[0]).astype(str), 
+                np.arange(table.shape[1]).astype(str))
+    if isinstance(table, tuple) and isinstance(table[0], np.ndarray):
+        counts, otu_ids, sample_ids = table
+        return (compact_counts(counts), np.asarray(otu_ids), 
+                np.asarray(sample_ids))
+    return sparse_counts(table)
+
+def load_abundances(input_filename, sparse=False, samples=None, metadata=None,
+                    where=None, arg_ignore_level=0):
+    '''Imports a tsv or biom file into memory for neufit_table()
+    
+    Parameters
+    ----------
+    input_filename: str
+        The filename of a .tsv (OTUs as rows, samples as columns) or 
+        .biom file, or a .comad folder written by convert_table(), which 
+        is memory-mapped instead of parsed (see comad.columnar).
+    sparse: bool, optional
+        If True biom files are returned as the sparse tuple of 
+        biom2sparse(), otherwise as a dense pandas df like the one 
+        written by biom2data_tax(). Ignored for tsv and .comad inputs.
+    samples, metadata, where: optional
+        Only load these samples, see read_biom_subset(). HDF5 biom files 
+        are read selectively, other inputs are subset after loading.
+    arg_ignore_level: int, optional
+        With a sample selection, only OTUs with more reads than this in 
+        the selected samples are kept. Default is 0.
+    
+    Returns
+    -------
+    table: pandas df or tuple
+        Abundance table accepted by neufit_table(), or None if the file 
+        format is not supported. While a comad.cache.TableCache is 
+        activated, whole tables come from (and are kept in) that cache as 
+        read only table_counts() tuples.
+    '''
+    extension = input_filename.split('.')[1]
+    selection = samples is not None or where is not None
+    tables = active_table_cache()
+    if tables is not None and not selection:
+        return tables.get(input_filename, sparse,
+                          lambda: load_abundances(input_filename, sparse))
+    with stage('parse', filename=input_filename, sparse=sparse) as record:
+        if selection and extension == 'biom':
+            table = read_biom_subset(input_filename, samples, metadata, where,
+                                     arg_ignore_level)
+            if sparse != True:
+                counts, otu_ids, sample_ids = table
+                table = pd.DataFrame(counts.toarray(), otu_ids, sample_ids)
+        elif is_columnar(input_filename):
+            table = load_columnar(input_filename)
+        elif extension == 'tsv':
+            table = pd.read_csv(input_filename, sep = '\t', index_col = 0)
+        elif extension == 'biom' and sparse == True:
+            table = biom2sparse(input_filename)
+        elif extension == 'biom':
+            from biom import load_table
+            featureTable = load_table(input_filename)
+            table = pd.DataFrame(_dense_counts(featureTable.matrix_data),
+                                 featureTable.ids('observation'), 
+                                 featureTable.ids())
+        else:
+            return None
+        if selection and extension != 'biom':
+            table = _subset_table(table, samples, metadata, where, arg_ignore_level)
+        counts = table[0] if isinstance(table, tuple) else table
+        record['shape'] = list(counts.shape)
+    return table
+
+def _subset_table(table, samples, metadata, where, arg_ignore_level):
+    # Sample selection of an already loaded df or (counts, ids) tuple
+    if isinstance(metadata, str):
+        metadata = read_metadata(metadata)
+    if isinstance(table, pd.DataFrame):
+        keep = select_samples(table.columns, samples, metadata, where)
+        table = table.loc[:, keep]
+        return table[table.sum(1) > arg_ignore_level]
+    counts, otu_ids, sample_ids = table
+    keep = select_samples(sample_ids, samples, metadata, where)
+    return _subset_counts(counts, otu_ids, sample_ids, keep, arg_ignore_level)
+
 def tsv2data_tax(tsv_filename, output_filename, output_folder_path):
     '''Imports tsv file -> pandas dataframe -> data.csv, taxonomy.csv 
     
@@ -120,11 +570,14 @@ def tsv2data_tax(tsv_filename, output_filename, output_folder_path):
 
     
     #Import data as _data.csv
-    pandas_featureTable = pd.read_csv(tsv_filename, sep = '\t', index_col = 0)
-    #pandas_featureTable = pandas_featureTable.T
+    with stage('parse', filename=tsv_filename) as record:
+        pandas_featureTable = pd.read_csv(tsv_filename, sep = '\t', index_col = 0)
+        #pandas_featureTable = pandas_featureTable.T
+        record['shape'] = list(pandas_featureTable.shape)
 
     fnD = data_tax_path +  output_filename + '_data.csv'
-    pandas_featureTable.to_csv(fnD, sep='\t')
+    with stage('write_data_tax'):
+        pandas_featureTable.to_csv(fnD, sep='\t')
     
     
     fnT = None
@@ -132,7 +585,108 @@ def tsv2data_tax(tsv_filename, output_filename, output_folder_path):
     return(fnD, fnT)
 
 
-def non_neutral_outliers(file_header, occurr_freqs, threshold = 0.5):
+def taxonomy_columns(occurr_freqs):
+    '''Columns of occurr_freqs between occurrence and 
+        predicted_occurrence, i.e. the joined taxonomy'''
+    columns = list(occurr_freqs.columns)
+    start = columns.index('occurrence') + 1
+    if 'predicted_occurrence' in columns:
+        return columns[start:columns.index('predicted_occurrence')]
+    return columns[start:]
+
+
+def non_neutral_masks(occurr_freqs, threshold = 0.5):
+    '''Distance off the neutral curve and non-neutral masks of all OTUs 
+        at once
+    
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+        Needs occurrence, predicted_occurrence, lower_conf_int and 
+        upper_conf_int columns (see neufit()).
+    threshold: float, optional
+        Minimal |occurrence - predicted_occurrence| of an outlier. Default 
+        is 0.5.
+    
+    Returns
+    -------
+    difference: numpy array
+        |occurrence - predicted_occurrence| per OTU
+    above, below: numpy array of bool
+        OTUs above the upper/below the lower confidence interval
+    outlier: numpy array of bool
+        OTUs with difference > threshold
+    '''
+    occurrence = occurr_freqs['occurrence'].to_numpy(dtype=float)
+    difference = np.abs(occurrence - 
+                        occurr_freqs['predicted_occurrence'].to_numpy(dtype=float))
+    above = occurrence > occurr_freqs['upper_conf_int'].to_numpy(dtype=float)
+    below = occurrence < occurr_freqs['lower_conf_int'].to_numpy(dtype=float)
+    return difference, above, below, difference > threshold
+
+
+def standout_microbes(occurr_freqs, difference, outlier, top = None):
+    '''Outlier OTUs sorted by their distance off the neutral curve
+    
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+    difference, outlier: numpy array
+        As returned by non_neutral_masks()
+    top: int, optional
+        Only keep the top most distant outliers. Default keeps all.
+    
+    Returns
+    -------
+    standoutMicrobes: pandas df
+        'Difference off Neutral Model' followed by the taxonomy columns
+    '''
+    rows = np.flatnonzero(outlier)
+    if top is not None and top < len(rows):
+        #Partial sort: only the top rows need ordering
+        rows = rows[np.argpartition(-difference[rows], top)[:top]]
+    rows = rows[np.argsort(-difference[rows], kind='stable')]
+    
+    standoutMicrobes = occurr_freqs.iloc[rows][taxonomy_columns(occurr_freqs)]
+    standoutMicrobes.insert(0, 'Difference off Neutral Model', difference[rows])
+    return standoutMicrobes.reset_index(drop=True)
+
+
+def non_neutral_rank_summary(occurr_freqs, rank, threshold = 0.5):
+    '''Counts of non-neutral OTUs per taxon of one taxonomic rank
+    
+    Parameters
+    ----------
+    occurr_freqs: pandas df
+        As returned by neufit(), with a taxonomy column named rank 
+        (e.g. 'Phylum').
+    rank: str
+        Taxonomy column to group by.
+    threshold: float, optional
+        See non_neutral_masks(). Default is 0.5.
+    
+    Returns
+    -------
+    summary: pandas df
+        Indexed by taxon: n_otus, n_above, n_below, n_outliers and 
+        mean_difference, sorted by the number of non-neutral OTUs.
+    '''
+    difference, above, below, outlier = non_neutral_masks(occurr_freqs, threshold)
+    summary = pd.DataFrame({'n_otus': 1, 'n_above': above, 'n_below': below,
+                            'n_outliers': outlier, 
+                            'mean_difference': difference},
+                           index=occurr_freqs.index)
+    summary = summary.groupby(occurr_freqs[rank].to_numpy(), sort=False).agg(
+        {'n_otus': 'sum', 'n_above': 'sum', 'n_below': 'sum', 
+         'n_outliers': 'sum', 'mean_difference': 'mean'})
+    summary.index.name = rank
+    order = np.argsort(-(summary['n_above'] + summary['n_below']).to_numpy(), 
+                       kind='stable')
+    return summary.iloc[order]
+
+
+def non_neutral_outliers(file_header, occurr_freqs, threshold = 0.5, 
+                         top = None, ranks = None, full = False):
     ''' Creates the most Non-neutral csv file 
     
     Written by: Caitlin Guccione, 08-25-2021
@@ -149,12 +703,25 @@ def non_neutral_outliers(file_header, occurr_freqs, threshold = 0.5):
     threshold: int, optional
         Autoset to 0.5, but determines which bacteria are considered 
         non-neutral strictly for this csv file
+    top: int, optional
+        Only export the top most non-neutral outliers. Default exports 
+        all outliers above threshold.
+    ranks: list of str, optional
+        Taxonomy columns (e.g. ['Phylum', 'Genus']) for which a 
+        [name]_NonNeutral_[rank].csv summary is written, see 
+        non_neutral_rank_summary().
+    full: bool, optional
+        Also write [name]_FullNonNeutral.csv, all OTUs outside the 
+        confidence interval (those above it first), from the same pass. 
+        Default is False.
         
      Returns
      -------
      csv file
          [name]_NonNeutralOutliers.csv, holds all the species 
          furthest off the neutral curve
+     standoutMicrobes: pandas df
+         Contents of that file
     
     TODO
     ----
@@ -163,39 +730,37 @@ def non_neutral_outliers(file_header, occurr_freqs, threshold = 0.5):
     
     '''
     
-    #Create standout microbes df with approriate col names
-    occurr_freqs_col_names = list(occurr_freqs.columns)
-    standoutMicrobes_col_names = ['Difference off Neutral Model']
-    start = False
-    for i in occurr_freqs_col_names:
-        if i == 'occurrence':
-            start = True 
-        elif start == True:
-            if i != 'predicted_occurrence':
-                standoutMicrobes_col_names.append(i)
-            else:
-                break
-    standoutMicrobes = pd.DataFrame(columns = standoutMicrobes_col_names)
-    
-    #Loop and find most non-neutral microbes based upon threshold
-    row_count = 0
-
-    for index, row in occurr_freqs.iterrows():
-        diff = abs(row['occurrence'] - row['predicted_occurrence'])
-        if diff > threshold:
-            new_row = [diff]
-            for i in standoutMicrobes_col_names[1:]:
-                new_row.append(row[i])
-            standoutMicrobes.loc[row_count] = new_row
-            row_count +=1
-    standoutMicrobes = standoutMicrobes.sort_values(by =['Difference off Neutral Model'],
-                                                    ascending=False)
-    
-    #Display and export non-neutral microbes as csv
-    print("\nTop NonNeutral Microbes")
-    print(standoutMicrobes)
+    with stage('outliers', n_otus=len(occurr_freqs)) as record:
+        standoutMicrobes = _non_neutral_outliers(file_header, occurr_freqs, 
+                                                 threshold, top, ranks, full)
+        record['n_outliers'] = len(standoutMicrobes)
+    return standoutMicrobes
+
+
+def _non_neutral_outliers(file_header, occurr_freqs, threshold, top, ranks, 
+                          full):
+    #Distance off the neutral model and non-neutral sets for all OTUs at once
+    difference, above, below, outlier = non_neutral_masks(occurr_freqs, threshold)
+    
+    if full:
+        #Non-neutral otus: outside the confidence interval
+        rows = np.concatenate((np.flatnonzero(above), np.flatnonzero(below)))
+        occurr_freqs.iloc[rows].to_csv(str(file_header) + '_FullNonNeutral.csv')
+    
+    #Most non-neutral microbes based upon threshold
+    standoutMicrobes = standout_microbes(occurr_freqs, difference, outlier, top)
+    
+    #Display a short summary and export non-neutral microbes as csv
+    print("\nTop NonNeutral Microbes (" + str(len(standoutMicrobes)) + \
+          " with difference > " + str(threshold) + ")")
+    print(standoutMicrobes.head(10).to_string())
     print('=========================================================\n')
     
-    fn = file_header + '_NonNeutral_Outliers.csv'
+    fn = str(file_header) + '_NonNeutral_Outliers.csv'
+    standoutMicrobes.to_csv(fn, sep = ',', index=False)
+    
+    for rank in ranks or []:
+        non_neutral_rank_summary(occurr_freqs, rank, threshold).to_csv(
+            str(file_header) + '_NonNeutral_' + str(rank) + '.csv')
     
-    standoutMicrobes.to_csv(fn, sep = ',', index=False)
\ No newline at end of file
+    return standoutMicrobes
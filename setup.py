@@ -92,6 +92,7 @@ setup(name='comad',
           'nose >= 1.3.7',
           'biom-format',
           'h5py', ],
+      extras_require={'parquet': ['pyarrow']},
       classifiers=classifiers,
       entry_points={'console_scripts': standalone},
       cmdclass={'install': CustomInstallCommand,